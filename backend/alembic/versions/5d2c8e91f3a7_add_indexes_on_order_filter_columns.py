@@ -0,0 +1,34 @@
+"""Add indexes on order filter columns
+
+Revision ID: 5d2c8e91f3a7
+Revises: a4faf00d95a3
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2c8e91f3a7'
+down_revision: Union[str, Sequence[str], None] = 'a4faf00d95a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_orders_status_created_at', 'orders', ['status', 'created_at'], unique=False)
+    op.create_index(op.f('ix_orders_table_id'), 'orders', ['table_id'], unique=False)
+    op.create_index(op.f('ix_order_items_order_id'), 'order_items', ['order_id'], unique=False)
+    op.create_index(op.f('ix_order_items_menu_id'), 'order_items', ['menu_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_order_items_menu_id'), table_name='order_items')
+    op.drop_index(op.f('ix_order_items_order_id'), table_name='order_items')
+    op.drop_index(op.f('ix_orders_table_id'), table_name='orders')
+    op.drop_index('ix_orders_status_created_at', table_name='orders')
@@ -0,0 +1,37 @@
+"""Add sales_rollup table
+
+Revision ID: 8b41f0c6d2e9
+Revises: 5d2c8e91f3a7
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b41f0c6d2e9'
+down_revision: Union[str, Sequence[str], None] = '5d2c8e91f3a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('sales_rollup',
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('hour', sa.Integer(), nullable=False),
+    sa.Column('menu_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=True),
+    sa.Column('revenue', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['menu_id'], ['menus.id'], ),
+    sa.PrimaryKeyConstraint('date', 'hour', 'menu_id')
+    )
+    # 既存の注文からの集計は `python -m app.rollup` で行う
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('sales_rollup')
@@ -0,0 +1,28 @@
+"""Add stock_quantity to Menu model
+
+Revision ID: c7a3d19e5b20
+Revises: 8b41f0c6d2e9
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7a3d19e5b20'
+down_revision: Union[str, Sequence[str], None] = '8b41f0c6d2e9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('menus', sa.Column('stock_quantity', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('menus', 'stock_quantity')
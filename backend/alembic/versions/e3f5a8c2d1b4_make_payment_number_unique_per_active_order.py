@@ -0,0 +1,43 @@
+"""Make payment_number unique only among active orders
+
+Revision ID: e3f5a8c2d1b4
+Revises: c7a3d19e5b20
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3f5a8c2d1b4'
+down_revision: Union[str, Sequence[str], None] = 'c7a3d19e5b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ACTIVE_ORDER = "payment_number IS NOT NULL AND status NOT IN ('completed', 'cancelled')"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 完了・キャンセルされた注文の支払い番号を再利用できるように、一意制約を進行中の注文に絞る
+    op.drop_index('ix_orders_payment_number', table_name='orders')
+    op.create_index('ix_orders_payment_number', 'orders', ['payment_number'], unique=False)
+    op.create_index(
+        'ux_orders_active_payment_number', 'orders', ['payment_number'], unique=True,
+        sqlite_where=sa.text(ACTIVE_ORDER),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 再利用された番号が残っていると一意インデックスは作れないので、古い注文の番号を消してから戻す
+    op.execute(
+        "UPDATE orders SET payment_number = NULL WHERE payment_number IS NOT NULL AND id NOT IN ("
+        " SELECT MAX(id) FROM orders WHERE payment_number IS NOT NULL GROUP BY payment_number)"
+    )
+    op.drop_index('ux_orders_active_payment_number', table_name='orders')
+    op.drop_index('ix_orders_payment_number', table_name='orders')
+    op.create_index('ix_orders_payment_number', 'orders', ['payment_number'], unique=True)
@@ -0,0 +1,285 @@
+import asyncio
+import heapq
+import hmac
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from .metrics import admission_in_flight, admission_queue_wait, admission_rejected, admission_waiting
+
+# 過負荷の時に、お金を受け取っているレジの処理を優先するための流入制御。
+# API へのリクエストを優先度クラスに分け、クラスごとの同時実行数・待ち時間・(クライアントごとの) レートを制限する。
+#   register  レジ (script.js のレジ画面)
+#   kitchen   調理画面・注文表示・スタッフの操作
+#   mobile    お客様のモバイルオーダー
+#   analytics 売上・注文一覧などの集計
+# 空いた枠は優先度の高いクラスの待ちから順に割り当てる。待ち時間の上限を超えたら 503、レートを超えたら 429 を
+# Retry-After 付きで返す。ADMISSION_CONTROL=0 で無効になる。
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"
+# 全クラス合計の同時実行数。SQLite の書き込みは1本なので、これ以上並べても待ちが DB に移るだけになる
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "16"))
+# 枠を待てるリクエストの数。これを超えたら待たずに 503
+ADMISSION_MAX_WAITING = int(os.environ.get("ADMISSION_MAX_WAITING", "200"))
+# レート制限のためにクライアントごとの状態を持つ上限
+RATE_LIMIT_CLIENTS = 10_000
+
+# スタッフの端末が自分のクラスを伝えるヘッダー
+CLIENT_CLASS_HEADER = "x-client-class"
+# クラスのヘッダーは、スタッフの端末だけに設定する合言葉 (ADMISSION_STAFF_TOKEN) が一緒に送られた場合だけ使う。
+# 未設定ならヘッダーは使わない（お客様の端末がヘッダーだけで優先されたり、レート制限を逃れたりしないように）
+STAFF_TOKEN_HEADER = "x-staff-token"
+ADMISSION_STAFF_TOKEN = os.environ.get("ADMISSION_STAFF_TOKEN", "")
+
+
+class PriorityClass:
+    def __init__(self, name: str, priority: int, max_concurrency: int, queue_timeout: float,
+                 rate: Optional[float] = None, burst: Optional[float] = None):
+        self.name = name
+        # 小さいほど優先
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        # 枠が空くのを待てる時間
+        self.queue_timeout = queue_timeout
+        # クライアント (IP) ごとの 1秒あたりのリクエスト数。None なら制限しない
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+
+
+def _env_class(name: str, priority: int, max_concurrency: int, queue_timeout: float,
+               rate: Optional[float] = None, burst: Optional[float] = None) -> PriorityClass:
+    prefix = f"ADMISSION_{name.upper()}_"
+    rate_env = os.environ.get(prefix + "RATE")
+    if rate_env is not None:
+        rate = float(rate_env) or None
+    burst_env = os.environ.get(prefix + "BURST")
+    return PriorityClass(
+        name, priority,
+        int(os.environ.get(prefix + "CONCURRENCY", str(max_concurrency))),
+        float(os.environ.get(prefix + "QUEUE_TIMEOUT", str(queue_timeout))),
+        rate, float(burst_env) if burst_env is not None else burst,
+    )
+
+
+PRIORITY_CLASSES: Dict[str, PriorityClass] = {
+    cls.name: cls for cls in (
+        _env_class("register", 0, 16, 5.0),
+        _env_class("kitchen", 1, 8, 3.0),
+        _env_class("mobile", 2, 8, 1.0, rate=5, burst=10),
+        _env_class("analytics", 3, 2, 0.5, rate=2, burst=5),
+    )
+}
+
+# メソッドとパスからクラスを決める（上から順に最初に一致したもの）
+ROUTE_CLASSES: List[Tuple[Optional[str], re.Pattern, str]] = [
+    ("POST", re.compile(r"^/api/orders/batch$"), "register"),
+    ("POST", re.compile(r"^/api/orders/?$"), "mobile"),
+    ("GET", re.compile(r"^/api/orders/by_payment_number/"), "mobile"),
+    ("GET", re.compile(r"^/api/orders/active"), "kitchen"),
+    ("GET", re.compile(r"^/api/orders/sales/"), "analytics"),
+    ("GET", re.compile(r"^/api/orders/?$"), "analytics"),
+    ("GET", re.compile(r"^/api/menus"), "mobile"),
+    (None, re.compile(r"^/api/"), "kitchen"),
+]
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    """リクエストの優先度クラス。API 以外 (静的ファイル・/ws・/metrics など) は制限しないので None"""
+    if not path.startswith("/api/"):
+        return None
+    for route_method, pattern, name in ROUTE_CLASSES:
+        if (route_method is None or route_method == method) and pattern.match(path):
+            return name
+    return None
+
+
+def is_staff(headers: Headers, staff_token: str = ADMISSION_STAFF_TOKEN) -> bool:
+    if not staff_token:
+        return False
+    return hmac.compare_digest(headers.get(STAFF_TOKEN_HEADER, "").encode(), staff_token.encode())
+
+
+def request_class(method: str, path: str, headers: Headers, staff_token: str = ADMISSION_STAFF_TOKEN) -> Optional[str]:
+    """メソッドとパスから決めたクラス。合言葉を送ったスタッフの端末に限り X-Client-Class のクラスを使う"""
+    name = classify(method, path)
+    if name is None:
+        return None
+    client_class = headers.get(CLIENT_CLASS_HEADER)
+    if client_class in PRIORITY_CLASSES and is_staff(headers, staff_token):
+        return client_class
+    return name
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """1つ取り出せれば 0、足りなければ次に取り出せるまでの秒数を返す"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, retry_after: float, detail: str):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+    """
+    優先度つきの同時実行制限とレート制限。イベントループの中だけで使うのでロックは要らない。
+    待っているリクエストは (優先度, 到着順) のヒープに積み、枠が空いたら先頭から割り当てる。
+    """
+
+    def __init__(self, classes: Dict[str, PriorityClass] = PRIORITY_CLASSES,
+                 max_concurrency: int = ADMISSION_MAX_CONCURRENCY, max_waiting: int = ADMISSION_MAX_WAITING):
+        self.classes = classes
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.in_flight_by_class: Dict[str, int] = {name: 0 for name in classes}
+        self._waiters: List[Tuple[int, int, asyncio.Future, PriorityClass]] = []
+        # ヒープには諦めたリクエストも残るので、実際に待っている数は別に数える
+        self.waiting = 0
+        self._order = count()
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+        admission_in_flight.callback = lambda: [((name,), n) for name, n in self.in_flight_by_class.items()]
+        admission_waiting.callback = self._waiting_by_class
+
+    def _waiting_by_class(self):
+        waiting = {name: 0 for name in self.classes}
+        for _, _, future, cls in self._waiters:
+            if not future.done():
+                waiting[cls.name] += 1
+        return [((name,), n) for name, n in waiting.items()]
+
+    def check_rate(self, cls: PriorityClass, client: str):
+        if cls.rate is None:
+            return
+        key = (cls.name, client)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(cls.rate, cls.burst)
+            while len(self._buckets) > RATE_LIMIT_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take()
+        if wait > 0:
+            raise Rejected(429, wait, "Too many requests")
+
+    def _can_run(self, cls: PriorityClass) -> bool:
+        return self.in_flight < self.max_concurrency and self.in_flight_by_class[cls.name] < cls.max_concurrency
+
+    def _take(self, cls: PriorityClass):
+        self.in_flight += 1
+        self.in_flight_by_class[cls.name] += 1
+
+    async def acquire(self, cls: PriorityClass):
+        # 枠が空けばその場で待ちに割り当てるので、待ちがあるのに枠が空いていることはない（追い越しは起きない）
+        if self._can_run(cls):
+            self._take(cls)
+            admission_queue_wait.observe(0.0, cls.name)
+            return
+        if self.waiting >= self.max_waiting:
+            raise Rejected(503, cls.queue_timeout, "Server busy")
+        if len(self._waiters) > 2 * self.max_waiting:
+            self._waiters = [entry for entry in self._waiters if not entry[2].done()]
+            heapq.heapify(self._waiters)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (cls.priority, next(self._order), future, cls))
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), cls.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.waiting -= 1
+                raise Rejected(503, cls.queue_timeout, "Server busy")
+        except asyncio.CancelledError:
+            # クライアントが切断した。割り当て済みなら枠を返す
+            if future.done() and not future.cancelled():
+                self.release(cls)
+            else:
+                future.cancel()
+                self.waiting -= 1
+            raise
+        admission_queue_wait.observe(time.perf_counter() - started, cls.name)
+
+    def release(self, cls: PriorityClass):
+        self.in_flight -= 1
+        self.in_flight_by_class[cls.name] -= 1
+        self._wake()
+
+    def _wake(self):
+        """空いた枠を、優先度の高い待ちから順に割り当てる。クラスの上限に達しているものは飛ばす"""
+        skipped = []
+        while self._waiters and self.in_flight < self.max_concurrency:
+            entry = heapq.heappop(self._waiters)
+            future, cls = entry[2], entry[3]
+            if future.done():
+                continue
+            if not self._can_run(cls):
+                skipped.append(entry)
+                continue
+            self._take(cls)
+            self.waiting -= 1
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+
+class AdmissionMiddleware:
+    """API へのリクエストを優先度クラスごとに受け付け・待たせ・断る ASGI ミドルウェア"""
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None, enabled: bool = ADMISSION_CONTROL,
+                 staff_token: str = ADMISSION_STAFF_TOKEN):
+        self.app = app
+        self.controller = controller or AdmissionController()
+        self.enabled = enabled
+        self.staff_token = staff_token
+        if enabled and not staff_token:
+            print("ADMISSION_STAFF_TOKEN が未設定のため X-Client-Class は使いません。"
+                  "レジの注文 (/api/orders/batch) 以外のスタッフの操作は、経路から決めたクラスで扱います")
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        name = request_class(scope["method"], scope["path"], Headers(scope=scope), self.staff_token)
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        cls = self.controller.classes[name]
+        client = scope["client"][0] if scope.get("client") else "unknown"
+        try:
+            self.controller.check_rate(cls, client)
+            await self.controller.acquire(cls)
+        except Rejected as e:
+            admission_rejected.inc(name, "rate_limited" if e.status_code == 429 else "overloaded")
+            response = JSONResponse(
+                {"detail": e.detail}, status_code=e.status_code,
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(cls)
@@ -1,12 +1,18 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+import asyncio
+import contextvars
 import os
+from .metrics import db_executor_queue, instrument_engine
 
 # プロジェクトルートパスを取得
 backend_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(backend_dir, "..", ".."))
-db_path = os.path.join(project_root, "db", "database.db")
+db_path = os.environ.get("DB_PATH", os.path.join(project_root, "db", "database.db"))
 
 # dbディレクトリが存在しない場合は作成
 os.makedirs(os.path.dirname(db_path), exist_ok=True)
@@ -14,16 +20,117 @@ os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{db_path}"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+JST = timezone(timedelta(hours=9))
+# SQLite のバインド変数の上限を超えないよう、IN 句の値や一括で書き込む行はこの件数ずつに分ける
+SQLITE_CHUNK_SIZE = 500
+
+# エンジンの設定
+#   DB_PROFILE=production: WAL・synchronous=NORMAL などのプラグマを接続ごとに設定する
+#   DB_PROFILE=basic:      SQLite の既定値のまま（ロールバックジャーナル・毎コミット fsync）
+DB_PROFILE = os.environ.get("DB_PROFILE", "production")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "65536"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# 同期エンドポイントはスレッドプール（既定40スレッド）で動くので、それに合わせる
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+# async def のエンドポイントから DB 処理を逃がす専用スレッドの数
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+# 売上集計などの読み取り専用クエリを別のエンジン（別の接続プール）で実行する
+DB_SEPARATE_READ_ENGINE = os.environ.get("DB_SEPARATE_READ_ENGINE", "0") == "1"
+
+
+def apply_sqlite_pragmas(dbapi_connection, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    try:
+        if not read_only:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        # 負の値は KiB 単位
+        cursor.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def make_engine(read_only: bool = False):
+    if DB_PROFILE == "basic":
+        new_engine = create_engine(
+            SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+        )
+        instrument_engine(new_engine)
+        return new_engine
+
+    url = SQLALCHEMY_DATABASE_URL
+    if read_only:
+        url = f"sqlite:///file:{db_path}?mode=ro&uri=true"
+    new_engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT_MS / 1000},
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+    )
+
+    @event.listens_for(new_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection, read_only=read_only)
+
+    instrument_engine(new_engine)
+    return new_engine
+
+
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def now_jst() -> datetime:
+    """DB に保存されている created_at と同じ、タイムゾーンなしの日本時間"""
+    return datetime.now(JST).replace(tzinfo=None)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# 同期の SQLAlchemy セッションはイベントループ上で使うと WebSocket を含む
+# すべての処理を止めてしまうので、async def のエンドポイントではこの専用
+# スレッドプールで実行する
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+db_executor_queue.callback = lambda: [((), db_executor._work_queue.qsize())]
+
+async def run_db(fn, *args, **kwargs):
+    """fn(*args, **kwargs) を DB 用スレッドで実行して結果を返す"""
+    loop = asyncio.get_running_loop()
+    # リクエストごとの SQL の件数を数えられるよう、呼び出し元のコンテキストを引き継ぐ
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, partial(context.run, fn, *args, **kwargs))
+
+
+# 読み取り専用エンジンは初回利用時に作る（テーブル作成後でないと開けないため）
+_read_session_factory = None
+
+def get_read_session_factory():
+    global _read_session_factory
+    if _read_session_factory is None:
+        if DB_SEPARATE_READ_ENGINE and DB_PROFILE != "basic":
+            _read_session_factory = sessionmaker(autocommit=False, autoflush=False, bind=make_engine(read_only=True))
+        else:
+            _read_session_factory = SessionLocal
+    return _read_session_factory
+
+def get_read_db():
+    """レポート系エンドポイント用のセッション"""
+    db = get_read_session_factory()()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+# 通知イベントの配送方法
+#   local:  同一プロセス内で配送する（ワーカー1つで動かす場合）
+#   sqlite: 共有の SQLite ファイルを介して全ワーカーに配送する（uvicorn --workers N）
+EVENT_BUS_BACKEND = os.environ.get("EVENT_BUS", "local")
+EVENT_BUS_POLL_INTERVAL = float(os.environ.get("EVENT_BUS_POLL_INTERVAL", "0.05"))
+EVENT_BUS_RETENTION = int(os.environ.get("EVENT_BUS_RETENTION", "5000"))
+
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(backend_dir, "..", ".."))
+EVENT_BUS_PATH = os.environ.get("EVENT_BUS_PATH", os.path.join(project_root, "db", "events.db"))
+
+Event = Dict[str, Any]
+EventHandler = Callable[[Event], Awaitable[None]]
+
+
+def build_event(message: Dict[str, Any], topics: Optional[Iterable[str]] = None,
+                key: Optional[str] = None, channel: Optional[str] = None,
+                order_topics: Optional[List[List[str]]] = None) -> Event:
+    """
+    バスに流すイベント。channel を指定すると、そのチャンネル内で
+    全ワーカー共通の単調増加 seq が振られる。
+    order_topics は複数の注文をまとめたメッセージの、注文ごとのトピック（接続ごとに絞り込んで送る）。
+    """
+    return {
+        "channel": channel,
+        "message": message,
+        "topics": list(topics) if topics is not None else None,
+        "key": key,
+        "order_topics": order_topics,
+    }
+
+
+class LocalEventBus:
+    """同一プロセス内でそのまま handler に渡す"""
+
+    def __init__(self, handler: EventHandler):
+        self.handler = handler
+        self._seq: Dict[str, int] = defaultdict(int)
+        # seq はプロセスを起動し直すと 1 から振り直すので、起動ごとに変わる epoch と組で使う
+        self.epoch = uuid.uuid4().hex[:12]
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Event):
+        if event["channel"] is not None:
+            self._seq[event["channel"]] += 1
+            event["seq"] = self._seq[event["channel"]]
+        await self.handler(event)
+
+
+class SQLiteEventBus:
+    """
+    SQLite ファイルをブローカーにして、全ワーカーにイベントを配送する。
+    発行したワーカーでは即座に配送し、他のワーカーはポーリングで受け取る。
+    """
+
+    def __init__(self, handler: EventHandler, path: str = EVENT_BUS_PATH,
+                 poll_interval: float = EVENT_BUS_POLL_INTERVAL, retention: int = EVENT_BUS_RETENTION):
+        self.handler = handler
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.last_id: Optional[int] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._epoch: Optional[str] = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " origin TEXT NOT NULL,"
+                " channel TEXT,"
+                " seq INTEGER,"
+                " payload TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS channel_seq ("
+                " channel TEXT PRIMARY KEY,"
+                " seq INTEGER NOT NULL)"
+            )
+            # seq を振り直すのはブローカーのファイルを作り直した時なので、epoch もファイルに持たせて全ワーカーで共有する
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:12],))
+            self._epoch = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    @property
+    def epoch(self) -> str:
+        """seq の系列。ブローカーのファイルが作り直されると変わる"""
+        if self._epoch is None:
+            with self._lock:
+                self._connect()
+        return self._epoch
+
+    def _insert(self, event: Event) -> Event:
+        with self._lock:
+            return self._insert_locked(event)
+
+    def _insert_locked(self, event: Event) -> Event:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if event["channel"] is not None:
+                conn.execute(
+                    "INSERT INTO channel_seq (channel, seq) VALUES (?, 1)"
+                    " ON CONFLICT(channel) DO UPDATE SET seq = seq + 1",
+                    (event["channel"],),
+                )
+                event["seq"] = conn.execute(
+                    "SELECT seq FROM channel_seq WHERE channel = ?", (event["channel"],)
+                ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO events (origin, channel, seq, payload) VALUES (?, ?, ?, ?)",
+                (self.worker_id, event["channel"], event.get("seq"), json.dumps(event)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return event
+
+    def _fetch(self) -> List[Event]:
+        with self._lock:
+            return self._fetch_locked()
+
+    def _fetch_locked(self) -> List[Event]:
+        conn = self._connect()
+        if self.last_id is None:
+            # 起動前のイベントは再配送しない
+            self.last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            return []
+        rows = conn.execute(
+            "SELECT id, origin, payload FROM events WHERE id > ? ORDER BY id", (self.last_id,)
+        ).fetchall()
+        events = []
+        for row_id, origin, payload in rows:
+            self.last_id = row_id
+            if origin != self.worker_id:
+                events.append(json.loads(payload))
+        return events
+
+    def _prune(self):
+        with self._lock:
+            self._connect().execute(
+                "DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (self.retention,)
+            )
+
+    async def start(self):
+        await asyncio.to_thread(self._fetch)
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def publish(self, event: Event):
+        event = await asyncio.to_thread(self._insert, event)
+        await self.handler(event)
+
+    async def _poll(self):
+        polls = 0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                for event in await asyncio.to_thread(self._fetch):
+                    await self.handler(event)
+                polls += 1
+                if polls % 1000 == 0:
+                    await asyncio.to_thread(self._prune)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event bus poll failed: {e}")
+
+
+def create_event_bus(handler: EventHandler, backend: str = EVENT_BUS_BACKEND):
+    if backend == "local":
+        return LocalEventBus(handler)
+    if backend == "sqlite":
+        return SQLiteEventBus(handler)
+    raise ValueError(f"Unknown event bus backend: {backend}")
@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.orm import Session, joinedload
+from .database import JST, SessionLocal, now_jst, run_db
+from .models import Order as ModelOrder, OrderItem as ModelOrderItem
+from .stock import apply_released_stock, order_quantities, publish_stock_changes, release_stock
+from .websockets import notify_orders_update, serialize_order
+
+# 未払いのモバイルオーダーを自動キャンセルするまでの時間
+UNPAID_ORDER_TTL = timedelta(seconds=int(os.environ.get("UNPAID_ORDER_TTL_SECONDS", str(15 * 60))))
+# 期限のヒープに載っていない注文（他のワーカーで作られたものなど）も拾うための定期スイープ間隔
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get("EXPIRY_SWEEP_INTERVAL", "60"))
+# 期限が近い注文をまとめて1回でキャンセルするため、最初の期限からこの秒数だけ待つ
+EXPIRY_BATCH_WINDOW = float(os.environ.get("EXPIRY_BATCH_WINDOW", "1"))
+
+
+def is_expired(created_at: datetime) -> bool:
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(JST).replace(tzinfo=None)
+    return now_jst() - created_at > UNPAID_ORDER_TTL
+
+
+def expire_unpaid_orders(db: Session, cutoff: datetime) -> Tuple[List[dict], List[dict]]:
+    """
+    cutoff より前に作られた未払い注文を1回の UPDATE でキャンセルし、同じトランザクションで在庫を戻す。
+    (キャンセルした注文, 在庫数が変わったメニュー) を返す
+    """
+    cancelled_ids = db.execute(
+        update(ModelOrder)
+        .where(ModelOrder.status == 'unpaid', ModelOrder.created_at < cutoff)
+        .values(status='cancelled', version=ModelOrder.version + 1)
+        .returning(ModelOrder.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    quantities = order_quantities(cancelled_ids, db) if cancelled_ids else {}
+    stock = release_stock(quantities, db) if quantities else {}
+    db.commit()
+    if not cancelled_ids:
+        return [], []
+    changed_menus = apply_released_stock(stock, db)
+    orders = db.query(ModelOrder).options(
+        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
+    ).filter(ModelOrder.id.in_(cancelled_ids)).order_by(ModelOrder.id).all()
+    return [serialize_order(order) for order in orders], changed_menus
+
+
+def load_unpaid_deadlines(db: Session) -> List[Tuple[datetime, int]]:
+    rows = db.query(ModelOrder.id, ModelOrder.created_at).filter(ModelOrder.status == 'unpaid').all()
+    return [(created_at + UNPAID_ORDER_TTL, order_id) for order_id, created_at in rows]
+
+
+class UnpaidOrderExpiry:
+    """
+    未払い注文の期限を1つのヒープで管理し、期限が来たらまとめてキャンセルする。
+    起動時に DB から未払い注文を読み直すので、再起動や --reload をまたいでも期限は失われない。
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, order_id: int, created_at: datetime):
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(JST).replace(tzinfo=None)
+        deadline = created_at + UNPAID_ORDER_TTL
+        heapq.heappush(self._heap, (deadline, order_id))
+        if self._wakeup is not None and self._heap[0] == (deadline, order_id):
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        for entry in await run_db(self._load):
+            heapq.heappush(self._heap, entry)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @staticmethod
+    def _load() -> List[Tuple[datetime, int]]:
+        db = SessionLocal()
+        try:
+            return load_unpaid_deadlines(db)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _expire(cutoff: datetime) -> Tuple[List[dict], List[dict]]:
+        db = SessionLocal()
+        try:
+            return expire_unpaid_orders(db, cutoff)
+        finally:
+            db.close()
+
+    async def sweep(self) -> List[dict]:
+        """期限切れの未払い注文をすべてキャンセルし、1つのメッセージで通知する"""
+        now = now_jst()
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+        cancelled, changed_menus = await run_db(self._expire, now - UNPAID_ORDER_TTL)
+        await publish_stock_changes(changed_menus)
+        if cancelled:
+            print(f"Orders {[order['id'] for order in cancelled]} have been cancelled due to non-payment.")
+            await notify_orders_update(cancelled)
+        return cancelled
+
+    async def _run(self):
+        while True:
+            timeout = EXPIRY_SWEEP_INTERVAL
+            if self._heap:
+                until_deadline = (self._heap[0][0] - now_jst()).total_seconds() + EXPIRY_BATCH_WINDOW
+                timeout = min(timeout, max(until_deadline, 0))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                # 新しい期限が先頭に来たので待ち時間を計算し直す
+                continue
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Unpaid order sweep failed: {e}")
+
+unpaid_expiry = UnpaidOrderExpiry()
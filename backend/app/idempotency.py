@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import json
+import os
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from .database import SQLITE_CHUNK_SIZE, SessionLocal, now_jst, run_db
+from .models import IdempotencyKey
+from .schemas import IDEMPOTENCY_KEY_MAX_LENGTH, OrderCreate
+from .serialization import dumps
+
+# 冪等キー付きの注文の応答を保持する期間。これを過ぎたキーは新しいリクエストとして扱う
+IDEMPOTENCY_TTL = timedelta(seconds=int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60))))
+# 期限切れのキーを削除する間隔
+IDEMPOTENCY_PURGE_INTERVAL = float(os.environ.get("IDEMPOTENCY_PURGE_INTERVAL", "600"))
+
+
+class IdempotencyConflict(Exception):
+    """同じキーの注文が、このリクエストの確認後に他のリクエストで登録された"""
+    pass
+
+
+def request_fingerprint(order: OrderCreate) -> str:
+    """同じキーで内容の違う注文が送られてきたことを見分けるためのハッシュ"""
+    body = order.model_dump(mode="json", exclude={"idempotency_key"})
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    冪等キー -> (リクエストのハッシュ, 最初の応答)。
+    注文と同じトランザクションで書き込むので、注文が登録されていればキーも必ず残っている
+    （コミットが遅くてクライアントがタイムアウトし、再送した場合も二重に登録されない）。
+    複数ワーカーでも共有される。期限切れのキーは定期的に削除する。
+    """
+
+    def __init__(self, ttl: timedelta = IDEMPOTENCY_TTL, purge_interval: float = IDEMPOTENCY_PURGE_INTERVAL):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._task: Optional[asyncio.Task] = None
+
+    def lookup(self, db: Session, keys: Iterable[str]) -> Dict[str, Tuple[str, Any]]:
+        keys = list(set(keys))
+        cutoff = now_jst() - self.ttl
+        found: Dict[str, Tuple[str, Any]] = {}
+        for start in range(0, len(keys), SQLITE_CHUNK_SIZE):
+            rows = db.query(IdempotencyKey.key, IdempotencyKey.request_hash, IdempotencyKey.response).filter(
+                IdempotencyKey.key.in_(keys[start:start + SQLITE_CHUNK_SIZE]),
+                IdempotencyKey.created_at >= cutoff,
+            ).all()
+            for key, request_hash, response in rows:
+                found[key] = (request_hash, json.loads(response))
+        return found
+
+    def save(self, db: Session, entries: List[Tuple[str, str, Any]]):
+        """
+        (キー, ハッシュ, 応答) を呼び出し側のトランザクション内で書き込む。
+        期限切れのキーは上書きする。まだ有効なキーがすでにあれば IdempotencyConflict。
+        """
+        if not entries:
+            return
+        now = now_jst()
+        statement = sqlite_insert(IdempotencyKey).values([
+            {"key": key, "request_hash": request_hash, "response": dumps(response).decode("utf-8"), "created_at": now}
+            for key, request_hash, response in entries
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[IdempotencyKey.key],
+            set_={
+                "request_hash": statement.excluded.request_hash,
+                "response": statement.excluded.response,
+                "created_at": statement.excluded.created_at,
+            },
+            where=IdempotencyKey.created_at < now - self.ttl,
+        ).returning(IdempotencyKey.key)
+        written: Set[str] = set(db.execute(statement).scalars().all())
+        if len(written) < len(entries):
+            raise IdempotencyConflict()
+
+    def purge(self, db: Session) -> int:
+        deleted = db.query(IdempotencyKey).filter(
+            IdempotencyKey.created_at < now_jst() - self.ttl
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+    def _purge(self) -> int:
+        db = SessionLocal()
+        try:
+            return self.purge(db)
+        finally:
+            db.close()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await run_db(self._purge)
+            except Exception as e:
+                print(f"Idempotency key purge failed: {e}")
+            await asyncio.sleep(self.purge_interval)
+
+idempotency_store = IdempotencyStore()
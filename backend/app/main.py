@@ -1,20 +1,36 @@
 from fastapi import FastAPI, Depends
 from sqlalchemy.orm import Session
-from .database import SessionLocal, engine, Base
+from .database import SessionLocal, engine, Base, get_db, run_db
 from .models import Table, Menu, Order, OrderItem
 from .routers import tables, menus, orders
 from fastapi.middleware.cors import CORSMiddleware
-from .websockets import manager
+from .websockets import manager, event_bus, order_events, order_updates
+from .admission import AdmissionMiddleware
+from .metrics import MetricsMiddleware, background_queue, render_metrics
+from .profiler import profiler
+from .schemas import ProfilerSettings
+from .serialization import order_bodies
+from .expiry import unpaid_expiry
+from .idempotency import idempotency_store
+from .static_assets import StaticAssets
+from .sales import sales_accumulator
+from .rollup import backfill, has_completed_orders, rollup_is_empty
 from fastapi import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+import asyncio
+import json
 import os
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from typing import Optional
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from sqlalchemy import text
 
 # テーブル作成
 Base.metadata.create_all(bind=engine)
 
 app = FastAPI(title="Order System API", version="1.0.0",docs_url="/null", redoc_url="/null2")
 
+# 過負荷時はレジ > 調理 > モバイル > 集計 の順に優先して受け付ける (CORS の内側に置き、断る応答にも CORS ヘッダーを付ける)
+app.add_middleware(AdmissionMiddleware)
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -23,23 +39,57 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# ルートごとのレイテンシ・SQL の件数を記録し、遅いリクエストはプロファイラに渡す
+app.add_middleware(MetricsMiddleware, on_request_end=profiler.request_finished)
 
-# 依存性
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+background_queue.callback = lambda: [
+    (("order_event_log",), len(order_events.events)),
+    (("unpaid_expiry",), len(unpaid_expiry)),
+    (("order_body_cache",), len(order_bodies)),
+]
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, topics: Optional[str] = None, session: Optional[str] = None):
+    """
+    購読するトピックは接続時に ?topics=orders.active,menu で指定するか、
+    接続後に {"action": "subscribe" | "unsubscribe", "topics": [...]} を送る。
+    指定しなければすべてのメッセージを受信する。
+    サブプロトコルに msgpack を指定すると、サーバーからのメッセージを MessagePack のバイナリで受け取る
+    （コマンドはどちらでも JSON のテキストで送る）。
+    接続すると {"type": "session", "session_id": ...} が届く。再接続の時に ?session=<session_id> を付けると、
+    古い接続を置き換えて購読を引き継ぐ。サーバーからの {"type": "ping"} には {"action": "pong"} を返す。
+    """
+    initial_topics = [t for t in topics.split(",") if t] if topics else None
+    if await manager.connect(websocket, initial_topics, session_id=session) is None:
+        return
     try:
-        while True:
-            data = await websocket.receive_text()
-            await manager.send_personal_message(f"You wrote: {data}", websocket)
+        # 置き換えられた古い接続はサーバー側で閉じられるので、そこで抜ける
+        while websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                data = await asyncio.wait_for(websocket.receive_text(), manager.idle_timeout)
+            except asyncio.TimeoutError:
+                # pong も届かない（スリープした端末などで切れている）
+                await manager.close_idle(websocket)
+                return
+            try:
+                command = json.loads(data)
+            except ValueError:
+                command = None
+            action = command.get("action") if isinstance(command, dict) else None
+            if action == "pong":
+                continue
+            if action in ("subscribe", "unsubscribe"):
+                requested = [str(t) for t in command.get("topics") or []]
+                if action == "subscribe":
+                    current = manager.subscribe(websocket, requested)
+                else:
+                    current = manager.unsubscribe(websocket, requested)
+                await manager.send_personal_message({"type": "subscriptions", "topics": sorted(current)}, websocket)
+            else:
+                await manager.send_personal_message({"type": "error", "detail": "Unknown command"}, websocket)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 # ルーターのインクルード
@@ -48,9 +98,29 @@ app.include_router(menus.router, prefix="/api/menus", tags=["menus"])
 app.include_router(orders.router, prefix="/api/orders", tags=["orders"])
 
 @app.get("/health")
-def health_check():
+def health_check(db: Session = Depends(get_db)):
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unhealthy", "detail": str(e)})
     return {"status": "healthy"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus のテキスト形式のメトリクス"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/profiler")
+def get_profiler():
+    """遅いリクエストのプロファイラの設定と、書き出したファイルの数"""
+    return profiler.status()
+
+@app.put("/profiler")
+def set_profiler(settings: ProfilerSettings):
+    """再起動せずにプロファイラを切り替える。例: {"slow_request_ms": 200} で有効、{"slow_request_ms": 0} で無効"""
+    profiler.configure(settings.slow_request_ms, settings.interval_ms)
+    return profiler.status()
+
 # テストデータ挿入 (開発用)
 @app.post("/init-data")
 def init_data(db: Session = Depends(get_db)):
@@ -73,8 +143,24 @@ def init_data(db: Session = Depends(get_db)):
 
     return {"message": "テストデータ挿入完了"}
 
+def rebuild_sales():
+    db = SessionLocal()
+    try:
+        sales_accumulator.rebuild(db)
+        # sales_rollup を追加する前からある DB では、初回起動時に既存の完了注文から作る
+        if rollup_is_empty(db) and has_completed_orders(db):
+            count = backfill(db)
+            print(f"sales_rollup を {count} 件の完了注文から作成しました")
+    finally:
+        db.close()
+
 @app.on_event("startup")
 async def startup_event():
+    profiler.start()
+    await event_bus.start()
+    # WebSocket の ping と、期限切れのセッションの削除
+    await manager.start()
+
     db = SessionLocal()
     try:
         # テーブルデータが存在しない場合のみ追加
@@ -104,9 +190,28 @@ async def startup_event():
     finally:
         db.close()
 
+    # 未払い注文の期限を DB から読み直して自動キャンセルを再開する
+    await unpaid_expiry.start()
+    # 期限切れの冪等キーを定期的に削除する
+    await idempotency_store.start()
+
+    # 今日の売上集計を DB から作り直す
+    await run_db(rebuild_sales)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await unpaid_expiry.stop()
+    await idempotency_store.stop()
+    # まとめ送りのために溜めている注文イベントを発行してから止める
+    await order_updates.stop()
+    await event_bus.stop()
+    await manager.stop()
+    profiler.stop()
+
 # 静的ファイルのマウント (他のすべてのルートの後に配置)
 backend_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.abspath(os.path.join(backend_dir, "..", ".."))
 frontend_path = os.path.join(project_root, "frontend")
 
-app.mount("/", StaticFiles(directory=frontend_path, html=True), name="static")
\ No newline at end of file
+# 起動時に読み込んで圧縮・フィンガープリントを済ませ、メモリから返す
+app.mount("/", StaticAssets(frontend_path), name="static")
\ No newline at end of file
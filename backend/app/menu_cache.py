@@ -0,0 +1,130 @@
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy.orm import Session
+from .models import Menu as ModelMenu
+from .schemas import Menu
+
+# 注文のたびに変わる在庫の項目。これだけの変更はキャッシュを作り直さずにその場で反映する
+STOCK_FIELDS = {"stock_quantity", "is_out_of_stock"}
+
+
+class CatalogSnapshot:
+    """ある時点のメニュー一覧と、一覧系エンドポイント用のシリアライズ済み JSON"""
+
+    def __init__(self, menus: List[Dict[str, Any]], generation: int = 0,
+                 order_menus: Optional[Dict[int, Dict[str, Any]]] = None):
+        # メニューが変わるたびに増える（在庫の項目だけの変更では変わらない）。メニューを埋め込んだキャッシュのキーに使う
+        self.generation = generation
+        self.menus: Dict[int, Dict[str, Any]] = {menu["id"]: menu for menu in menus}
+        # 注文に埋め込むメニュー (schemas.OrderItemMenu)。在庫の項目を含めないので、在庫が変わっても世代と同じく変わらない
+        if order_menus is None:
+            order_menus = {
+                menu["id"]: {key: value for key, value in menu.items() if key not in STOCK_FIELDS} for menu in menus
+            }
+        self.order_menus = order_menus
+        # DB の distinct と同じく、最初に現れた順でカテゴリを並べる
+        self.categories: List[str] = list(dict.fromkeys(menu["category"] for menu in menus))
+        self.categories_body = self._encode(self.categories)
+        self.categories_etag = self._etag(self.categories_body)
+        # メニュー一覧の JSON は在庫が変わるたびに作り直すので、最初に要求された時に作る
+        self._bodies: Optional[Dict[Optional[str], bytes]] = None
+        self._etags: Dict[Optional[str], str] = {}
+
+    def _encode_bodies(self) -> Dict[Optional[str], bytes]:
+        bodies = self._bodies
+        if bodies is None:
+            menus = list(self.menus.values())
+            bodies = {None: self._encode(menus)}
+            for category in self.categories:
+                bodies[category] = self._encode([m for m in menus if m["category"] == category])
+            self._etags = {key: self._etag(body) for key, body in bodies.items()}
+            self._bodies = bodies
+        return bodies
+
+    def with_stock(self, menus: Iterable[Dict[str, Any]], reserved: bool = False) -> Optional["CatalogSnapshot"]:
+        """
+        在庫の項目だけを差し替えたスナップショット（変わらなければ None）。
+        reserved は注文による引き当てで、在庫は減る一方なので、通知が前後して届いても古い値には戻さない
+        """
+        updated = dict(self.menus)
+        changed = False
+        for menu in menus:
+            cached = updated.get(menu["id"])
+            if cached is None:
+                continue
+            if reserved and cached["stock_quantity"] is not None and menu["stock_quantity"] is not None \
+                    and cached["stock_quantity"] < menu["stock_quantity"]:
+                continue
+            stock = {field: menu[field] for field in STOCK_FIELDS if field in menu}
+            if any(cached.get(field) != value for field, value in stock.items()):
+                # キャッシュの dict は共有なので書き換えずに差し替える
+                updated[menu["id"]] = {**cached, **stock}
+                changed = True
+        if not changed:
+            return None
+        return CatalogSnapshot(list(updated.values()), self.generation, self.order_menus)
+
+    @staticmethod
+    def _encode(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+    def menus_body(self, category: Optional[str] = None) -> bytes:
+        return self._encode_bodies().get(category, b"[]")
+
+    def menus_etag(self, category: Optional[str] = None) -> str:
+        self._encode_bodies()
+        return self._etags.get(category) or self._etag(b"[]")
+
+
+class MenuCatalog:
+    """
+    プロセス全体で共有するメニューのキャッシュ。
+    メニューは1日に数回しか変わらないので、変更時（create_menu / update_menu と
+    イベントバス経由の menu_update）に破棄し、次のアクセスで DB から作り直す。
+    注文のたびに変わる在庫の項目は、破棄せずに update_stock で該当するメニューだけを差し替える。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._generation = 0
+
+    def get(self, db: Session) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+            generation = self._generation
+            rows = db.query(ModelMenu).order_by(ModelMenu.id).all()
+            snapshot = CatalogSnapshot(
+                [Menu.model_validate(row).model_dump(mode="json") for row in rows], generation
+            )
+            # 読み込み中に破棄された場合は古い内容を保持しない
+            if generation == self._generation:
+                self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        self._generation += 1
+        self._snapshot = None
+
+    def update_stock(self, menus: Iterable[Dict[str, Any]], reserved: bool = False):
+        """変更後のメニューの在庫の項目を、キャッシュ済みのメニューに反映する（世代は変えない）"""
+        with self._lock:
+            base = self._snapshot
+            if base is None:
+                return
+            snapshot = base.with_stock(menus, reserved)
+            # 作っている間に破棄された場合は古い内容を戻さない
+            if snapshot is not None and self._snapshot is base:
+                self._snapshot = snapshot
+
+menu_catalog = MenuCatalog()
@@ -0,0 +1,345 @@
+import bisect
+import contextvars
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Prometheus のテキスト形式で出力する最小限のメトリクス。
+# 依存を増やさないよう prometheus_client は使わず、ここで必要な種類だけ実装する。
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+LabelValues = Tuple[str, ...]
+INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(Metric):
+    """値はスクレイプ時に callback で集める（キューの長さなど、その時点の状態を表すもの）"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], Iterable[Tuple[LabelValues, float]]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        if self.callback is not None:
+            try:
+                samples = list(self.callback())
+            except Exception:
+                samples = []
+            for labels, value in samples:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル -> [バケットごとの件数..., 合計, 件数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(row)) for labels, row in self._values.items()]
+        lines = self.header()
+        for labels, row in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, INF_LABEL)} {int(row[-1])}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(row[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {int(row[-1])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# --- HTTP ---
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"])
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ["method", "route"])
+http_request_db_statements = registry.histogram(
+    "http_request_db_statements", "SQL statements executed per HTTP request (catches N+1 queries).",
+    ["method", "route"], buckets=COUNT_BUCKETS)
+http_requests_in_progress = registry.gauge(
+    "http_requests_in_progress", "HTTP requests currently being handled.")
+
+# --- DB ---
+db_statement_duration = registry.histogram(
+    "db_statement_duration_seconds", "SQL statement execution time by operation and table.", ["operation", "table"])
+db_commit_duration = registry.histogram(
+    "db_commit_duration_seconds", "Time spent in COMMIT (WAL write / fsync).")
+db_executor_queue = registry.gauge(
+    "db_executor_queue_depth", "Jobs waiting for a DB executor thread.")
+db_pool_checked_out = registry.gauge(
+    "db_pool_connections_checked_out", "Connections currently checked out of the pool.")
+
+# --- WebSocket ---
+ws_connections = registry.gauge(
+    "ws_connections", "Open WebSocket connections.")
+ws_send_queue = registry.gauge(
+    "ws_send_queue_depth", "Messages waiting in WebSocket send queues.", ["stat"])
+ws_broadcast_duration = registry.histogram(
+    "ws_broadcast_fanout_seconds", "Time to enqueue one broadcast to every subscriber.")
+ws_broadcast_recipients = registry.histogram(
+    "ws_broadcast_recipients", "Connections a broadcast was enqueued to.", buckets=COUNT_BUCKETS)
+ws_messages_dropped = registry.counter(
+    "ws_messages_dropped_total", "Messages dropped or replaced because a send queue was full.", ["reason"])
+ws_frames_sent = registry.counter(
+    "ws_frames_sent_total", "WebSocket frames sent, by encoding.", ["encoding"])
+ws_bytes_sent = registry.counter(
+    "ws_bytes_sent_total", "WebSocket payload bytes sent before permessage-deflate, by encoding.", ["encoding"])
+ws_connections_rejected = registry.counter(
+    "ws_connections_rejected_total", "WebSocket connections refused by the global or per-IP cap.", ["reason"])
+ws_connections_reaped = registry.counter(
+    "ws_connections_reaped_total", "WebSocket connections closed by the server (idle, replaced by a resumed session).",
+    ["reason"])
+ws_events_coalesced = registry.counter(
+    "ws_events_coalesced_total", "Order events merged into a batched frame instead of being sent on their own.")
+
+# --- 流入制御 ---
+admission_in_flight = registry.gauge(
+    "admission_in_flight", "Requests admitted and not yet finished, by priority class.", ["class"])
+admission_waiting = registry.gauge(
+    "admission_waiting", "Requests waiting for a concurrency slot, by priority class.", ["class"])
+admission_queue_wait = registry.histogram(
+    "admission_queue_wait_seconds", "Time a request waited for a concurrency slot.", ["class"])
+admission_rejected = registry.counter(
+    "admission_rejected_total", "Requests rejected by admission control.", ["class", "reason"])
+
+# --- その他のキュー ---
+background_queue = registry.gauge(
+    "background_queue_depth", "Items held by in-process background structures.", ["queue"])
+
+
+# --- リクエストごとの SQL 件数 ---
+# DB 用スレッドへもコンテキストを引き継ぐ（database.run_db）ので、スレッドをまたいで数えられる
+_request_statements: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "request_statements", default=None)
+
+_STATEMENT_RE = re.compile(
+    r"^\s*(SELECT|INSERT|UPDATE|DELETE|PRAGMA|BEGIN|COMMIT|ROLLBACK|CREATE|DROP|WITH)\b"
+    r"(?:.*?\b(?:FROM|INTO|UPDATE)\s+\"?(\w+))?",
+    re.IGNORECASE | re.DOTALL,
+)
+_statement_labels: Dict[str, Tuple[str, str]] = {}
+
+
+def statement_labels(statement: str) -> Tuple[str, str]:
+    """SQL を (操作, 主なテーブル) にまとめる。パラメータ違いの同じ文は同じラベルになる"""
+    labels = _statement_labels.get(statement)
+    if labels is None:
+        match = _STATEMENT_RE.match(statement)
+        if match is None:
+            labels = ("OTHER", "")
+        else:
+            operation = match.group(1).upper()
+            table = match.group(2) or ""
+            if operation == "UPDATE":
+                table = re.match(r"^\s*UPDATE\s+\"?(\w+)", statement, re.IGNORECASE).group(1)
+            labels = (operation, table)
+        if len(_statement_labels) < 10_000:
+            _statement_labels[statement] = labels
+    return labels
+
+
+_engines: List = []
+
+
+def _pool_checked_out():
+    return [((), sum(engine.pool.checkedout() for engine in _engines if hasattr(engine.pool, "checkedout")))]
+
+db_pool_checked_out.callback = _pool_checked_out
+
+
+def instrument_engine(engine):
+    """SQL の実行時間・件数と COMMIT の時間を記録するフックをエンジンに付ける"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        db_statement_duration.observe(time.perf_counter() - started, *statement_labels(statement))
+        counter = _request_statements.get()
+        if counter is not None:
+            counter[0] += 1
+
+    # COMMIT は cursor を通らないので、方言の do_commit を包んで時間を測る
+    dialect = engine.dialect
+    do_commit = dialect.do_commit
+
+    def timed_commit(dbapi_connection):
+        started = time.perf_counter()
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            db_commit_duration.observe(time.perf_counter() - started)
+
+    dialect.do_commit = timed_commit
+
+    _engines.append(engine)
+
+
+def route_template(scope) -> Optional[str]:
+    """
+    リクエストが一致したルートのパステンプレート。
+    include_router したルートの scope["route"] はプレフィックスを含まないので、
+    FastAPI が scope に残す実効ルートがあればそちらのテンプレートを使う。
+    """
+    context = (scope.get("fastapi") or {}).get("effective_route_context")
+    path = getattr(context, "path_format", None)
+    if path:
+        return path
+    route = scope.get("route")
+    return getattr(route, "path_format", None) or getattr(route, "path", None)
+
+
+class MetricsMiddleware:
+    """
+    ルートごとのレイテンシ・ステータス・SQL の件数を記録する ASGI ミドルウェア。
+    ルートはパスのテンプレート（/api/orders/{order_id}）でまとめる。
+    """
+
+    def __init__(self, app, on_request_end: Optional[Callable[[str, str, float, float], None]] = None):
+        self.app = app
+        self.on_request_end = on_request_end
+        self.in_progress = 0
+        http_requests_in_progress.callback = lambda: [((), self.in_progress)]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        statements = [0]
+        token = _request_statements.set(statements)
+        self.in_progress += 1
+        started_wall = time.time()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.in_progress -= 1
+            _request_statements.reset(token)
+            # ルートに一致しなかったもの（静的ファイルなど）はまとめる
+            route_path = route_template(scope) or ("static" if status["code"] < 400 else "unmatched")
+            method = scope["method"]
+            http_requests.inc(method, route_path, str(status["code"]))
+            http_request_duration.observe(elapsed, method, route_path)
+            http_request_db_statements.observe(statements[0], method, route_path)
+            if self.on_request_end is not None:
+                self.on_request_end(method, route_path, started_wall, elapsed)
+
+
+def render_metrics() -> str:
+    return registry.render()
@@ -1,9 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Boolean, Index, Text, text
 from sqlalchemy.orm import relationship
-from .database import Base
-from datetime import datetime, timezone, timedelta
-
-JST = timezone(timedelta(hours=9))
+from .database import JST, Base
+from datetime import datetime
 
 class Table(Base):
     __tablename__ = "tables"
@@ -21,6 +19,8 @@ class Menu(Base):
     category = Column(String, default="general")
     image_url = Column(String, nullable=True)
     is_out_of_stock = Column(Boolean, default=False)
+    # 在庫数。NULL なら数えない（is_out_of_stock を手動で切り替える）
+    stock_quantity = Column(Integer, nullable=True)
 
     order_items = relationship("OrderItem", back_populates="menu")
 
@@ -28,22 +28,54 @@ class Order(Base):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True, index=True)
-    payment_number = Column(String, unique=True, index=True, nullable=True)
-    table_id = Column(Integer, ForeignKey("tables.id"), nullable=True)
+    # 完了・キャンセルされた注文の番号は再利用されるので、一意なのは進行中の注文の間だけ
+    payment_number = Column(String, index=True, nullable=True)
+    table_id = Column(Integer, ForeignKey("tables.id"), nullable=True, index=True)
     total_price = Column(Float)
     status = Column(String, default="pending")  # unpaid, pending, preparing, ready, completed, cancelled
     created_at = Column(DateTime, default=lambda: datetime.now(JST))
+    # ステータスを書き換えるたびに増やす。遷移は読んだ時の version を条件に UPDATE する（楽観的排他制御）
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     table = relationship("Table")
     order_items = relationship("OrderItem", back_populates="order")
 
+    __table_args__ = (
+        # 調理中一覧 (status で絞って created_at で並べる) と売上集計 (status + 期間) 用
+        Index("ix_orders_status_created_at", "status", "created_at"),
+        Index(
+            "ux_orders_active_payment_number", "payment_number", unique=True,
+            sqlite_where=text("payment_number IS NOT NULL AND status NOT IN ('completed', 'cancelled')"),
+        ),
+    )
+
 class OrderItem(Base):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
-    menu_id = Column(Integer, ForeignKey("menus.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
+    menu_id = Column(Integer, ForeignKey("menus.id"), index=True)
     quantity = Column(Integer, default=1)
 
     order = relationship("Order", back_populates="order_items")
-    menu = relationship("Menu", back_populates="order_items")
\ No newline at end of file
+    menu = relationship("Menu", back_populates="order_items")
+
+class SalesRollup(Base):
+    """完了注文の売上を 日付 × 時 × メニュー で事前集計したもの"""
+    __tablename__ = "sales_rollup"
+
+    date = Column(Date, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    menu_id = Column(Integer, ForeignKey("menus.id"), primary_key=True)
+    quantity = Column(Integer, default=0)
+    revenue = Column(Float, default=0.0)
+
+class IdempotencyKey(Base):
+    """冪等キー付きで作成された注文の最初の応答。同じキーで再送されたら注文を作らずにこれを返す"""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    # 同じキーで内容の違うリクエストを見分けるためのハッシュ
+    request_hash = Column(String)
+    response = Column(Text)
+    created_at = Column(DateTime, index=True)
@@ -0,0 +1,106 @@
+import itertools
+import os
+import random
+import string
+import threading
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Set
+from sqlalchemy.orm import Session
+from .models import Order as ModelOrder
+
+PAYMENT_NUMBER_ALPHABET = string.ascii_uppercase + string.digits
+PAYMENT_NUMBER_LENGTH = int(os.environ.get("PAYMENT_NUMBER_LENGTH", "3"))
+# この状態の注文の支払い番号は再利用できる
+RELEASED_STATUSES = ('completed', 'cancelled')
+
+
+class PaymentNumbersExhausted(Exception):
+    pass
+
+
+class PaymentNumberAllocator:
+    """
+    モバイルオーダーの支払い番号を重複なく払い出す。
+    未使用の番号をキューで持ち、完了・キャンセルされた注文の番号はキューの末尾に戻すので、
+    返却された番号はすぐには再利用されない。払い出し・返却とも DB を引かずに O(1)。
+    使用中の番号は DB（完了・キャンセル以外の注文）から起動時に読み直す。
+    """
+
+    def __init__(self, length: int = PAYMENT_NUMBER_LENGTH, alphabet: str = PAYMENT_NUMBER_ALPHABET):
+        self.length = length
+        self.alphabet = alphabet
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._queue: Deque[str] = deque()
+        self._in_use: Set[str] = set()
+
+    def load(self, db: Session):
+        with self._lock:
+            self._load_locked(db)
+
+    def ensure_loaded(self, db: Session):
+        # 最初の払い出しが同時に来ても読み込みは1回だけ（後から読み込むと払い出した番号を上書きしてしまう）
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load_locked(db)
+
+    def _load_locked(self, db: Session):
+        in_use = {
+            row[0] for row in db.query(ModelOrder.payment_number).filter(
+                ModelOrder.payment_number.isnot(None),
+                ModelOrder.status.notin_(RELEASED_STATUSES),
+            ).all()
+        }
+        codes = [''.join(chars) for chars in itertools.product(self.alphabet, repeat=self.length)]
+        random.shuffle(codes)
+        self._in_use = in_use
+        self._queue = deque(code for code in codes if code not in in_use)
+        self._loaded = True
+
+    def allocate(self, count: int = 1) -> List[str]:
+        codes = []
+        with self._lock:
+            while len(codes) < count:
+                if not self._queue:
+                    self._in_use.difference_update(codes)
+                    self._queue.extendleft(reversed(codes))
+                    raise PaymentNumbersExhausted()
+                code = self._queue.popleft()
+                # 他のワーカーで使われた番号はキューに残ったままなので、ここで読み飛ばす
+                if code in self._in_use:
+                    continue
+                self._in_use.add(code)
+                codes.append(code)
+        return codes
+
+    def release(self, codes: Iterable[Optional[str]]):
+        with self._lock:
+            for code in codes:
+                if code in self._in_use:
+                    self._in_use.remove(code)
+                    self._queue.append(code)
+
+    def mark_in_use(self, codes: Iterable[Optional[str]]):
+        with self._lock:
+            self._in_use.update(code for code in codes if code)
+
+    def reclaim(self, code: str) -> bool:
+        """返却済みの番号をもう一度使う（完了した注文を戻す時）。すでに他の注文が使っていれば False"""
+        with self._lock:
+            if code in self._in_use:
+                return False
+            self._in_use.add(code)
+            return True
+
+    def observe(self, order: dict):
+        """注文イベントから使用中・返却を反映する（他のワーカーでの変更も含む）"""
+        code = order.get("payment_number")
+        if not code or not self._loaded:
+            return
+        if order.get("status") in RELEASED_STATUSES:
+            self.release([code])
+        else:
+            self.mark_in_use([code])
+
+payment_numbers = PaymentNumberAllocator()
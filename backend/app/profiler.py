@@ -0,0 +1,167 @@
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# 遅いリクエストのフレームグラフ用データを書き出すサンプリングプロファイラ（既定では無効。PUT /profiler で切り替えられる）
+#   PROFILE_SLOW_REQUESTS_MS: これより遅いリクエストの間に採ったサンプルを書き出す (0 なら無効)
+#   PROFILE_INTERVAL_MS:      サンプリング間隔
+#   PROFILE_DIR:              書き出し先 (collapsed stack 形式。flamegraph.pl や speedscope で開ける)
+#   PROFILE_MAX_FILES:        書き出し先に残すファイル数。超えたら古いものから消す
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get("PROFILE_SLOW_REQUESTS_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+# 書き出し待ちの上限。過負荷ですべてのリクエストが遅い時は、溢れた分を書き出さずに捨てる
+PROFILE_QUEUE_SIZE = 16
+# 保持するサンプルの期間。これより長いリクエストは先頭が欠ける
+PROFILE_WINDOW_SECONDS = 30
+
+IDLE_FRAMES = {("select", "selectors.py"), ("wait", "threading.py"), ("_worker", "thread.py")}
+
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(backend_dir, "..", ".."))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(project_root, "db", "profiles"))
+
+
+def collapse_stack(frame) -> str:
+    """フレームを root;...;leaf 形式の1行にする"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    一定間隔で全スレッドのスタックを採り、直近の分をリングバッファに保持する。
+    リクエストが遅かった時だけ、その間のサンプルを集計してファイルに書き出す。
+    async のハンドラ・スレッドプール・DB 用スレッドのどこで時間を使っていても拾える。
+    集計と書き出しは専用のスレッドで行い、イベントループではキューに積むだけにする。
+    """
+
+    def __init__(self, threshold_ms: float = PROFILE_SLOW_REQUESTS_MS,
+                 interval_ms: float = PROFILE_INTERVAL_MS, output_dir: str = PROFILE_DIR,
+                 max_files: int = PROFILE_MAX_FILES):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.max_files = max_files
+        maxlen = int(PROFILE_WINDOW_SECONDS / max(self.interval, 0.001))
+        # (時刻, スレッド名, スタック)
+        self._samples: Deque[Tuple[float, str, str]] = deque(maxlen=maxlen * 8)
+        # 書き出し待ちの (メソッド, ルート, 開始時刻, 所要時間)
+        self._pending: "queue.Queue[Tuple[str, str, float, float]]" = queue.Queue(maxsize=PROFILE_QUEUE_SIZE)
+        self.dropped = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        # 止めた直後に再開しても前のスレッドが確実に終わるよう、起動ごとに別の Event を渡す
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._write_pending, args=(self._stop,), name="profile-writer", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def configure(self, threshold_ms: float, interval_ms: Optional[float] = None):
+        """実行中に閾値（0 で無効）とサンプリング間隔を変える"""
+        self.stop()
+        self.threshold = threshold_ms / 1000
+        if interval_ms is not None:
+            self.interval = interval_ms / 1000
+        self.start()
+
+    def status(self) -> Dict[str, Any]:
+        try:
+            files = len([name for name in os.listdir(self.output_dir) if name.endswith(".folded")])
+        except OSError:
+            files = 0
+        return {
+            "enabled": self._thread is not None,
+            "slow_request_ms": self.threshold * 1000,
+            "interval_ms": self.interval * 1000,
+            "profiles": files,
+            "max_files": self.max_files,
+            "dropped": self.dropped,
+        }
+
+    def _run(self, stop: threading.Event):
+        me = threading.get_ident()
+        while not stop.wait(self.interval):
+            now = time.time()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                # 仕事を待っているだけのスレッド（イベントループの select・空いているスレッドプール）は記録しない
+                if (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in IDLE_FRAMES:
+                    continue
+                stack = collapse_stack(frame)
+                self._samples.append((now, names.get(ident, str(ident)), stack))
+
+    def request_finished(self, method: str, route: str, started: float, elapsed: float):
+        """MetricsMiddleware から呼ばれる。閾値を超えたリクエストを書き出しのキューに積む"""
+        if self._thread is None or elapsed < self.threshold:
+            return
+        try:
+            self._pending.put_nowait((method, route, started, elapsed))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_pending(self, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                request = self._pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._write(*request)
+            self._prune()
+
+    def _write(self, method: str, route: str, started: float, elapsed: float):
+        end = started + elapsed
+        folded = Counter(
+            f"{thread};{stack}" for at, thread, stack in list(self._samples) if started <= at <= end
+        )
+        if not folded:
+            return
+        safe_route = re.sub(r"[^A-Za-z0-9_.-]+", "_", route).strip("_") or "root"
+        path = os.path.join(
+            self.output_dir,
+            f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}-{int(elapsed * 1000)}ms-{method}-{safe_route}.folded",
+        )
+        lines: List[str] = [f"{stack} {count}" for stack, count in folded.most_common()]
+        try:
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"Failed to write profile {path}: {e}")
+
+    def _prune(self):
+        """直近の max_files 件だけを残す"""
+        try:
+            paths = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir) if name.endswith(".folded")]
+            if len(paths) <= self.max_files:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - self.max_files]:
+                os.remove(path)
+        except OSError as e:
+            print(f"Failed to prune profiles: {e}")
+
+profiler = SamplingProfiler()
@@ -0,0 +1,136 @@
+import argparse
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, selectinload
+from .database import SQLITE_CHUNK_SIZE
+from .models import JST, Order as ModelOrder, OrderItem as ModelOrderItem, SalesRollup
+
+BACKFILL_BATCH_SIZE = 2000
+
+# (日付, 時, menu_id) -> [数量, 売上]
+RollupDelta = Dict[Tuple[date, int, int], List[float]]
+
+
+def order_contributions(order: ModelOrder) -> Iterable[Tuple[Tuple[date, int, int], int, float]]:
+    """
+    完了注文1件が集計に加える (キー, 数量, 売上)。
+    注文には商品ごとの販売価格が残っていないので、注文の合計金額を
+    現在の価格 × 数量 の比で商品に割り振る（時間帯ごとの合計は total_price の合計と一致する）。
+    """
+    created_at = order.created_at
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(JST).replace(tzinfo=None)
+    items = [item for item in order.order_items if item.menu_id is not None]
+    if not items:
+        return
+    weights = [item.quantity * (item.menu.price if item.menu is not None else 0.0) for item in items]
+    weight_total = sum(weights)
+    total = order.total_price or 0.0
+    for item, weight in zip(items, weights):
+        share = weight / weight_total if weight_total else 1 / len(items)
+        yield (created_at.date(), created_at.hour, item.menu_id), item.quantity, total * share
+
+
+def accumulate(delta: RollupDelta, orders: Iterable[ModelOrder], sign: int = 1):
+    for order in orders:
+        for key, quantity, revenue in order_contributions(order):
+            bucket = delta.setdefault(key, [0, 0.0])
+            bucket[0] += sign * quantity
+            bucket[1] += sign * revenue
+
+
+def apply_delta(db: Session, delta: RollupDelta):
+    """集計への差分を UPSERT で加える（コミットは呼び出し側のトランザクションで行う）"""
+    rows = [
+        {"date": day, "hour": hour, "menu_id": menu_id, "quantity": int(quantity), "revenue": revenue}
+        for (day, hour, menu_id), (quantity, revenue) in delta.items()
+        if quantity or revenue
+    ]
+    for start in range(0, len(rows), SQLITE_CHUNK_SIZE):
+        stmt = insert(SalesRollup).values(rows[start:start + SQLITE_CHUNK_SIZE])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[SalesRollup.date, SalesRollup.hour, SalesRollup.menu_id],
+            set_={
+                "quantity": SalesRollup.quantity + stmt.excluded.quantity,
+                "revenue": SalesRollup.revenue + stmt.excluded.revenue,
+            },
+        ))
+
+
+def record_status_change(db: Session, order: ModelOrder, original_status: str, new_status: str):
+    """注文が completed に入った・出た時に集計を更新する。ステータスの更新と同じトランザクションで呼ぶ"""
+    record_status_changes(db, [(order, original_status, new_status)])
+
+
+def record_status_changes(db: Session, changes: Iterable[Tuple[ModelOrder, str, str]]):
+    """(注文, 元のステータス, 新しいステータス) の集計への影響を、まとめて1回の UPSERT で反映する"""
+    delta: RollupDelta = {}
+    for order, original_status, new_status in changes:
+        if (original_status == 'completed') != (new_status == 'completed'):
+            accumulate(delta, [order], 1 if new_status == 'completed' else -1)
+    apply_delta(db, delta)
+
+
+def backfill(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """
+    完了注文から集計を作り直す。start / end（両端を含む）を指定するとその期間だけ置き換える。
+    作り直した注文の件数を返す。
+    """
+    query = db.query(ModelOrder).options(
+        selectinload(ModelOrder.order_items).selectinload(ModelOrderItem.menu)
+    ).filter(ModelOrder.status == 'completed')
+    clear = delete(SalesRollup)
+    if start is not None:
+        query = query.filter(ModelOrder.created_at >= datetime.combine(start, datetime.min.time()))
+        clear = clear.where(SalesRollup.date >= start)
+    if end is not None:
+        query = query.filter(ModelOrder.created_at <= datetime.combine(end, datetime.max.time()))
+        clear = clear.where(SalesRollup.date <= end)
+
+    delta: RollupDelta = defaultdict(lambda: [0, 0.0])
+    count = 0
+    last_id = 0
+    while True:
+        batch = query.filter(ModelOrder.id > last_id).order_by(ModelOrder.id).limit(BACKFILL_BATCH_SIZE).all()
+        if not batch:
+            break
+        accumulate(delta, batch)
+        count += len(batch)
+        last_id = batch[-1].id
+        db.expunge_all()
+
+    db.execute(clear)
+    apply_delta(db, delta)
+    db.commit()
+    return count
+
+
+def rollup_is_empty(db: Session) -> bool:
+    return db.query(SalesRollup.menu_id).first() is None
+
+
+def has_completed_orders(db: Session) -> bool:
+    return db.query(ModelOrder.id).filter(ModelOrder.status == 'completed').first() is not None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="完了注文から sales_rollup を作り直す")
+    parser.add_argument("--start", type=date.fromisoformat, help="開始日 (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="終了日 (YYYY-MM-DD)")
+    args = parser.parse_args(argv)
+
+    from .database import SessionLocal, engine, Base
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        count = backfill(db, args.start, args.end)
+    finally:
+        db.close()
+    print(f"Rebuilt sales_rollup from {count} completed orders.")
+
+
+if __name__ == "__main__":
+    main()
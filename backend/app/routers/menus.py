@@ -1,48 +1,131 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from typing import Dict, List, Optional, Set, Tuple
 from sqlalchemy.orm import Session
-from ..database import get_db
+from ..database import get_db, run_db
 from ..models import Menu as ModelMenu
-from ..schemas import Menu, MenuCreate, MenuUpdate
+from ..schemas import Menu, MenuCreate, MenuUpdate, MenuBulkUpdate, StockUpdate
 from ..websockets import notify_menu_update
+from ..menu_cache import menu_catalog
 
 router = APIRouter()
 
+def cached_json_response(request: Request, body: bytes, etag: str) -> Response:
+    """キャッシュ済みの JSON を返す。クライアントが同じ ETag を持っていれば 304"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @router.get("/", response_model=list[Menu])
-def get_menus(category: Optional[str] = None, db: Session = Depends(get_db)):
-    query = db.query(ModelMenu)
-    if category:
-        query = query.filter(ModelMenu.category == category)
-    return query.all()
+def get_menus(request: Request, category: Optional[str] = None, db: Session = Depends(get_db)):
+    catalog = menu_catalog.get(db)
+    category = category or None
+    return cached_json_response(request, catalog.menus_body(category), catalog.menus_etag(category))
 
 @router.get("/categories/", response_model=list[str])
-def get_categories(db: Session = Depends(get_db)):
-    categories = db.query(ModelMenu.category).distinct().all()
-    return [cat[0] for cat in categories]
+def get_categories(request: Request, db: Session = Depends(get_db)):
+    catalog = menu_catalog.get(db)
+    return cached_json_response(request, catalog.categories_body, catalog.categories_etag)
 
-@router.post("/", response_model=Menu)
-def create_menu(menu: MenuCreate, db: Session = Depends(get_db)):
-    db_menu = ModelMenu(**menu.dict())
+def with_stock_flag(values: dict) -> dict:
+    """在庫数が指定されて品切れフラグが指定されていなければ、在庫数から決める"""
+    if values.get("stock_quantity") is not None and "is_out_of_stock" not in values:
+        values["is_out_of_stock"] = values["stock_quantity"] <= 0
+    return values
+
+def insert_menu(menu: MenuCreate, db: Session) -> dict:
+    db_menu = ModelMenu(**with_stock_flag(menu.model_dump(exclude_unset=True)))
     db.add(db_menu)
     db.commit()
     db.refresh(db_menu)
-    return db_menu
+    menu_catalog.invalidate()
+    return Menu.model_validate(db_menu).model_dump(mode="json")
 
-@router.patch("/{menu_id}", response_model=Menu)
-async def update_menu(menu_id: int, menu_update: MenuUpdate, db: Session = Depends(get_db)):
+@router.post("/", response_model=Menu)
+async def create_menu(menu: MenuCreate, db: Session = Depends(get_db)):
+    created = await run_db(insert_menu, menu, db)
+
+    await notify_menu_update([created], fields=created.keys())
+
+    return created
+
+def apply_bulk_menu_update(updates: List[MenuBulkUpdate], db: Session) -> Tuple[List[dict], Set[str]]:
+    """
+    複数のメニューを1つのトランザクションで更新する。1つでも存在しなければ何も変更しない。
+    実際に値が変わったメニューと、変わった項目を返す。
+    """
+    changes: Dict[int, dict] = {}
+    for update in updates:
+        changes.setdefault(update.id, {}).update(with_stock_flag(update.model_dump(exclude_unset=True, exclude={"id"})))
+
+    db_menus = {menu.id: menu for menu in db.query(ModelMenu).filter(ModelMenu.id.in_(changes)).all()}
+    missing = [menu_id for menu_id in changes if menu_id not in db_menus]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Menu not found: {missing}")
+
+    changed, fields = [], set()
+    for menu_id, values in changes.items():
+        db_menu = db_menus[menu_id]
+        modified = {key for key, value in values.items() if getattr(db_menu, key) != value}
+        for key in modified:
+            setattr(db_menu, key, values[key])
+        if modified:
+            changed.append(db_menu)
+            fields |= modified
+
+    if not changed:
+        return [], fields
+    db.commit()
+    menu_catalog.invalidate()
+    return [Menu.model_validate(menu).model_dump(mode="json") for menu in changed], fields
+
+@router.patch("/bulk", response_model=list[Menu])
+async def update_menus_bulk(updates: List[MenuBulkUpdate], db: Session = Depends(get_db)):
+    """[{"id": 1, "is_out_of_stock": true}, ...] をまとめて適用し、変更を1回だけ通知する"""
+    changed, fields = await run_db(apply_bulk_menu_update, updates, db)
+    if changed:
+        await notify_menu_update(changed, fields)
+    return changed
+
+def apply_category_stock(category: str, is_out_of_stock: bool, db: Session) -> List[dict]:
+    db_menus = db.query(ModelMenu).filter(ModelMenu.category == category).all()
+    if not db_menus:
+        raise HTTPException(status_code=404, detail="Category not found")
+    updates = [MenuBulkUpdate(id=menu.id, is_out_of_stock=is_out_of_stock) for menu in db_menus]
+    changed, _ = apply_bulk_menu_update(updates, db)
+    return changed
+
+@router.patch("/categories/{category}/stock", response_model=list[Menu])
+async def update_category_stock(category: str, stock: StockUpdate, db: Session = Depends(get_db)):
+    """カテゴリ内のメニューの品切れをまとめて切り替える"""
+    changed = await run_db(apply_category_stock, category, stock.is_out_of_stock, db)
+    if changed:
+        await notify_menu_update(changed, ["is_out_of_stock"])
+    return changed
+
+def apply_menu_update(menu_id: int, menu_update: MenuUpdate, db: Session) -> dict:
     db_menu = db.query(ModelMenu).filter(ModelMenu.id == menu_id).first()
     if not db_menu:
         raise HTTPException(status_code=404, detail="Menu not found")
 
-    update_data = menu_update.model_dump(exclude_unset=True)
+    update_data = with_stock_flag(menu_update.model_dump(exclude_unset=True))
     for key, value in update_data.items():
         setattr(db_menu, key, value)
 
     db.add(db_menu)
     db.commit()
     db.refresh(db_menu)
+    menu_catalog.invalidate()
+    return Menu.model_validate(db_menu).model_dump(mode="json")
+
+@router.patch("/{menu_id}", response_model=Menu)
+async def update_menu(menu_id: int, menu_update: MenuUpdate, db: Session = Depends(get_db)):
+    updated = await run_db(apply_menu_update, menu_id, menu_update, db)
 
     # Notify clients about the update
-    await notify_menu_update()
+    await notify_menu_update([updated], fields=with_stock_flag(menu_update.model_dump(exclude_unset=True)).keys())
 
-    return db_menu
\ No newline at end of file
+    return updated
\ No newline at end of file
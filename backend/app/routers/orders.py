@@ -1,292 +1,683 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy.orm import joinedload
-from sqlalchemy import func
-from ..database import get_db
-from ..models import Order as ModelOrder, OrderItem as ModelOrderItem, Menu as ModelMenu, Table as ModelTable
-from ..schemas import OrderCreate, Order, OrderItem, StatusUpdate, SalesByTime, RealtimeSales, MenuSales
+from sqlalchemy.orm import selectinload
+from sqlalchemy import case, func, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from ..database import SQLITE_CHUNK_SIZE, get_db, get_read_db, now_jst, run_db
+from ..models import Order as ModelOrder, OrderItem as ModelOrderItem, Menu as ModelMenu, Table as ModelTable, SalesRollup
+from ..schemas import (
+    IDEMPOTENCY_KEY_MAX_LENGTH, OrderCreate, Order, OrderItem, StatusUpdate, SalesByTime, RealtimeSales, MenuSales,
+    ActiveOrdersDelta, OrderTransition, OrderTransitionsRequest, OrderTransitionsResult,
+)
 from ..database import SessionLocal
-from ..websockets import notify_new_order, notify_order_update
+from ..websockets import event_bus, notify_order_update, notify_orders_update, order_events
+from ..menu_cache import CatalogSnapshot, menu_catalog
+from ..expiry import unpaid_expiry, is_expired
+from ..sales import sales_accumulator
+from ..payment_numbers import RELEASED_STATUSES, PaymentNumbersExhausted, payment_numbers
+from ..rollup import record_status_changes
+from ..stock import (
+    StockLevels, apply_released_stock, order_quantities, publish_stock_changes, release_stock, reserve_stock, stock_menus,
+)
+from ..idempotency import IdempotencyConflict, idempotency_store, request_fingerprint
+from ..serialization import (
+    ORDER_COLUMNS, RawJSONResponse, build_order_dicts, dumps, join_array, json_response, order_bodies, order_dict,
+)
 from datetime import datetime, timedelta, timezone
 from sqlalchemy import func, extract
 
 JST = timezone(timedelta(hours=9))
 from sqlalchemy import extract
-from typing import List
-import random
+from typing import Dict, List, Optional, Set, Tuple, Union
 import time
 import asyncio
-import string
 
 router = APIRouter()
 
-# 支払い番号で注文を取得する関数
-def get_order_by_payment_number(payment_number: str, db: Session):
-    order = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).filter(ModelOrder.payment_number == payment_number).first()
-    return order
+ORDER_FIELDS = ("id", "table_id", "total_price", "payment_number", "status", "created_at", "order_items", "version")
+MAX_PAGE_SIZE = 1000
+# 他のワーカーと支払い番号が衝突した場合に払い出し直す回数
+PAYMENT_NUMBER_ATTEMPTS = 3
+# 同じ冪等キーのリクエストと競合した場合に、保存された応答を読み直す回数
+IDEMPOTENCY_ATTEMPTS = 3
+EXPORT_BATCH_SIZE = 500
+
+# 許可するステータスの遷移
+ALLOWED_TRANSITIONS = {
+    'unpaid': ['pending', 'cancelled'],
+    'pending': ['preparing', 'cancelled'],
+    'preparing': ['ready'],
+    'ready': ['completed'],
+    'completed': ['pending'],  # Allow returning to pending
+}
+# 遷移の条件に使う列: (id, ステータス, バージョン, 支払い番号)
+TRANSITION_COLUMNS = (ModelOrder.id, ModelOrder.status, ModelOrder.version, ModelOrder.payment_number)
+
+class OrderFilter:
+    """GET /api/orders/ の絞り込み・並び順・取得する項目"""
+
+    def __init__(self, status: Optional[str] = None, created_from: Optional[datetime] = None,
+                 created_to: Optional[datetime] = None, table_id: Optional[int] = None,
+                 desc: bool = False, fields: Optional[str] = None):
+        self.statuses = [s for s in status.split(",") if s] if status else None
+        self.created_from = created_from
+        self.created_to = created_to
+        self.table_id = table_id
+        self.desc = desc
+        self.fields = list(ORDER_FIELDS)
+        if fields:
+            requested = [f for f in fields.split(",") if f]
+            unknown = [f for f in requested if f not in ORDER_FIELDS]
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown fields: {unknown}")
+            # カーソルに使うので id は常に含める
+            self.fields = ["id"] + [f for f in requested if f != "id"]
+
+    @property
+    def with_items(self) -> bool:
+        return "order_items" in self.fields
+
+    @property
+    def all_fields(self) -> bool:
+        return set(self.fields) == set(ORDER_FIELDS)
+
+    def fetch_rows(self, db: Session, after_id: Optional[int], limit: Optional[int]):
+        """after_id の次から limit 件を列だけ取り出して返す（アイテムを含める場合は ORDER_COLUMNS の行）"""
+        if self.with_items:
+            query = db.query(*ORDER_COLUMNS)
+        else:
+            query = db.query(*[getattr(ModelOrder, f) for f in self.fields])
+        if self.statuses:
+            query = query.filter(ModelOrder.status.in_(self.statuses))
+        if self.created_from is not None:
+            query = query.filter(ModelOrder.created_at >= self.created_from)
+        if self.created_to is not None:
+            query = query.filter(ModelOrder.created_at <= self.created_to)
+        if self.table_id is not None:
+            query = query.filter(ModelOrder.table_id == self.table_id)
+        if after_id is not None:
+            query = query.filter(ModelOrder.id < after_id if self.desc else ModelOrder.id > after_id)
+        query = query.order_by(ModelOrder.id.desc() if self.desc else ModelOrder.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
-async def cancel_order_if_unpaid(order_id: int):
-    """15分後に注文が未払いであればキャンセルする"""
-    await asyncio.sleep(15 * 60)
+    def fetch(self, db: Session, after_id: Optional[int], limit: Optional[int]) -> List[dict]:
+        """after_id の次から limit 件を、選択された項目だけの dict で返す"""
+        rows = self.fetch_rows(db, after_id, limit)
+        if not self.with_items:
+            return [
+                {f: (v.isoformat() if isinstance(v, datetime) else v) for f, v in zip(self.fields, row)}
+                for row in rows
+            ]
+        return [{f: data[f] for f in self.fields} for data in build_order_dicts(rows, db)]
+
+    def fetch_json(self, db: Session, after_id: Optional[int], limit: Optional[int]) -> Tuple[bytes, int, Optional[int]]:
+        """fetch と同じ内容をエンコード済みの JSON 配列で返す。(本文, 件数, 最後の id)"""
+        if not self.all_fields:
+            rows = self.fetch(db, after_id, limit)
+            return dumps(rows), len(rows), (rows[-1]["id"] if rows else None)
+        # すべての項目を返す場合は注文ごとのキャッシュを使う
+        rows = self.fetch_rows(db, after_id, limit)
+        return join_array(order_bodies.encode(rows, db)), len(rows), (rows[-1][0] if rows else None)
+
+def export_orders_ndjson(order_filter: OrderFilter, after_id: Optional[int]):
+    """全件をキーセットで少しずつ読み出して NDJSON で流す（メモリ使用量は件数によらず一定）"""
+    # レスポンスを流している間もリクエストのセッションに依存しないよう、専用のセッションを使う
     db = SessionLocal()
     try:
-        db_order = db.query(ModelOrder).filter(ModelOrder.id == order_id).first()
-        if db_order and db_order.status == 'unpaid':
-            created_at = db_order.created_at
-            if created_at.tzinfo is None:
-                created_at = created_at.replace(tzinfo=JST)
-            if datetime.now(JST) - created_at > timedelta(minutes=15):
-                db_order.status = 'cancelled'
-                db.commit()
-                db.refresh(db_order)
-                print(f"Order {order_id} has been cancelled due to non-payment.")
-                await notify_order_update(order_id, 'cancelled')
+        while True:
+            rows = order_filter.fetch(db, after_id, EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield b"".join(dumps(row) + b"\n" for row in rows)
+            after_id = rows[-1]["id"]
+            db.expunge_all()
     finally:
         db.close()
 
-
 @router.get("/", response_model=list[Order])
-def get_orders(db: Session = Depends(get_db)):
-    orders = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).all()
-    for order in orders:
-        order.order_items = order.order_items or []
-    return orders
+def get_orders(
+    response: Response,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    status: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    table_id: Optional[int] = None,
+    desc: bool = False,
+    fields: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    db: Session = Depends(get_db),
+):
+    """
+    注文一覧。
+    - after_id / limit: キーセットページング。ページが埋まった場合は X-Next-Cursor に次の after_id を返す
+    - status (カンマ区切り) / created_from / created_to / table_id: サーバー側での絞り込み
+    - desc: 新しい順 (after_id より小さい id を返す)
+    - fields: 返す項目をカンマ区切りで指定 (order_items を含めなければアイテムは読み込まない)
+    - format=ndjson: 全件を1行1注文でストリーミングする (エクスポート用)
+    limit を指定しない場合は、従来どおり条件に合う全件を返す。
+    """
+    order_filter = OrderFilter(status, created_from, created_to, table_id, desc, fields)
+    if format == "ndjson":
+        return StreamingResponse(export_orders_ndjson(order_filter, after_id), media_type="application/x-ndjson")
+
+    body, count, last_id = order_filter.fetch_json(db, after_id, limit)
+    headers = {}
+    if limit is not None and count == limit:
+        headers["X-Next-Cursor"] = str(last_id)
+    # fields で項目を絞った場合は schemas.Order の形にならないので、そのまま返す
+    return RawJSONResponse(body, headers=headers)
+
+@router.get("/active", response_model=Union[list[Order], ActiveOrdersDelta])
+def get_active_orders(since_seq: Optional[int] = None, epoch: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    調理中の注文一覧。X-Order-Seq / X-Order-Seq-Epoch ヘッダーで現在のイベント seq とその系列を返す。
+    since_seq を指定すると、その seq 以降に変更された注文だけを返す
+    （アクティブでなくなった注文も含まれるので、クライアント側で除外する）。
+    epoch が今の系列と違えば（サーバーが起動し直して seq が振り直された）、全件を reset で返す。
+    """
+    current_epoch = event_bus.epoch
+    seq, changes = order_events.since(since_seq if since_seq is not None else order_events.last_seq)
+    if epoch is not None and epoch != current_epoch:
+        changes = None
+    headers = {"X-Order-Seq": str(seq), "X-Order-Seq-Epoch": current_epoch}
+    if since_seq is not None and changes is not None:
+        # 差分の注文はイベントに載せた時点でシリアライズ済み
+        return json_response({"seq": seq, "epoch": current_epoch, "reset": False, "orders": changes}, headers=headers)
 
-@router.get("/active", response_model=list[Order])
-def get_active_orders(db: Session = Depends(get_db)):
     active_statuses = ["pending", "preparing", "ready", "調理中", "提供可能"]
-    orders = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).filter(ModelOrder.status.in_(active_statuses)).order_by(ModelOrder.created_at).all()
-    for order in orders:
-        order.order_items = order.order_items or []
-    return orders
+    rows = db.query(*ORDER_COLUMNS).filter(
+        ModelOrder.status.in_(active_statuses)
+    ).order_by(ModelOrder.created_at).all()
+    body = join_array(order_bodies.encode(rows, db))
+    if since_seq is not None:
+        body = b'{"seq":%d,"epoch":%b,"reset":true,"orders":%b}' % (seq, dumps(current_epoch), body)
+    return RawJSONResponse(body, headers=headers)
+
+def find_order_by_payment_number(payment_number: str, db: Session) -> Optional[dict]:
+    # 番号は再利用されるので、同じ番号なら一番新しい注文を返す
+    row = db.query(*ORDER_COLUMNS).filter(
+        ModelOrder.payment_number == payment_number
+    ).order_by(ModelOrder.id.desc()).first()
+    if row is None:
+        return None
+    return build_order_dicts([row], db)[0]
 
 @router.get("/by_payment_number/{payment_number}", response_model=Order)
-def get_order_by_payment_number_api(payment_number: str, db: Session = Depends(get_db)):
-    order = get_order_by_payment_number(payment_number, db)
+async def get_order_by_payment_number_api(payment_number: str, db: Session = Depends(get_db)):
+    order = await run_db(find_order_by_payment_number, payment_number, db)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    # 15分以上経過していて未払いの場合
-    if order.status == 'unpaid':
-        created_at = order.created_at
-        if created_at.tzinfo is None:
-            created_at = created_at.replace(tzinfo=JST)
-        if datetime.now(JST) - created_at > timedelta(minutes=15):
-            order.status = 'cancelled'
-            db.commit()
-            db.refresh(order)
-            # WebSocketでの通知も検討
+    # 15分以上経過していて未払いの場合は、スケジューラーより先にここでキャンセルして通知する
+    if order["status"] == 'unpaid' and is_expired(datetime.fromisoformat(order["created_at"])):
+        for cancelled in await unpaid_expiry.sweep():
+            if cancelled["id"] == order["id"]:
+                order = cancelled
 
-    order.order_items = order.order_items or []
     return order
 
 @router.get("/{table_id}", response_model=list[Order])
 def get_orders_by_table(table_id: int, db: Session = Depends(get_db)):
-    orders = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).filter(ModelOrder.table_id == table_id).all()
-    for order in orders:
-        order.order_items = order.order_items or []
-    return orders
+    rows = db.query(*ORDER_COLUMNS).filter(ModelOrder.table_id == table_id).order_by(ModelOrder.id).all()
+    return RawJSONResponse(join_array(order_bodies.encode(rows, db)))
 
-@router.post("/", response_model=Order)
-async def create_order(order: OrderCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+def active_payment_numbers(codes: List[str], db: Session) -> Set[str]:
+    if not codes:
+        return set()
+    return {row[0] for row in db.query(ModelOrder.payment_number).filter(
+        ModelOrder.payment_number.in_(codes), ModelOrder.status.notin_(RELEASED_STATUSES)
+    ).all()}
+
+def write_orders(orders: List[OrderCreate], order_rows: List[dict], quantities: Dict[int, int], db: Session):
+    """在庫の引き当てと注文・注文アイテムの挿入を行う。コミットと失敗時のロールバックは呼び出し側で行う"""
+    stock = reserve_stock(quantities, db) if quantities else {}
+
+    # SQLite の RETURNING は行の順序を保証しないので、入力の順に並べ直させる
+    order_ids = [row[0] for row in db.execute(
+        insert(ModelOrder).returning(ModelOrder.id, sort_by_parameter_order=True),
+        order_rows,
+    ).all()]
+
+    item_rows = [
+        {"order_id": order_id, "menu_id": item.menu_id, "quantity": item.quantity}
+        for order_id, order in zip(order_ids, orders)
+        for item in order.order_items
+    ]
+    returned_items = []
+    if item_rows:
+        returned_items = db.execute(
+            insert(ModelOrderItem).returning(
+                ModelOrderItem.id, ModelOrderItem.order_id, ModelOrderItem.menu_id, ModelOrderItem.quantity,
+                sort_by_parameter_order=True,
+            ),
+            item_rows,
+        ).all()
+    return order_ids, returned_items, stock
+
+def insert_orders(orders: List[OrderCreate], db: Session,
+                  idempotency: Optional[List[Optional[Tuple[str, str]]]] = None) -> Tuple[List[dict], List[dict]]:
+    """
+    注文と注文アイテムをまとめて1つのトランザクションで挿入し、在庫を差し引く。
+    戻り値は (schemas.Order と同じ形の JSON 互換 dict, 在庫数が変わったメニュー)。
+    DB を再クエリせず、手元のデータとメニューキャッシュから組み立てる。
+    idempotency に注文ごとの (冪等キー, ハッシュ) を渡すと、応答を同じトランザクションで保存する。
+    """
     # テーブル存在確認 (オプション)
-    if order.table_id:
-        table = db.query(ModelTable).filter(ModelTable.id == order.table_id).first()
-        if not table:
+    table_ids = {order.table_id for order in orders if order.table_id}
+    if table_ids:
+        found_tables = {row[0] for row in db.query(ModelTable.id).filter(ModelTable.id.in_(table_ids)).all()}
+        if table_ids - found_tables:
             raise HTTPException(status_code=404, detail="Table not found")
-    
-    # 合計価格計算 (N+1問題対策)
-    menu_ids = [item.menu_id for item in order.order_items]
-    unique_menu_ids = set(menu_ids)
-    menus = db.query(ModelMenu).filter(ModelMenu.id.in_(unique_menu_ids)).all()
-    menu_map = {menu.id: menu for menu in menus}
-
-    found_ids = set(menu_map.keys())
-    missing_ids = list(unique_menu_ids - found_ids)
+
+    # 合計価格計算 (メニューキャッシュから引くので DB には問い合わせない)
+    snapshot = menu_catalog.get(db)
+    menu_map = snapshot.menus
+    unique_menu_ids = {item.menu_id for order in orders for item in order.order_items}
+    missing_ids = list(unique_menu_ids - menu_map.keys())
     if missing_ids:
         raise HTTPException(status_code=404, detail=f"Menu items not found: {missing_ids}")
 
-    total_price = sum(menu_map[item.menu_id].price * item.quantity for item in order.order_items)
-
-    payment_number = None
-    # モバイルオーダーの場合のみ支払い番号を生成
-    if order.status == "unpaid":
-        payment_number = ''.join(random.choices(string.ascii_uppercase + string.digits, k=3))
-
-    # 注文作成
-    db_order = ModelOrder(
-        table_id=order.table_id,
-        total_price=total_price,
-        payment_number=payment_number,
-        status=order.status  # フロントエンドからのステータスを使用
-    )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-
-    # 注文アイテム追加
-    for item in order.order_items:
-        db_item = ModelOrderItem(order_id=db_order.id, menu_id=item.menu_id, quantity=item.quantity)
-        db.add(db_item)
-    db.commit()
-    db.refresh(db_order)
-    
-    # unpaidの場合のみ、15分後にキャンセルするバックグラウンドタスクを追加
-    if db_order.status == "unpaid":
-        background_tasks.add_task(cancel_order_if_unpaid, db_order.id)
-
-    # メニュー情報を含む注文を再クエリ
-    full_order = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).filter(ModelOrder.id == db_order.id).first()
-
-    await notify_order_update(db_order.id, is_new=True)
-
-    return full_order
+    # SQLite にはタイムゾーンなしで保存されるので、読み出し時と同じ形に揃える
+    created_at = now_jst()
+    order_rows = []
+    for order in orders:
+        order_rows.append({
+            "table_id": order.table_id,
+            "total_price": sum(menu_map[item.menu_id]["price"] * item.quantity for item in order.order_items),
+            "payment_number": None,
+            "status": order.status,  # フロントエンドからのステータスを使用
+            "created_at": created_at,
+        })
+    # モバイルオーダーの場合のみ支払い番号を払い出す
+    mobile_rows = [row for row in order_rows if row["status"] == "unpaid"]
+    if mobile_rows:
+        payment_numbers.ensure_loaded(db)
 
-@router.patch("/{order_id}", response_model=Order)
-async def update_order_status(order_id: int, status_update: StatusUpdate, db: Session = Depends(get_db)):
-    order = db.query(ModelOrder).options(
-        joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
-    ).filter(ModelOrder.id == order_id).first()
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
+    quantities: Dict[int, int] = {}
+    for order in orders:
+        for item in order.order_items:
+            quantities[item.menu_id] = quantities.get(item.menu_id, 0) + item.quantity
 
-    original_status = order.status
-    new_status = status_update.status
+    for attempt in range(PAYMENT_NUMBER_ATTEMPTS):
+        try:
+            codes = payment_numbers.allocate(len(mobile_rows)) if mobile_rows else []
+        except PaymentNumbersExhausted:
+            raise HTTPException(status_code=503, detail="No payment numbers available")
+        for row, code in zip(mobile_rows, codes):
+            row["payment_number"] = code
+        try:
+            order_ids, returned_items, stock = write_orders(orders, order_rows, quantities, db)
+            created, changed_menus = build_created_orders(order_ids, order_rows, returned_items, stock, snapshot)
+            if idempotency:
+                idempotency_store.save(db, [
+                    (entry[0], entry[1], order) for entry, order in zip(idempotency, created) if entry is not None
+                ])
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            # 複数ワーカーで動かしている場合、他のワーカーが同じ番号を払い出していることがある。
+            # その番号は使用中のままにして、残りを返却してから払い出し直す
+            taken = active_payment_numbers(codes, db)
+            payment_numbers.release(set(codes) - taken)
+            if not taken or attempt == PAYMENT_NUMBER_ATTEMPTS - 1:
+                raise
+        except Exception:
+            db.rollback()
+            payment_numbers.release(codes)
+            raise
 
-    # Define allowed transitions
-    allowed_transitions = {
-        'unpaid': ['pending', 'cancelled'],
-        'pending': ['preparing', 'cancelled'],
-        'preparing': ['ready'],
-        'ready': ['completed'],
-        'completed': ['pending'] # Allow returning to pending
-    }
+    if changed_menus:
+        menu_catalog.update_stock(changed_menus, reserved=True)
+    return created, changed_menus
 
-    if original_status in allowed_transitions and new_status in allowed_transitions[original_status]:
-        order.status = new_status
-        db.commit()
-        db.refresh(order)
-        
-        # Notify clients
-        if original_status == 'unpaid' and new_status == 'pending':
-            await notify_new_order(order.id, new_status)
-        else:
-            await notify_order_update(order.id, new_status)
+def build_created_orders(order_ids: List[int], order_rows: List[dict], returned_items, stock,
+                         snapshot: CatalogSnapshot) -> Tuple[List[dict], List[dict]]:
+    """挿入した注文の応答と、在庫数が変わったメニューを手元のデータから組み立てる"""
+    changed_menus = stock_menus(stock, snapshot)
 
-        # Reload items for the response
-        order.order_items = order.order_items or []
-        return order
-    else:
-        # If the transition is not allowed, raise an exception
+    items_by_order = {order_id: [] for order_id in order_ids}
+    for item_id, order_id, menu_id, quantity in sorted(returned_items):
+        items_by_order[order_id].append({
+            "menu_id": menu_id,
+            "quantity": quantity,
+            "id": item_id,
+            "order_id": order_id,
+            "menu": snapshot.order_menus[menu_id],
+        })
+
+    created = [
+        order_dict(
+            (order_id, row["table_id"], row["total_price"], row["payment_number"], row["status"], row["created_at"], 1),
+            items_by_order[order_id],
+        )
+        for order_id, row in zip(order_ids, order_rows)
+    ]
+    return created, changed_menus
+
+def reused_key_error(key: str) -> HTTPException:
+    return HTTPException(status_code=422, detail=f"Idempotency key reused with a different request: {key}")
+
+def insert_orders_once(orders: List[OrderCreate], db: Session) -> Tuple[List[dict], List[dict], List[dict]]:
+    """
+    冪等キー付きの注文は、同じキーで登録済みなら注文を作らずに最初の応答を返す。
+    戻り値は (入力の順に並べた応答, 新しく作成した注文, 在庫数が変わったメニュー)。
+    同じキーで内容の違う注文は 422。
+    """
+    fingerprints = [request_fingerprint(order) if order.idempotency_key else None for order in orders]
+    if not any(fingerprints):
+        created, changed_menus = insert_orders(orders, db)
+        return created, created, changed_menus
+    for _ in range(IDEMPOTENCY_ATTEMPTS):
+        stored = idempotency_store.lookup(db, [order.idempotency_key for order in orders if order.idempotency_key])
+        db.rollback()  # 読み取りのトランザクションを閉じてから書き込む
+        responses: List[Optional[dict]] = [None] * len(orders)
+        # 新しく登録する注文の位置。同じバッチ内で同じキーが繰り返された場合は最初の1件だけを登録する
+        first_by_key: Dict[str, int] = {}
+        pending: List[int] = []
+        for i, order in enumerate(orders):
+            key = order.idempotency_key
+            if key is not None:
+                if key in stored:
+                    request_hash, response = stored[key]
+                    if request_hash != fingerprints[i]:
+                        raise reused_key_error(key)
+                    responses[i] = response
+                    continue
+                if key in first_by_key:
+                    if fingerprints[first_by_key[key]] != fingerprints[i]:
+                        raise reused_key_error(key)
+                    continue
+                first_by_key[key] = i
+            pending.append(i)
+        if not pending:
+            return responses, [], []
+        try:
+            created, changed_menus = insert_orders(
+                [orders[i] for i in pending], db,
+                [(orders[i].idempotency_key, fingerprints[i]) if orders[i].idempotency_key else None for i in pending],
+            )
+        except IdempotencyConflict:
+            # 確認してから書き込むまでの間に、同じキーの注文が他のリクエストで登録された。保存された応答を返す
+            continue
+        for i, order in zip(pending, created):
+            responses[i] = order
+        for i, order in enumerate(orders):
+            if responses[i] is None:
+                responses[i] = responses[first_by_key[order.idempotency_key]]
+        return responses, created, changed_menus
+    raise HTTPException(status_code=409, detail="Order with this idempotency key is being processed")
+
+async def publish_created_orders(created: List[dict], changed_menus: List[dict]):
+    await publish_stock_changes(changed_menus, reserved=True)
+    for order in created:
+        # unpaidの場合のみ、期限切れでキャンセルされるようスケジューラーに登録する
+        if order["status"] == "unpaid":
+            unpaid_expiry.schedule(order["id"], datetime.fromisoformat(order["created_at"]))
+        await notify_order_update(order["id"], is_new=True, order=order)
+
+@router.post("/", response_model=Order)
+async def create_order(
+    order: OrderCreate,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH),
+):
+    """
+    Idempotency-Key ヘッダー（または本文の idempotency_key）を付けると、
+    同じキーで再送されたリクエストには注文を作らずに最初の応答を返す
+    """
+    if idempotency_key:
+        order.idempotency_key = idempotency_key
+    responses, created, changed_menus = await run_db(insert_orders_once, [order], db)
+    await publish_created_orders(created, changed_menus)
+    return responses[0]
+
+@router.post("/batch", response_model=list[Order])
+async def create_orders_batch(orders: List[OrderCreate], db: Session = Depends(get_db)):
+    """
+    レジの注文を登録する。オフラインのレジに溜まった注文は1つのトランザクションでまとめて登録する。
+    流入制御ではレジのクラスに分類されるので、レジの画面は1件の注文もここに送る。
+    idempotency_key 付きの注文のうち登録済みのものは、作り直さずに最初の応答を返す
+    """
+    if not orders:
+        return []
+    responses, created, changed_menus = await run_db(insert_orders_once, orders, db)
+    await publish_created_orders(created, changed_menus)
+    return responses
+
+def load_transition_rows(order_ids: List[int], db: Session) -> Dict[int, Tuple[int, str, int, Optional[str]]]:
+    ids = list(set(order_ids))
+    rows = {}
+    for start in range(0, len(ids), SQLITE_CHUNK_SIZE):
+        for row in db.query(*TRANSITION_COLUMNS).filter(ModelOrder.id.in_(ids[start:start + SQLITE_CHUNK_SIZE])).all():
+            rows[row[0]] = tuple(row)
+    return rows
+
+def check_transition(current: Tuple[int, str, int, Optional[str]], transition: StatusUpdate):
+    order_id, status, version, _ = current
+    if transition.expected_status is not None and status != transition.expected_status:
+        raise HTTPException(status_code=409, detail=f"Order {order_id} is '{status}', not '{transition.expected_status}'")
+    if transition.expected_version is not None and version != transition.expected_version:
+        raise HTTPException(status_code=409, detail=f"Order {order_id} has been modified (version {version})")
+    if transition.status not in ALLOWED_TRANSITIONS.get(status, []):
         raise HTTPException(
             status_code=400,
-            detail=f"Transition from '{original_status}' to '{new_status}' is not allowed."
+            detail=f"Transition from '{status}' to '{transition.status}' is not allowed."
         )
 
+def compare_and_set_status(current: Tuple[int, str, int, Optional[str]], new_status: str, db: Session, claimed: List[str]):
+    """
+    読んだ時のステータスとバージョンのままなら書き換え、ORDER_COLUMNS の行を返す。
+    その間に他のリクエストが変更していれば 409（両方が成功したことにはならない）。
+    付け直した・取り戻した支払い番号は claimed に加える（ロールバックしたら返却する）
+    """
+    order_id, status, version, payment_number = current
+    values = {"status": new_status, "version": ModelOrder.version + 1}
+    code = None
+    if status in RELEASED_STATUSES and payment_number:
+        # 完了から戻した注文の番号が、すでに別の注文に払い出されていれば付け直す
+        payment_numbers.ensure_loaded(db)
+        if payment_numbers.reclaim(payment_number):
+            code = payment_number
+        else:
+            try:
+                code = values["payment_number"] = payment_numbers.allocate()[0]
+            except PaymentNumbersExhausted:
+                raise HTTPException(status_code=503, detail="No payment numbers available")
+    row = db.execute(
+        update(ModelOrder)
+        .where(ModelOrder.id == order_id, ModelOrder.status == status, ModelOrder.version == version)
+        .values(**values)
+        .returning(*ORDER_COLUMNS)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        if code is not None:
+            payment_numbers.release([code])
+        raise HTTPException(status_code=409, detail=f"Order {order_id} was modified by another request")
+    if code is not None:
+        claimed.append(code)
+    return row
+
+def record_rollup_changes(changes: List[Tuple[int, str, str]], db: Session):
+    """completed に入った・出た注文の売上集計を、アイテムとメニューをまとめて読み込んで更新する"""
+    changes = [change for change in changes if (change[1] == 'completed') != (change[2] == 'completed')]
+    if not changes:
+        return
+    ids = list({order_id for order_id, _, _ in changes})
+    orders = {}
+    for start in range(0, len(ids), SQLITE_CHUNK_SIZE):
+        for order in db.query(ModelOrder).options(
+            selectinload(ModelOrder.order_items).selectinload(ModelOrderItem.menu)
+        ).filter(ModelOrder.id.in_(ids[start:start + SQLITE_CHUNK_SIZE])).all():
+            orders[order.id] = order
+    record_status_changes(db, [(orders[order_id], original, new) for order_id, original, new in changes])
+
+def restock_transitions(changes: List[Tuple[int, str, str]], db: Session) -> StockLevels:
+    """キャンセルに入った注文の在庫を戻し、キャンセルから戻した注文の在庫を引き当て直す"""
+    cancelled = [order_id for order_id, original, new in changes if new == 'cancelled' and original != 'cancelled']
+    reopened = [order_id for order_id, original, new in changes if original == 'cancelled' and new != 'cancelled']
+    stock: StockLevels = {}
+    if cancelled:
+        quantities = order_quantities(cancelled, db)
+        if quantities:
+            stock.update(release_stock(quantities, db))
+    if reopened:
+        quantities = order_quantities(reopened, db)
+        if quantities:
+            stock.update(reserve_stock(quantities, db))
+    return stock
+
+def apply_transitions(transitions: List[OrderTransition], db: Session,
+                      atomic: bool = True) -> Tuple[List[Tuple[str, dict]], List[dict], List[dict]]:
+    """
+    ステータスの遷移を1つのトランザクションで行い、
+    ([(元のステータス, シリアライズ済みの注文)], [失敗], 在庫数が変わったメニュー) を返す。
+    キャンセルした注文の在庫は同じトランザクションで戻す。
+    各注文は条件付きの UPDATE で書き換え、注文・アイテムの読み込みは遷移の確認とレスポンスの組み立てに必要な分だけにする。
+    atomic なら1件でも遷移できなければ全体を取り消して HTTPException を送出する。
+    """
+    current = load_transition_rows([transition.order_id for transition in transitions], db)
+    claimed: List[str] = []
+    applied: List[Tuple[str, tuple]] = []
+    failures: List[dict] = []
+    try:
+        for transition in transitions:
+            row = current.get(transition.order_id)
+            try:
+                if row is None:
+                    raise HTTPException(status_code=404, detail="Order not found")
+                check_transition(row, transition)
+                updated = compare_and_set_status(row, transition.status, db, claimed)
+            except HTTPException as e:
+                if atomic:
+                    raise
+                failures.append({"order_id": transition.order_id, "status_code": e.status_code, "detail": e.detail})
+                continue
+            applied.append((row[1], updated))
+            # 同じ注文の遷移が続けて指定された場合に備えて、書き換えた後の値にする
+            current[transition.order_id] = (updated[0], updated[4], updated[6], updated[3])
+        changes = [(updated[0], original, updated[4]) for original, updated in applied]
+        record_rollup_changes(changes, db)
+        stock = restock_transitions(changes, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        payment_numbers.release(claimed)
+        raise
+    changed_menus = apply_released_stock(stock, db)
+    orders = build_order_dicts([updated for _, updated in applied], db) if applied else []
+    return [(original, order) for (original, _), order in zip(applied, orders)], failures, changed_menus
+
+def expand_transitions(request: OrderTransitionsRequest, db: Session) -> List[OrderTransition]:
+    """from_status の指定を、その状態の注文ごとの遷移に展開する"""
+    transitions = list(request.transitions)
+    if request.from_status is not None:
+        ids = [row[0] for row in db.query(ModelOrder.id).filter(
+            ModelOrder.status == request.from_status
+        ).order_by(ModelOrder.id).all()]
+        transitions += [
+            OrderTransition(order_id=order_id, status=request.status, expected_status=request.from_status)
+            for order_id in ids
+        ]
+    return transitions
+
+def apply_transitions_request(request: OrderTransitionsRequest,
+                              db: Session) -> Tuple[List[Tuple[str, dict]], List[dict], List[dict]]:
+    return apply_transitions(expand_transitions(request, db), db, request.atomic)
+
+async def notify_transitions(applied: List[Tuple[str, dict]], changed_menus: List[dict]):
+    """遷移した注文を1つの通知で送る。未払いから支払い済みになった注文は、調理画面にとっては新しい注文"""
+    await publish_stock_changes(changed_menus)
+    if not applied:
+        return
+    new_order_ids = [order["id"] for original, order in applied if original == 'unpaid' and order["status"] == 'pending']
+    await notify_orders_update([order for _, order in applied], new_order_ids=new_order_ids)
+
+@router.patch("/{order_id}", response_model=Order)
+async def update_order_status(order_id: int, status_update: StatusUpdate, db: Session = Depends(get_db)):
+    """
+    expected_status / expected_version を指定すると、その間に他の端末が変更していた場合は 409 になる。
+    指定しなくても、確認してから書き換えるまでの間に変更されていれば 409（同時に押しても片方だけが成功する）
+    """
+    transition = OrderTransition(order_id=order_id, **status_update.model_dump())
+    applied, _, changed_menus = await run_db(apply_transitions, [transition], db)
+    await notify_transitions(applied, changed_menus)
+    return applied[0][1]
+
+@router.post("/transitions", response_model=OrderTransitionsResult)
+async def transition_orders(request: OrderTransitionsRequest, db: Session = Depends(get_db)):
+    """
+    複数の注文のステータスを1つのトランザクションで遷移させ、1つの通知で送る。
+    例: 閉店時に {"from_status": "ready", "status": "completed"} で提供可能な注文をすべて完了にする。
+    atomic (既定) なら1件でも遷移できなければ何も変更せずにそのエラーを返す
+    """
+    if request.from_status is not None and request.status is None:
+        raise HTTPException(status_code=422, detail="status is required with from_status")
+    applied, failures, changed_menus = await run_db(apply_transitions_request, request, db)
+    await notify_transitions(applied, changed_menus)
+    return {"orders": [order for _, order in applied], "failed": failures}
+
 @router.get("/sales/by-time", response_model=List[SalesByTime])
-async def get_sales_by_time(
+def get_sales_by_time(
     start: str,
     end: str,
-    db: Session = Depends(get_db)
+    granularity: str = Query("hour", pattern="^(hour|day|menu)$"),
+    db: Session = Depends(get_read_db)
 ):
+    """
+    完了注文の売上を sales_rollup から集計する。
+      hour: 日付 × 時間帯ごと（複数日を指定しても日付ごとに分かれる）
+      day:  日付ごと
+      menu: 期間全体の商品ごと
+    """
     start_date = datetime.fromisoformat(start).date()
     end_date = datetime.fromisoformat(end).date()
-    
-    # 日本時間で開始日時と終了日時を設定（UTC+9）
-    start_datetime = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=JST)
-    end_datetime = datetime.combine(end_date, datetime.max.time()).replace(tzinfo=JST)
-    
-    # 完了した注文のみ集計
-    sales_data = db.query(
-        extract('hour', ModelOrder.created_at).label('hour'),
-        func.sum(ModelOrder.total_price).label('total')
-    ).filter(
-        ModelOrder.status == 'completed',
-        ModelOrder.created_at >= start_datetime,
-        ModelOrder.created_at <= end_datetime
-    ).group_by(
-        extract('hour', ModelOrder.created_at)
-    ).order_by('hour').all()
-    
+    in_range = (SalesRollup.date >= start_date, SalesRollup.date <= end_date)
+    revenue = func.sum(SalesRollup.revenue)
+    quantity = func.sum(SalesRollup.quantity)
+
     result = []
-    for hour, total in sales_data:
-        time_slot = f"{int(hour):02d}:00 - {int(hour+1):02d}:00"
-        result.append(SalesByTime(time_slot=time_slot, total=float(total or 0)))
+    if granularity == "hour":
+        rows = db.query(SalesRollup.date, SalesRollup.hour, revenue, quantity).filter(*in_range).group_by(
+            SalesRollup.date, SalesRollup.hour
+        ).order_by(SalesRollup.date, SalesRollup.hour).all()
+        for day, hour, total, count in rows:
+            if not count:
+                continue
+            result.append(SalesByTime(
+                time_slot=f"{hour:02d}:00 - {hour + 1:02d}:00", total=float(total or 0),
+                date=day.isoformat(), hour=hour, quantity=int(count or 0),
+            ))
+    elif granularity == "day":
+        rows = db.query(SalesRollup.date, revenue, quantity).filter(*in_range).group_by(
+            SalesRollup.date
+        ).order_by(SalesRollup.date).all()
+        for day, total, count in rows:
+            if not count:
+                continue
+            result.append(SalesByTime(
+                time_slot=day.isoformat(), total=float(total or 0),
+                date=day.isoformat(), quantity=int(count or 0),
+            ))
+    else:
+        rows = db.query(SalesRollup.menu_id, ModelMenu.name, revenue, quantity).outerjoin(
+            ModelMenu, ModelMenu.id == SalesRollup.menu_id
+        ).filter(*in_range).group_by(SalesRollup.menu_id, ModelMenu.name).order_by(revenue.desc()).all()
+        for menu_id, name, total, count in rows:
+            if not count:
+                continue
+            result.append(SalesByTime(
+                time_slot=name or str(menu_id), total=float(total or 0),
+                menu_id=menu_id, menu_name=name, quantity=int(count or 0),
+            ))
     return result
 
 @router.get("/sales/realtime", response_model=RealtimeSales)
-async def get_realtime_sales(db: Session = Depends(get_db)):
-    now_jst = datetime.now(JST)
-    
-    # JSTでの今日の開始時刻（00:00）
-    today_start_jst = now_jst.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # JSTでの明日の開始時刻（00:00）
-    tomorrow_start_jst = today_start_jst + timedelta(days=1)
-
-    # 過去1時間と過去30分の基準時刻 (JST)
-    one_hour_ago_jst = now_jst - timedelta(hours=1)
-    thirty_minutes_ago_jst = now_jst - timedelta(minutes=30)
-    
-    # 今日の総売上 (完了注文)
-    daily_total = db.query(func.sum(ModelOrder.total_price)).filter(
-        ModelOrder.status == 'completed',
-        ModelOrder.created_at >= today_start_jst,
-        ModelOrder.created_at < tomorrow_start_jst
-    ).scalar() or 0.0
-    
-    # 過去1時間の売上
-    past_hour_total = db.query(func.sum(ModelOrder.total_price)).filter(
-        ModelOrder.status == 'completed',
-        ModelOrder.created_at >= one_hour_ago_jst,
-        ModelOrder.created_at <= now_jst
-    ).scalar() or 0.0
-    
-    # 過去30分の売上
-    past_30min_total = db.query(func.sum(ModelOrder.total_price)).filter(
-        ModelOrder.status == 'completed',
-        ModelOrder.created_at >= thirty_minutes_ago_jst,
-        ModelOrder.created_at <= now_jst
-    ).scalar() or 0.0
-    
-    # 今日の商品ごとの売上
-    menu_sales_data = db.query(
-        ModelOrderItem.menu_id,
-        ModelMenu.name.label('menu_name'),
-        func.sum(ModelOrderItem.quantity).label('quantity_sold'),
-        func.sum(ModelOrderItem.quantity * ModelMenu.price).label('total_sales')
-    ).join(ModelMenu, ModelOrderItem.menu_id == ModelMenu.id
-    ).join(ModelOrder, ModelOrderItem.order_id == ModelOrder.id
-    ).filter(
-        ModelOrder.status == 'completed',
-        ModelOrder.created_at >= today_start_jst,
-        ModelOrder.created_at < tomorrow_start_jst
-    ).group_by(
-        ModelOrderItem.menu_id, ModelMenu.name, ModelMenu.price
-    ).order_by(func.sum(ModelOrderItem.quantity * ModelMenu.price).desc()).all()
-    
-    menu_sales = []
-    for item in menu_sales_data:
-        menu_sales.append(MenuSales(
-            menu_id=item.menu_id,
-            menu_name=item.menu_name,
-            quantity_sold=int(item.quantity_sold or 0),
-            total_sales=float(item.total_sales or 0.0)
-        ))
-    
-    return RealtimeSales(
-        daily_total=daily_total,
-        past_hour_total=past_hour_total,
-        past_30min_total=past_30min_total,
-        menu_sales=menu_sales
-    )
\ No newline at end of file
+def get_realtime_sales(db: Session = Depends(get_read_db)):
+    """完了注文の売上。メモリ上の集計から返す（必要な場合だけ DB から作り直す）"""
+    return RealtimeSales(**sales_accumulator.snapshot(db))
@@ -0,0 +1,172 @@
+import threading
+from datetime import datetime, timedelta, date
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session, joinedload
+from .database import now_jst
+from .models import JST, Order as ModelOrder, OrderItem as ModelOrderItem
+
+WINDOW_MINUTES = 60
+EPOCH = datetime(1970, 1, 1)
+
+
+def minute_index(value: datetime) -> int:
+    """タイムゾーンなしの日本時間を、分単位の通し番号にする"""
+    return int((value.replace(tzinfo=None) - EPOCH).total_seconds() // 60)
+
+
+class SalesAccumulator:
+    """
+    完了した注文の売上をメモリ上で集計し、/sales/realtime に O(1) で答える。
+    - 過去1時間・30分: 注文の作成時刻ごとの1分単位のリングバッファ
+    - 今日の合計と商品ごとの売上: 今日作成された完了注文の累計
+    注文が completed に入る・出るたびに更新し、起動時・日付が変わった時・
+    メニュー変更時（価格が変わるため）は DB から作り直す。
+    集計対象は既存のクエリと同じく「注文の作成時刻」で判定する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valid = False
+        self._day: Optional[date] = None
+        # order_id -> (作成時刻の分, 今日の注文か, 合計金額, [(menu_id, 数量)])
+        self._orders: Dict[int, Tuple[int, bool, float, List[Tuple[int, int]]]] = {}
+        self._buckets: List[List[float]] = [[-1, 0.0] for _ in range(WINDOW_MINUTES)]
+        self._daily_total = 0.0
+        self._menu_quantities: Dict[int, int] = {}
+        self._menus: Dict[int, Tuple[str, float]] = {}
+        # 作り直し中に届いた注文イベント（作り直し後にもう一度反映する）
+        self._pending: Optional[List[Dict[str, Any]]] = None
+
+    def invalidate(self):
+        with self._lock:
+            self._valid = False
+
+    def rebuild(self, db: Session):
+        now = now_jst()
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        since = min(today_start, now - timedelta(minutes=WINDOW_MINUTES))
+        with self._lock:
+            self._pending = []
+        orders = db.query(ModelOrder).options(
+            joinedload(ModelOrder.order_items).joinedload(ModelOrderItem.menu)
+        ).filter(
+            ModelOrder.status == 'completed',
+            ModelOrder.created_at >= since,
+        ).all()
+        with self._lock:
+            self._reset(now.date())
+            for order in orders:
+                items = []
+                for item in order.order_items:
+                    if item.menu is not None:
+                        self._menus[item.menu_id] = (item.menu.name, item.menu.price)
+                        items.append((item.menu_id, item.quantity))
+                self._add(order.id, order.created_at, order.total_price or 0.0, items)
+            self._valid = True
+            pending, self._pending = self._pending or [], None
+        # 反映は冪等なので、クエリ結果に含まれていた注文が重複しても問題ない
+        for order in pending:
+            self.apply_order(order)
+
+    def _reset(self, day: date):
+        self._day = day
+        self._orders.clear()
+        self._buckets = [[-1, 0.0] for _ in range(WINDOW_MINUTES)]
+        self._daily_total = 0.0
+        self._menu_quantities.clear()
+
+    def _add(self, order_id: int, created_at: datetime, total: float, items: List[Tuple[int, int]]):
+        minute = minute_index(created_at)
+        is_today = created_at.date() == self._day
+        self._orders[order_id] = (minute, is_today, total, items)
+        bucket = self._buckets[minute % WINDOW_MINUTES]
+        if bucket[0] < minute:
+            bucket[0], bucket[1] = minute, 0.0
+        if bucket[0] == minute:
+            bucket[1] += total
+        if is_today:
+            self._daily_total += total
+            for menu_id, quantity in items:
+                self._menu_quantities[menu_id] = self._menu_quantities.get(menu_id, 0) + quantity
+
+    def _remove(self, order_id: int):
+        minute, is_today, total, items = self._orders.pop(order_id)
+        bucket = self._buckets[minute % WINDOW_MINUTES]
+        if bucket[0] == minute:
+            bucket[1] -= total
+        if is_today:
+            self._daily_total -= total
+            for menu_id, quantity in items:
+                self._menu_quantities[menu_id] -= quantity
+                if self._menu_quantities[menu_id] <= 0:
+                    del self._menu_quantities[menu_id]
+
+    def apply_order(self, order: Dict[str, Any]) -> bool:
+        """
+        注文イベント（schemas.Order と同じ形の dict）を反映する。
+        直前のステータスは不要で、completed に入った・出たかは保持している注文から判断する。
+        集計が変わった場合は True を返す。
+        """
+        with self._lock:
+            if not self._valid:
+                if self._pending is not None:
+                    self._pending.append(order)
+                return False
+            tracked = order["id"] in self._orders
+            completed = order.get("status") == 'completed'
+            if completed == tracked:
+                return False
+            if tracked:
+                self._remove(order["id"])
+                return True
+            created_at = datetime.fromisoformat(order["created_at"])
+            if created_at.tzinfo is not None:
+                created_at = created_at.astimezone(JST).replace(tzinfo=None)
+            now = now_jst()
+            if created_at.date() != self._day and minute_index(created_at) <= minute_index(now) - WINDOW_MINUTES:
+                return False
+            items = []
+            for item in order.get("order_items") or []:
+                menu = item.get("menu")
+                if menu is not None:
+                    self._menus.setdefault(item["menu_id"], (menu["name"], menu["price"]))
+                    items.append((item["menu_id"], item["quantity"]))
+            self._add(order["id"], created_at, order.get("total_price") or 0.0, items)
+            return True
+
+    def _window_total(self, now_minute: int, minutes: int) -> float:
+        return sum(total for minute, total in self._buckets if now_minute - minutes < minute <= now_minute)
+
+    def snapshot(self, db: Optional[Session] = None) -> Optional[Dict[str, Any]]:
+        """
+        RealtimeSales と同じ形の dict。作り直しが必要で db が渡されていなければ None。
+        過去1時間・30分は1分単位で丸めた値になる。
+        """
+        now = now_jst()
+        with self._lock:
+            needs_rebuild = not self._valid or self._day != now.date()
+        if needs_rebuild:
+            if db is None:
+                return None
+            self.rebuild(db)
+
+        now_minute = minute_index(now)
+        with self._lock:
+            menu_sales = []
+            for menu_id, quantity in self._menu_quantities.items():
+                name, price = self._menus.get(menu_id, ("", 0.0))
+                menu_sales.append({
+                    "menu_id": menu_id,
+                    "menu_name": name,
+                    "quantity_sold": quantity,
+                    "total_sales": float(quantity * price),
+                })
+            menu_sales.sort(key=lambda item: item["total_sales"], reverse=True)
+            return {
+                "daily_total": self._daily_total,
+                "past_hour_total": self._window_total(now_minute, 60),
+                "past_30min_total": self._window_total(now_minute, 30),
+                "menu_sales": menu_sales,
+            }
+
+sales_accumulator = SalesAccumulator()
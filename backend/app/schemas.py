@@ -1,10 +1,11 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from typing import List, Optional
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 JST = ZoneInfo("Asia/Tokyo")
+IDEMPOTENCY_KEY_MAX_LENGTH = 200
 
 class TableBase(BaseModel):
     name: str
@@ -25,6 +26,7 @@ class MenuBase(BaseModel):
     category: Optional[str] = "general"
     image_url: Optional[str] = None
     is_out_of_stock: bool = False
+    stock_quantity: Optional[int] = None
 
 class MenuCreate(MenuBase):
     pass
@@ -40,29 +42,50 @@ class MenuUpdate(BaseModel):
     price: Optional[float] = None
     category: Optional[str] = None
     is_out_of_stock: Optional[bool] = None
+    stock_quantity: Optional[int] = None
+
+class MenuBulkUpdate(MenuUpdate):
+    id: int
+
+class StockUpdate(BaseModel):
+    is_out_of_stock: bool
 
 class OrderItemBase(BaseModel):
     menu_id: int
-    quantity: int = 1
+    # 0 以下を通すと在庫の引き当てで在庫が増え、合計金額も負になる
+    quantity: int = Field(1, gt=0)
 
 class OrderItemCreate(OrderItemBase):
     pass
 
+class OrderItemMenu(BaseModel):
+    """注文に埋め込むメニュー。注文のたびに変わる在庫の項目は含めない（在庫は /api/menus/ で取得する）"""
+    name: str
+    price: float
+    category: Optional[str] = "general"
+    image_url: Optional[str] = None
+    id: int
+
+    class Config:
+        from_attributes = True
+
 class OrderItem(OrderItemBase):
     id: int
     order_id: int
-    menu: Optional['Menu'] = None
+    menu: Optional['OrderItemMenu'] = None
 
     class Config:
         from_attributes = True
 
 class OrderBase(BaseModel):
     table_id: Optional[int] = None
-    order_items: List[OrderItemCreate]
+    order_items: List[OrderItemCreate] = Field(min_length=1)
     total_price: Optional[float] = 0.0
 
 class OrderCreate(OrderBase):
     status: Optional[str] = "unpaid"
+    # 再送しても二重に登録されないよう、クライアントが注文ごとに付けるキー
+    idempotency_key: Optional[str] = Field(None, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)
 
 class Order(OrderBase):
     id: int
@@ -70,17 +93,58 @@ class Order(OrderBase):
     status: str = "pending"
     created_at: datetime
     order_items: List[OrderItem] = []
+    # ステータスが変わるたびに増える。StatusUpdate.expected_version に渡すと、その間に変更されていれば 409
+    version: int = 1
 
     class Config:
         from_attributes = True
 
+class ActiveOrdersDelta(BaseModel):
+    """GET /active?since_seq=N の応答。reset が True なら orders は全件"""
+    seq: int
+    # seq の系列。サーバーが起動し直して seq が振り直されると変わる
+    epoch: Optional[str] = None
+    reset: bool = False
+    orders: List[Order] = []
+
 
 class StatusUpdate(BaseModel):
     status: str
+    # 指定すると、注文がこの状態・バージョンのままの場合だけ遷移させる（変わっていれば 409）
+    expected_status: Optional[str] = None
+    expected_version: Optional[int] = None
+
+class OrderTransition(StatusUpdate):
+    order_id: int
+
+class OrderTransitionsRequest(BaseModel):
+    """
+    POST /api/orders/transitions の本文。transitions を並べるか、
+    from_status と status で「from_status の注文すべて」を指定する（両方指定すれば両方行う）
+    """
+    transitions: List[OrderTransition] = []
+    from_status: Optional[str] = None
+    status: Optional[str] = None
+    # True なら1件でも遷移できなければ全体を取り消す。False なら遷移できたものだけを反映し、残りを failed で返す
+    atomic: bool = True
+
+class TransitionFailure(BaseModel):
+    order_id: int
+    status_code: int
+    detail: str
+
+class OrderTransitionsResult(BaseModel):
+    orders: List[Order] = []
+    failed: List[TransitionFailure] = []
 
 class SalesByTime(BaseModel):
     time_slot: str
     total: float
+    date: Optional[str] = None
+    hour: Optional[int] = None
+    menu_id: Optional[int] = None
+    menu_name: Optional[str] = None
+    quantity: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -103,4 +167,9 @@ class RealtimeSales(BaseModel):
     class Config:
         from_attributes = True
 
+class ProfilerSettings(BaseModel):
+    """PUT /profiler の本文。slow_request_ms が 0 ならプロファイラを止める"""
+    slow_request_ms: float = Field(ge=0)
+    interval_ms: Optional[float] = Field(None, gt=0)
+
 OrderItem.model_rebuild()  # 循環参照のため
\ No newline at end of file
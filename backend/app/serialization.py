@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+from fastapi.responses import Response
+from sqlalchemy.orm import Session
+from .database import SQLITE_CHUNK_SIZE
+from .models import Order as ModelOrder, OrderItem as ModelOrderItem
+from .menu_cache import menu_catalog
+
+try:
+    import orjson
+except ImportError:  # orjson が無ければ標準の json で同じ形に出力する
+    orjson = None
+
+# 注文一覧の高速なシリアライズ。
+# Pydantic のモデルを注文・アイテム・メニューごとに組み立てる代わりに、
+# 必要な列だけを取り出したクエリから schemas.Order と同じ形の dict を直接作り、
+# 注文ごとのエンコード済み JSON を (注文 id, バージョン) をキーにキャッシュする。
+
+ORDER_BODY_CACHE_SIZE = int(os.environ.get("ORDER_BODY_CACHE_SIZE", "5000"))
+
+ORDER_COLUMNS = (
+    ModelOrder.id, ModelOrder.table_id, ModelOrder.total_price,
+    ModelOrder.payment_number, ModelOrder.status, ModelOrder.created_at, ModelOrder.version,
+)
+OrderRow = Sequence[Any]
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class RawJSONResponse(Response):
+    """エンコード済みの JSON (bytes) をそのまま返す"""
+    media_type = "application/json"
+
+
+def json_response(data: Any, headers: Optional[Dict[str, str]] = None) -> RawJSONResponse:
+    return RawJSONResponse(dumps(data), headers=headers)
+
+
+def join_array(bodies: Iterable[bytes]) -> bytes:
+    return b"[" + b",".join(bodies) + b"]"
+
+
+def order_version(row: OrderRow, generation: int) -> Hashable:
+    """
+    注文の JSON が変わりうる値。アイテム・金額・作成日時は作成後に変わらないので、
+    注文の version（ステータス・支払い番号を書き換えるたびに増える）と、埋め込むメニューの世代だけを見る。
+    埋め込むメニューには在庫の項目を含めないので、注文による在庫の変化では世代は変わらない。
+    DB を直接書き換えられた場合に備えて、ステータスと支払い番号も含める
+    """
+    return (row[6], row[4], row[3], generation)
+
+
+def order_dict(row: OrderRow, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    order_id, table_id, total_price, payment_number, status, created_at, version = row
+    return {
+        "table_id": table_id,
+        "order_items": items,
+        "total_price": float(total_price) if total_price is not None else None,
+        "id": order_id,
+        "payment_number": payment_number,
+        "status": status,
+        "created_at": created_at.isoformat() if isinstance(created_at, datetime) else created_at,
+        "version": version,
+    }
+
+
+def load_items(order_ids: Sequence[int], db: Session) -> Dict[int, List[Tuple[int, int, int]]]:
+    """注文 id -> [(アイテム id, メニュー id, 数量), ...]"""
+    items: Dict[int, List[Tuple[int, int, int]]] = {order_id: [] for order_id in order_ids}
+    for start in range(0, len(order_ids), SQLITE_CHUNK_SIZE):
+        chunk = order_ids[start:start + SQLITE_CHUNK_SIZE]
+        rows = db.query(
+            ModelOrderItem.id, ModelOrderItem.order_id, ModelOrderItem.menu_id, ModelOrderItem.quantity
+        ).filter(ModelOrderItem.order_id.in_(chunk)).order_by(ModelOrderItem.id).all()
+        for item_id, order_id, menu_id, quantity in rows:
+            items[order_id].append((item_id, menu_id, quantity))
+    return items
+
+
+def build_order_dicts(rows: Sequence[OrderRow], db: Session, menus: Optional[Dict[int, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    ORDER_COLUMNS の行から schemas.Order と同じ形の dict を作る。
+    アイテムは1回のクエリでまとめて読み、メニューはメニューキャッシュから埋め込む（共有の dict なので書き換えないこと）
+    """
+    if menus is None:
+        menus = menu_catalog.get(db).order_menus
+    items = load_items([row[0] for row in rows], db)
+    return [
+        order_dict(row, [
+            {"menu_id": menu_id, "quantity": quantity, "id": item_id, "order_id": row[0], "menu": menus.get(menu_id)}
+            for item_id, menu_id, quantity in items[row[0]]
+        ])
+        for row in rows
+    ]
+
+
+class OrderBodyCache:
+    """
+    注文ごとのエンコード済み JSON を (注文 id, バージョン) で保持する LRU。
+    バージョンが変われば別のキーになるので、古い内容が返ることはなく、明示的な破棄も要らない。
+    """
+
+    def __init__(self, max_size: int = ORDER_BODY_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._bodies: "OrderedDict[int, Tuple[Hashable, bytes]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._bodies)
+
+    def get(self, order_id: int, version: Hashable) -> Optional[bytes]:
+        with self._lock:
+            entry = self._bodies.get(order_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._bodies.move_to_end(order_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, order_id: int, version: Hashable, body: bytes):
+        with self._lock:
+            self._bodies[order_id] = (version, body)
+            self._bodies.move_to_end(order_id)
+            while len(self._bodies) > self.max_size:
+                self._bodies.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+
+    def encode(self, rows: Sequence[OrderRow], db: Session) -> List[bytes]:
+        """ORDER_COLUMNS の行をそれぞれ JSON にする。キャッシュに無い注文のアイテムだけを DB から読む"""
+        snapshot = menu_catalog.get(db)
+        bodies: List[Optional[bytes]] = []
+        missing: List[int] = []
+        for i, row in enumerate(rows):
+            body = self.get(row[0], order_version(row, snapshot.generation))
+            bodies.append(body)
+            if body is None:
+                missing.append(i)
+        if missing:
+            built = build_order_dicts([rows[i] for i in missing], db, snapshot.order_menus)
+            for i, data in zip(missing, built):
+                body = bodies[i] = dumps(data)
+                self.put(rows[i][0], order_version(rows[i], snapshot.generation), body)
+        return bodies
+
+order_bodies = OrderBodyCache()
@@ -0,0 +1,192 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response
+
+try:
+    import brotli
+except ImportError:  # brotli が無ければ gzip だけを用意する
+    brotli = None
+
+# フロントエンドの静的ファイルを起動時にすべて読み込み、圧縮・フィンガープリントを済ませてメモリから返す。
+#   - js / css などは内容のハッシュを含む名前 (script.1a2b3c4d.js) でも配信し、
+#     HTML 内の参照をその名前に書き換える。ハッシュ付きの名前は内容が変わらないので immutable でキャッシュさせる
+#   - HTML とハッシュなしの名前は毎回 ETag で確認させる (変わっていなければ 304)
+#   - gzip (brotli がインストールされていれば br も) を事前に作っておき、Accept-Encoding で選ぶ
+# STATIC_ASSETS_RELOAD=1 にすると、リクエストのたびに更新日時を確認して変わったファイルを読み直す（開発用）
+STATIC_ASSETS_RELOAD = os.environ.get("STATIC_ASSETS_RELOAD", "0") == "1"
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# これより小さいファイルは圧縮しない
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+FINGERPRINT_EXTENSIONS = (".js", ".css", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico", ".woff", ".woff2")
+
+# HTML 内の src="..." / href="..." のうち、外部 URL ではないもの
+ASSET_REFERENCE_RE = re.compile(r'(\s(?:src|href)=")([^":?#]+)(")')
+
+
+class Asset:
+    """1つのファイルの内容と、事前に圧縮したもの"""
+
+    def __init__(self, path: str, body: bytes, mtime: float):
+        self.path = path
+        self.mtime = mtime
+        self.body = body
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/javascript", "image/svg+xml"):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = f'"{self.hash}"'
+        # エンコーディング -> 圧縮した内容（元より小さくなったものだけ）
+        self.encodings: Dict[str, bytes] = {}
+        if len(body) >= MIN_COMPRESS_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            if brotli is not None:
+                self._add_encoding("br", brotli.compress(body, quality=11))
+            self._add_encoding("gzip", gzip.compress(body, compresslevel=9, mtime=0))
+
+    def _add_encoding(self, encoding: str, compressed: bytes):
+        if len(compressed) < len(self.body):
+            self.encodings[encoding] = compressed
+
+    @property
+    def fingerprinted_path(self) -> Optional[str]:
+        root, ext = os.path.splitext(self.path)
+        if ext.lower() not in FINGERPRINT_EXTENSIONS:
+            return None
+        return f"{root}.{self.hash[:8]}{ext}"
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """Accept-Encoding のうち q=0 でないもの"""
+    accepted = []
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.append(name.strip().lower())
+    return accepted
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == etag or tag == "W/" + etag for tag in candidates)
+
+
+class StaticAssets:
+    """
+    StaticFiles(html=True) の代わりに mount する ASGI アプリ。
+    ディレクトリへのリクエストには index.html を、見つからない場合は 404.html があればそれを返す。
+    """
+
+    def __init__(self, directory: str, reload: bool = STATIC_ASSETS_RELOAD):
+        self.directory = directory
+        self.reload = reload
+        # URL のパス -> (ファイル, ハッシュ付きの名前か)
+        self._routes: Dict[str, Tuple[Asset, bool]] = {}
+        self.load()
+
+    def load(self):
+        """ディレクトリを読み込み、圧縮とフィンガープリントを行う"""
+        assets: Dict[str, Asset] = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    assets[path] = Asset(path, f.read(), os.path.getmtime(full_path))
+
+        fingerprints = {path: asset.fingerprinted_path for path, asset in assets.items() if asset.fingerprinted_path}
+        routes: Dict[str, Tuple[Asset, bool]] = {}
+        for path, asset in assets.items():
+            if path.endswith(".html"):
+                # HTML から参照しているファイルをハッシュ付きの名前に書き換える
+                asset = Asset(path, self._rewrite_html(asset.body, path, fingerprints), asset.mtime)
+            routes[path] = (asset, False)
+            if path in fingerprints:
+                routes[fingerprints[path]] = (asset, True)
+        self._routes = routes
+
+    @staticmethod
+    def _rewrite_html(body: bytes, path: str, fingerprints: Dict[str, str]) -> bytes:
+        base = os.path.dirname(path)
+
+        def replace(match: re.Match) -> str:
+            reference = match.group(2)
+            target = os.path.normpath(os.path.join(base, reference)).replace(os.sep, "/")
+            fingerprinted = fingerprints.get(target)
+            if fingerprinted is None:
+                return match.group(0)
+            replaced = os.path.relpath(fingerprinted, base or ".").replace(os.sep, "/")
+            return match.group(1) + replaced + match.group(3)
+
+        return ASSET_REFERENCE_RE.sub(replace, body.decode("utf-8")).encode("utf-8")
+
+    def _changed(self) -> bool:
+        for asset, _ in self._routes.values():
+            full_path = os.path.join(self.directory, asset.path)
+            if not os.path.exists(full_path) or os.path.getmtime(full_path) != asset.mtime:
+                return True
+        return False
+
+    def lookup(self, path: str) -> Optional[Tuple[Asset, bool]]:
+        if self.reload and self._changed():
+            self.load()
+        path = path.lstrip("/")
+        if path == "" or path.endswith("/"):
+            path += "index.html"
+        return self._routes.get(path)
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+            await response(scope, receive, send)
+            return
+
+        found = self.lookup(scope["path"])
+        status_code = 200
+        if found is None:
+            found = self._routes.get("404.html")
+            if found is None:
+                await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+                return
+            status_code = 404
+        asset, immutable = found
+
+        request_headers = Headers(scope=scope)
+        headers = {
+            "ETag": asset.etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+        if status_code == 200 and etag_matches(request_headers.get("if-none-match", ""), asset.etag):
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+
+        body = asset.body
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        for encoding, compressed in asset.encodings.items():
+            if encoding in accepted:
+                body = compressed
+                headers["Content-Encoding"] = encoding
+                break
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        response = Response(body, status_code=status_code, headers=headers, media_type=asset.content_type)
+        await response(scope, receive, send)
@@ -0,0 +1,95 @@
+from typing import Dict, Iterable, List, Tuple
+from fastapi import HTTPException
+from sqlalchemy import case, func, or_, update
+from sqlalchemy.orm import Session
+from .database import SQLITE_CHUNK_SIZE
+from .models import Menu as ModelMenu, OrderItem as ModelOrderItem
+from .menu_cache import CatalogSnapshot, menu_catalog
+from .websockets import notify_menu_update
+
+# {menu_id: (在庫数, 品切れか)}
+StockLevels = Dict[int, Tuple[int, bool]]
+
+
+def reserve_stock(quantities: Dict[int, int], db: Session) -> StockLevels:
+    """
+    注文された数量を在庫から1つの条件付き UPDATE で差し引く（呼び出し側のトランザクション内で実行する）。
+    品切れのメニュー・在庫が足りないメニューが1つでもあれば 409。
+    在庫数を数えているメニューの {menu_id: (残りの在庫数, 品切れか)} を返す。
+    """
+    requested = case(quantities, value=ModelMenu.id)
+    remaining = ModelMenu.stock_quantity - requested
+    rows = db.execute(
+        update(ModelMenu)
+        .where(
+            ModelMenu.id.in_(quantities),
+            or_(ModelMenu.is_out_of_stock.is_(None), ModelMenu.is_out_of_stock.is_(False)),
+            or_(ModelMenu.stock_quantity.is_(None), ModelMenu.stock_quantity >= requested),
+        )
+        # SET の右辺はすべて更新前の値で評価されるので、在庫数と品切れフラグは同じ値から計算される
+        .values(stock_quantity=remaining, is_out_of_stock=case((remaining <= 0, True), else_=False))
+        .returning(ModelMenu.id, ModelMenu.stock_quantity, ModelMenu.is_out_of_stock)
+        .execution_options(synchronize_session=False)
+    ).all()
+    unavailable = sorted(set(quantities) - {row[0] for row in rows})
+    if unavailable:
+        raise HTTPException(status_code=409, detail=f"Menu items out of stock: {unavailable}")
+    return {menu_id: (stock, bool(sold_out)) for menu_id, stock, sold_out in rows if stock is not None}
+
+
+def release_stock(quantities: Dict[int, int], db: Session) -> StockLevels:
+    """
+    キャンセルした注文の数量を在庫に戻す（呼び出し側のトランザクション内で実行する）。
+    在庫数を数えていないメニューは変えず、在庫が1以上に戻ったメニューは品切れを解除する。
+    """
+    restored = ModelMenu.stock_quantity + case(quantities, value=ModelMenu.id)
+    rows = db.execute(
+        update(ModelMenu)
+        .where(ModelMenu.id.in_(quantities), ModelMenu.stock_quantity.isnot(None))
+        .values(stock_quantity=restored, is_out_of_stock=case((restored > 0, False), else_=ModelMenu.is_out_of_stock))
+        .returning(ModelMenu.id, ModelMenu.stock_quantity, ModelMenu.is_out_of_stock)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return {menu_id: (stock, bool(sold_out)) for menu_id, stock, sold_out in rows}
+
+
+def order_quantities(order_ids: List[int], db: Session) -> Dict[int, int]:
+    """注文のアイテムの数量をメニューごとに合計する"""
+    quantities: Dict[int, int] = {}
+    for start in range(0, len(order_ids), SQLITE_CHUNK_SIZE):
+        for menu_id, quantity in db.query(ModelOrderItem.menu_id, func.sum(ModelOrderItem.quantity)).filter(
+            ModelOrderItem.order_id.in_(order_ids[start:start + SQLITE_CHUNK_SIZE])
+        ).group_by(ModelOrderItem.menu_id).all():
+            quantities[menu_id] = quantities.get(menu_id, 0) + quantity
+    return quantities
+
+
+def stock_menus(stock: StockLevels, snapshot: CatalogSnapshot) -> List[dict]:
+    """在庫数が変わったメニューを、キャッシュのメニューに在庫の項目を重ねて組み立てる"""
+    # キャッシュの dict は共有なので書き換えない
+    return [
+        {**snapshot.menus[menu_id], "stock_quantity": stock_quantity, "is_out_of_stock": sold_out}
+        for menu_id, (stock_quantity, sold_out) in stock.items()
+        if menu_id in snapshot.menus
+    ]
+
+
+def apply_released_stock(stock: StockLevels, db: Session) -> List[dict]:
+    """コミット後に、戻した在庫をメニューキャッシュに反映して、変わったメニューを返す"""
+    if not stock:
+        return []
+    changed_menus = stock_menus(stock, menu_catalog.get(db))
+    menu_catalog.update_stock(changed_menus)
+    return changed_menus
+
+
+async def publish_stock_changes(changed_menus: Iterable[dict], reserved: bool = False):
+    """在庫数が変わったメニューを1つのメッセージで通知する"""
+    changed_menus = list(changed_menus)
+    if not changed_menus:
+        return
+    fields = ["stock_quantity"]
+    # 在庫を戻した場合は品切れが解除されていることがある
+    if not reserved or any(menu["is_out_of_stock"] for menu in changed_menus):
+        fields.append("is_out_of_stock")
+    await notify_menu_update(changed_menus, fields, reserved=reserved)
@@ -1,49 +1,730 @@
+import asyncio
 import json
+import os
+import secrets
+import time
+from collections import OrderedDict, deque
+from itertools import count
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import List, Optional
+from typing import Any, Deque, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from .schemas import Order
+from .events import Event, build_event, create_event_bus
+from .menu_cache import STOCK_FIELDS, menu_catalog
+from .sales import sales_accumulator
+from .payment_numbers import payment_numbers
+from .metrics import (
+    ws_broadcast_duration, ws_broadcast_recipients, ws_bytes_sent, ws_connections, ws_connections_reaped,
+    ws_connections_rejected, ws_events_coalesced, ws_frames_sent, ws_messages_dropped, ws_send_queue,
+)
+
+try:
+    import msgpack
+except ImportError:  # msgpack が無ければ JSON だけを使う
+    msgpack = None
+
+# 再接続したクライアントが差分を取りに来られるよう、直近のイベントを保持する
+ORDER_EVENT_LOG_SIZE = 1000
+# 売上集計・支払い番号に反映したバージョンを覚えておく注文の数
+APPLIED_VERSIONS_SIZE = 10_000
+
+# 接続ごとの送信キューの上限と、遅いクライアントへの対処方法
+#   drop_oldest: 一番古い未送信メッセージを捨てる
+#   coalesce:    同じキー（同じ注文など）の未送信メッセージを最新のもので置き換える
+#   disconnect:  キューが溢れたクライアントを切断する（再接続時に差分を取り直す）
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "100"))
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "coalesce")
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "10"))
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# ハートビート: WS_PING_INTERVAL 秒ごとに {"type": "ping"} を送り、クライアントは {"action": "pong"} を返す。
+# WS_IDLE_TIMEOUT 秒の間クライアントから何も届かなければ、スリープした端末などの半開きの接続とみなして閉じる
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.environ.get("WS_IDLE_TIMEOUT", "60"))
+# 同時接続数の上限（全体・クライアントの IP ごと）。超えた接続は 1013 (Try Again Later) で閉じる
+WS_MAX_CONNECTIONS = int(os.environ.get("WS_MAX_CONNECTIONS", "1000"))
+WS_MAX_CONNECTIONS_PER_IP = int(os.environ.get("WS_MAX_CONNECTIONS_PER_IP", "50"))
+# 切断したセッションの購読を、同じセッションでの再接続 (?session=...) のために覚えておく時間
+WS_SESSION_TTL = float(os.environ.get("WS_SESSION_TTL", "300"))
+
+# 注文イベントをまとめる時間窓。この間の変更は1つのフレーム (update_orders) にまとめ、
+# 同じ注文が何度か変わった場合は最新の状態だけを送る。0 ならまとめずにすぐ送る
+WS_COALESCE_WINDOW = float(os.environ.get("WS_COALESCE_WINDOW_MS", "25")) / 1000
+
+# 接続時に Sec-WebSocket-Protocol で選べるフレームのエンコーディング（msgpack はインストールされている場合だけ）。
+# 選ばなかったクライアントには従来どおり JSON のテキストで送る
+WS_ENCODINGS = ("msgpack", "json") if msgpack is not None else ("json",)
+
+# トピック
+#   *                       すべてのメッセージ（購読を指定しない既存クライアントの既定値）
+#   orders                  すべての注文イベント
+#   orders.active           調理画面向け（未払い注文のイベントを除く）
+#   order:{id}              特定の注文
+#   payment:{payment_number} モバイルオーダーの支払い番号
+#   menu                    メニュー更新
+#   sales                   リアルタイム売上の更新
+ALL_TOPICS = "*"
+ACTIVE_ORDER_TOPIC = "orders.active"
+
+# 売上集計に影響するメニューの項目
+PRICE_FIELDS = {"name", "price"}
+
+
+def negotiate_encoding(offered: Sequence[str]) -> Optional[str]:
+    """クライアントが提示したサブプロトコルのうち、最初に対応しているもの"""
+    for protocol in offered:
+        if protocol in WS_ENCODINGS:
+            return protocol
+    return None
+
+
+class Frame:
+    """送信するメッセージ。エンコーディングごとに1回だけエンコードし、宛先の全接続で共有する"""
+    __slots__ = ("data", "_encoded")
+
+    def __init__(self, data: Any):
+        self.data = data
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+
+    def encode(self, encoding: str) -> Union[str, bytes]:
+        encoded = self._encoded.get(encoding)
+        if encoded is None:
+            if encoding == "msgpack":
+                encoded = msgpack.packb(self.data)
+            elif isinstance(self.data, str):
+                encoded = self.data
+            else:
+                encoded = json.dumps(self.data)
+            self._encoded[encoding] = encoded
+        return encoded
+
+
+class ClientConnection:
+    """1つの WebSocket 用の送信キューと、それを消化する送信タスク"""
+
+    def __init__(self, websocket: WebSocket, manager: "ConnectionManager", encoding: str = "json",
+                 session_id: Optional[str] = None, client_host: str = "unknown"):
+        self.websocket = websocket
+        self.manager = manager
+        self.encoding = encoding
+        self.session_id = session_id
+        self.client_host = client_host
+        self.queue: Deque[Tuple[Optional[str], Frame]] = deque()
+        self.topics: Set[str] = set()
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: Frame, key: Optional[str] = None) -> bool:
+        """メッセージをキューに積む。切断すべき場合は False を返す"""
+        policy = self.manager.policy
+        if policy == "coalesce" and key is not None:
+            for i, (queued_key, _) in enumerate(self.queue):
+                if queued_key == key:
+                    # 古い方を取り除いて末尾に積む（その場で置き換えると seq が前後する）
+                    del self.queue[i]
+                    self.queue.append((key, message))
+                    ws_messages_dropped.inc("coalesced")
+                    self._wakeup.set()
+                    return True
+        if len(self.queue) >= self.manager.max_queue:
+            if policy == "disconnect":
+                ws_messages_dropped.inc("disconnected")
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            ws_messages_dropped.inc("dropped_oldest")
+        self.queue.append((key, message))
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, message = self.queue.popleft()
+                payload = message.encode(self.encoding)
+                if isinstance(payload, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(payload), WS_SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(payload), WS_SEND_TIMEOUT)
+                ws_frames_sent.inc(self.encoding)
+                ws_bytes_sent.inc(self.encoding, amount=len(payload))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 送信に失敗した（切断済み・タイムアウト）ソケットは取り除く
+            self.manager.disconnect(self.websocket)
+            await self.close()
+
+    def cancel(self):
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def close(self, code: int = 1000):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, max_queue: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY,
+                 max_connections: int = WS_MAX_CONNECTIONS, max_connections_per_ip: int = WS_MAX_CONNECTIONS_PER_IP,
+                 ping_interval: float = WS_PING_INTERVAL, idle_timeout: float = WS_IDLE_TIMEOUT,
+                 session_ttl: float = WS_SESSION_TTL):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.session_ttl = session_ttl
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # トピック -> 購読しているソケット
+        self.subscriptions: Dict[str, Set[WebSocket]] = {}
+        # クライアントの IP -> 接続数
+        self.connections_by_ip: Dict[str, int] = {}
+        # セッション id -> そのセッションの今の接続
+        self.sessions: Dict[str, WebSocket] = {}
+        # 切断したセッション id -> (期限, 購読していたトピック)。期限の早い順
+        self.detached: "OrderedDict[str, Tuple[float, Set[str]]]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    async def connect(self, websocket: WebSocket, topics: Optional[Iterable[str]] = None,
+                      session_id: Optional[str] = None) -> Optional[ClientConnection]:
+        """
+        接続を受け付け、最初のメッセージとして {"type": "session", "session_id": ..., "epoch": ...} を送る。
+        前回受け取った session_id を渡すと、同じセッションの古い接続（半開きのまま残っているもの）を閉じて置き換え、
+        購読していたトピックを引き継ぐ。接続数の上限を超えていれば 1013 で閉じて None を返す。
+        """
+        encoding = negotiate_encoding(websocket.scope.get("subprotocols") or [])
+        await websocket.accept(subprotocol=encoding)
+        host = websocket.client.host if websocket.client else "unknown"
+        previous = self.active_connections.get(self.sessions.get(session_id)) if session_id else None
+        reason = self._over_limit(host, previous)
+        if reason is not None:
+            ws_connections_rejected.inc(reason)
+            await websocket.close(code=1013, reason="Too many connections")
+            return None
+
+        resumed_topics: Optional[Set[str]] = None
+        if previous is not None:
+            resumed_topics = set(previous.topics)
+        elif session_id is not None:
+            expires, topics_of_session = self.detached.pop(session_id, (0.0, None))
+            if expires > time.monotonic():
+                resumed_topics = topics_of_session
+        if resumed_topics is None:
+            session_id = secrets.token_urlsafe(16)
+
+        connection = ClientConnection(websocket, self, encoding or "json", session_id, host)
+        self.active_connections[websocket] = connection
+        self.connections_by_ip[host] = self.connections_by_ip.get(host, 0) + 1
+        self.sessions[session_id] = websocket
+        if previous is not None:
+            # セッションは新しい接続に移したので、古い接続は購読を引き継がせずに閉じる
+            self.disconnect(previous.websocket)
+            ws_connections_reaped.inc("replaced")
+            asyncio.create_task(previous.close(code=1000))
+        self.subscribe(websocket, set(topics or ()) | (resumed_topics or set()) or {ALL_TOPICS})
+        self._enqueue(connection, Frame({
+            "type": "session",
+            "session_id": session_id,
+            "resumed": resumed_topics is not None,
+            "topics": sorted(connection.topics),
+            "ping_interval": self.ping_interval,
+            # 注文イベントの seq の系列。前回と違えば、サーバーが起動し直して seq が振り直されている
+            "epoch": event_bus.epoch,
+        }))
+        if previous is not None:
+            # 古い接続で送れていなかったメッセージを引き継ぐ
+            for key, frame in previous.queue:
+                self._enqueue(connection, frame, key)
+        return connection
+
+    def _over_limit(self, host: str, replacing: Optional[ClientConnection]) -> Optional[str]:
+        """上限を超えるなら理由を返す。置き換える接続の分は数えない"""
+        total = len(self.active_connections) - (1 if replacing is not None else 0)
+        if total >= self.max_connections:
+            return "global_limit"
+        same_host = self.connections_by_ip.get(host, 0)
+        if replacing is not None and replacing.client_host == host:
+            same_host -= 1
+        if same_host >= self.max_connections_per_ip:
+            return "ip_limit"
+        return None
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        connection.cancel()
+        self.unsubscribe(websocket, list(connection.topics))
+        remaining = self.connections_by_ip.get(connection.client_host, 0) - 1
+        if remaining > 0:
+            self.connections_by_ip[connection.client_host] = remaining
+        else:
+            self.connections_by_ip.pop(connection.client_host, None)
+        if self.sessions.get(connection.session_id) is websocket:
+            # 再接続で再開できるよう、購読していたトピックだけを覚えておく
+            del self.sessions[connection.session_id]
+            self.detached.pop(connection.session_id, None)
+            self.detached[connection.session_id] = (time.monotonic() + self.session_ttl, set(connection.topics))
+            while len(self.detached) > self.max_connections:
+                self.detached.popitem(last=False)
+
+    async def close_idle(self, websocket: WebSocket):
+        """WS_IDLE_TIMEOUT の間何も届かなかった接続を閉じる"""
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self.disconnect(websocket)
+            ws_connections_reaped.inc("idle")
+            await connection.close(code=1001)
+
+    def heartbeat(self):
+        """全接続に ping を送り、期限の切れたセッションを捨てる"""
+        ping = Frame({"type": "ping"})
+        for connection in list(self.active_connections.values()):
+            # 送信キューに溜まっている ping は1つにまとめる
+            self._enqueue(connection, ping, key="ping")
+        now = time.monotonic()
+        while self.detached and next(iter(self.detached.values()))[0] <= now:
+            self.detached.popitem(last=False)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"WebSocket heartbeat failed: {e}")
+
+    def subscribe(self, websocket: WebSocket, topics: Iterable[str]) -> Set[str]:
+        """
+        トピックを購読する。明示的に購読したクライアントは、
+        自分で * を指定しない限り全件受信（*）から外れる。
+        """
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return set()
+        topics = set(topics)
+        if ALL_TOPICS not in topics and ALL_TOPICS in connection.topics:
+            self.unsubscribe(websocket, [ALL_TOPICS])
+        for topic in topics:
+            self.subscriptions.setdefault(topic, set()).add(websocket)
+        connection.topics |= topics
+        return connection.topics
+
+    def unsubscribe(self, websocket: WebSocket, topics: Iterable[str]) -> Set[str]:
+        connection = self.active_connections.get(websocket)
+        for topic in topics:
+            subscribers = self.subscriptions.get(topic)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.subscriptions[topic]
+            if connection is not None:
+                connection.topics.discard(topic)
+        return connection.topics if connection is not None else set()
+
+    def subscribers(self, topics: Optional[Iterable[str]] = None) -> List[ClientConnection]:
+        """topics のいずれかを購読している接続（topics が None なら全接続）"""
+        if topics is None:
+            return list(self.active_connections.values())
+        targets: Set[WebSocket] = set(self.subscriptions.get(ALL_TOPICS, ()))
+        for topic in topics:
+            targets |= self.subscriptions.get(topic, set())
+        return [self.active_connections[ws] for ws in targets if ws in self.active_connections]
+
+    def _enqueue(self, connection: ClientConnection, message: Frame, key: Optional[str] = None):
+        if not connection.enqueue(message, key):
+            # disconnect ポリシー: 追いつけないクライアントは切断して再接続させる
+            self.disconnect(connection.websocket)
+            asyncio.create_task(connection.close(code=1013))
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+    async def send_personal_message(self, message: Any, websocket: WebSocket):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, Frame(message))
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    async def broadcast(self, message: Any, key: Optional[str] = None, topics: Optional[Iterable[str]] = None,
+                        order_topics: Optional[List[List[str]]] = None) -> List[ClientConnection]:
+        """
+        各接続の送信キューに積むだけで、実際の送信は接続ごとの送信タスクが並行して行う。
+        そのため遅いクライアントがいても呼び出し元（HTTP リクエスト）は待たされない。
+        message (dict か文字列) は接続のエンコーディングごとに1回だけエンコードする。
+        key が同じ未送信メッセージは coalesce ポリシーで最新のものにまとめられる。
+        topics を指定すると、そのいずれかを購読している接続にだけ送る。
+        order_topics (message["orders"] の注文ごとのトピック) を指定すると、
+        まとめた注文のうち各接続が購読しているものだけを送る。送り先の接続を返す。
+        """
+        started = time.perf_counter()
+        recipients = self.subscribers(topics)
+        frame = Frame(message)
+        if order_topics is None:
+            for connection in recipients:
+                self._enqueue(connection, frame, key)
+        else:
+            everything = tuple(range(len(order_topics)))
+            # 同じ注文の組み合わせを受け取る接続ではフレームを共有する
+            frames: Dict[Tuple[int, ...], Frame] = {everything: frame}
+            for connection in recipients:
+                if ALL_TOPICS in connection.topics:
+                    selected = everything
+                else:
+                    selected = tuple(
+                        i for i, topics_of_order in enumerate(order_topics)
+                        if not connection.topics.isdisjoint(topics_of_order)
+                    )
+                if selected not in frames:
+                    frames[selected] = Frame(select_orders(message, selected))
+                self._enqueue(connection, frames[selected], key)
+        ws_broadcast_duration.observe(time.perf_counter() - started)
+        ws_broadcast_recipients.observe(len(recipients))
+        return recipients
+
+    def skip_seq(self, seq: int, delivered: Iterable[ClientConnection]):
+        """
+        トピックで絞り込まれて注文イベントが届かなかった orders.active の購読者に、seq だけのフレームを送る。
+        送らないと次のイベントが取りこぼしに見えて、クライアントが差分を取り直してしまう
+        """
+        delivered = set(delivered)
+        skipped = [connection for connection in self.subscribers([ACTIVE_ORDER_TOPIC]) if connection not in delivered]
+        if skipped:
+            frame = Frame({"type": "seq", "seq": seq})
+            for connection in skipped:
+                self._enqueue(connection, frame)
+
+    def queue_depths(self):
+        depths = [len(connection.queue) for connection in self.active_connections.values()]
+        return [(("total",), sum(depths)), (("max",), max(depths, default=0))]
+
+
+def select_orders(message: Dict[str, Any], indices: Sequence[int]) -> Dict[str, Any]:
+    """まとめた注文のメッセージから、indices の注文だけを残したもの"""
+    orders = [message["orders"][i] for i in indices]
+    selected = {**message, "orders": orders}
+    if "new_order_ids" in message:
+        ids = {order["id"] for order in orders}
+        selected["new_order_ids"] = [order_id for order_id in message["new_order_ids"] if order_id in ids]
+    return selected
 
 manager = ConnectionManager()
+ws_connections.callback = lambda: [((), len(manager.active_connections))]
+ws_send_queue.callback = manager.queue_depths
+
+
+class OrderEventLog:
+    """注文イベントに単調増加のシーケンス番号を振り、直近分を保持する"""
+
+    def __init__(self, maxlen: int = ORDER_EVENT_LOG_SIZE):
+        self._seq = count(1)
+        self.last_seq = 0
+        self.events: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=maxlen)
+
+    def append(self, order: Dict[str, Any], seq: Optional[int] = None) -> int:
+        """seq はイベントバスが振った番号（省略時はプロセス内で採番）"""
+        if seq is None:
+            seq = next(self._seq)
+        if self.events and seq < self.events[-1][0]:
+            # 他のワーカーのイベントが自分のものより後に届いた場合は順序を保って挿入する
+            index = len(self.events)
+            while index > 0 and self.events[index - 1][0] > seq:
+                index -= 1
+            self.events.insert(index, (seq, order))
+            return seq
+        self.last_seq = seq
+        self.events.append((seq, order))
+        return seq
+
+    def since(self, seq: int) -> Tuple[int, Optional[List[Dict[str, Any]]]]:
+        """
+        (現在の seq, seq より後に変更された注文) を返す。注文ごとに最新の状態だけ。
+        ログから既に溢れている場合は変更分を None にする（クライアントは全件取り直す）。
+        """
+        # 別スレッドからの append と競合しないようスナップショットを取る
+        events = list(self.events)
+        last_seq = events[-1][0] if events else 0
+        if seq > last_seq:
+            return last_seq, None
+        if seq < last_seq and events[0][0] > seq + 1:
+            return last_seq, None
+        latest: Dict[int, Dict[str, Any]] = {}
+        for event_seq, order in events:
+            if event_seq > seq:
+                latest.pop(order["id"], None)
+                latest[order["id"]] = order
+        return last_seq, list(latest.values())
+
+order_events = OrderEventLog()
+
 
-async def notify_order_update(order_id: int, status: Optional[str] = None, is_new: bool = False):
+class AppliedOrderVersions:
+    """
+    このプロセスの売上集計と支払い番号に反映した注文のバージョン。
+    注文を変更したワーカーはその場で反映するので、同じ変更がイベントバスから届いても反映し直さず、
+    まとめ送りで後から届いた古い状態で新しい状態を上書きすることもない。イベントループの中だけで使う。
+    """
+
+    def __init__(self, maxlen: int = APPLIED_VERSIONS_SIZE):
+        self.maxlen = maxlen
+        self._versions: "OrderedDict[int, int]" = OrderedDict()
+
+    def advance(self, order: Dict[str, Any]) -> bool:
+        """反映済みより新しいバージョンなら記録して True"""
+        version = order.get("version")
+        if version is None:
+            return True
+        last = self._versions.get(order["id"])
+        if last is not None and version <= last:
+            return False
+        self._versions[order["id"]] = version
+        self._versions.move_to_end(order["id"])
+        while len(self._versions) > self.maxlen:
+            self._versions.popitem(last=False)
+        return True
+
+applied_versions = AppliedOrderVersions()
+
+
+def apply_order_changes(orders: Iterable[Dict[str, Any]]) -> bool:
+    """注文の変更をこのプロセスの売上集計と支払い番号に反映し、売上が変わったら True を返す"""
+    sales_changed = False
+    for order in orders:
+        if not applied_versions.advance(order):
+            continue
+        payment_numbers.observe(order)
+        sales_changed = sales_accumulator.apply_order(order) or sales_changed
+    return sales_changed
+
+
+async def dispatch_event(event: Dict[str, Any]):
+    """
+    イベントバスから届いたイベントを、このプロセスに接続しているクライアントへ配る。
+    注文イベントの seq はバスが全ワーカー共通で振るので、どのワーカーでも同じ番号になる。
+    """
+    message = event["message"]
+    if message.get("type") == "menu_update":
+        if message.get("menus") is not None and set(message.get("fields") or ()) <= STOCK_FIELDS:
+            # 在庫の項目だけの変更（注文による引き当てなど）は、キャッシュのメニューをその場で差し替える
+            menu_catalog.update_stock(message["menus"], reserved=message.get("reserved", False))
+        else:
+            # 他のワーカーで変更されたメニューのキャッシュも破棄する
+            menu_catalog.invalidate()
+        # 価格が変わると商品別売上も変わるので作り直す
+        if set(message.get("fields") or PRICE_FIELDS) & PRICE_FIELDS:
+            sales_accumulator.invalidate()
+    sales_changed = False
+    if event["channel"] == "orders":
+        message["seq"] = event["seq"]
+        # まとめて送られた注文はすべて同じ seq で記録する
+        orders = message["orders"] if "orders" in message else [message["order"]]
+        for order in orders:
+            order_events.append(order, event["seq"])
+        # 他のワーカーでの変更を反映する（このワーカーでの変更は反映済みなので飛ばされる）
+        sales_changed = apply_order_changes(orders)
+    recipients = await manager.broadcast(message, key=event.get("key"), topics=event.get("topics"),
+                                         order_topics=event.get("order_topics"))
+    if event["channel"] == "orders":
+        manager.skip_seq(event["seq"], recipients)
+    if sales_changed:
+        await notify_sales_update()
+
+
+async def notify_sales_update():
+    """
+    このプロセスの売上集計を、このプロセスに接続しているクライアントへ送る。
+    各ワーカーがイベントバスの注文イベントから自分で集計するので、バスには流さない。
+    """
+    sales = sales_accumulator.snapshot()
+    if sales is not None:
+        message = {"type": "sales_update", "sales": sales}
+        await manager.broadcast(message, key="sales", topics=["sales"])
+
+event_bus = create_event_bus(dispatch_event)
+
+
+def serialize_order(order: Any) -> Dict[str, Any]:
+    """ORM の注文を schemas.Order と同じ形の JSON 互換 dict に変換する"""
+    if isinstance(order, dict):
+        return order
+    return Order.model_validate(order).model_dump(mode="json")
+
+
+def order_topics(order_id: int, status: Optional[str] = None, order: Optional[Dict[str, Any]] = None) -> List[str]:
+    """注文イベントを届けるトピック"""
+    topics = ["orders", f"order:{order_id}"]
+    if order is not None:
+        status = order.get("status", status)
+        if order.get("payment_number"):
+            topics.append(f"payment:{order['payment_number']}")
+    if status != "unpaid":
+        topics.append(ACTIVE_ORDER_TOPIC)
+    return topics
+
+
+def order_update_event(updates: List[Tuple[Dict[str, Any], bool]]) -> Event:
+    """
+    (シリアライズ済みの注文, 新規注文か) の並びから注文イベントを作る。
+    1件なら従来どおり new_order / update_order、複数なら update_orders にまとめ、同じ seq を共有する。
+    """
+    if len(updates) == 1:
+        payload, is_new = updates[0]
+        message = {
+            "type": "new_order" if is_new else "update_order",
+            "order_id": payload["id"],
+            "status": payload["status"],
+            "order": payload,
+        }
+        return build_event(message, topics=order_topics(payload["id"], order=payload),
+                           key=f"order:{payload['id']}", channel="orders")
+    payloads = [payload for payload, _ in updates]
+    topics_by_order = [order_topics(payload["id"], order=payload) for payload in payloads]
+    message = {"type": "update_orders", "orders": payloads}
+    new_order_ids = [payload["id"] for payload, is_new in updates if is_new]
+    if new_order_ids:
+        message["new_order_ids"] = new_order_ids
+    topics = list(dict.fromkeys(topic for topics_of_order in topics_by_order for topic in topics_of_order))
+    return build_event(message, topics=topics, channel="orders", order_topics=topics_by_order)
+
+
+class OrderUpdateCoalescer:
+    """
+    時間窓の間の注文の変更を溜め、1つのイベントにまとめて発行する。
+    同じ注文の変更はバージョンの最も新しい状態だけを残す（新規注文だったことは new_order_ids に残る）。
+    HTTP リクエストは溜めるだけで戻るので、時間窓の分だけ待たされることはない。
+    """
+
+    def __init__(self, window: float = WS_COALESCE_WINDOW):
+        self.window = window
+        # 注文 id -> (シリアライズ済みの注文, 新規注文か)
+        self._pending: "OrderedDict[int, Tuple[Dict[str, Any], bool]]" = OrderedDict()
+        self._added = 0
+        # 発行の順序を保つため、発行は1つずつ行う
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def add(self, payloads: Iterable[Dict[str, Any]], is_new: bool = False, new_order_ids: Iterable[int] = ()):
+        new_order_ids = set(new_order_ids)
+        for payload in payloads:
+            previous = self._pending.pop(payload["id"], None)
+            new = is_new or payload["id"] in new_order_ids
+            if previous is not None:
+                new = new or previous[1]
+                # 別々のリクエストの通知は、書き換えた順に届くとは限らないので、バージョンの新しい方を残す
+                if (payload.get("version") or 0) < (previous[0].get("version") or 0):
+                    payload = previous[0]
+            self._pending[payload["id"]] = (payload, new)
+            self._added += 1
+        if self.window <= 0:
+            await self.flush()
+        elif self._task is None and self._pending:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        # 発行中に stop() で取り消されないよう、先に外す
+        self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Order event publish failed: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            updates = list(self._pending.values())
+            if self._added > 1:
+                ws_events_coalesced.inc(amount=self._added - 1)
+            self._pending = OrderedDict()
+            self._added = 0
+            await event_bus.publish(order_update_event(updates))
+
+    async def stop(self):
+        """溜まっている変更を発行してから止める"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+order_updates = OrderUpdateCoalescer()
+
+
+async def notify_order_update(order_id: int, status: Optional[str] = None, is_new: bool = False, order: Any = None):
     """
     Notifies clients about a new order or an order status update.
     - if is_new == True -> message["type"] == "new_order"
     - otherwise -> message["type"] == "update_order"
     - status が与えられれば message に含める（後方互換）
+    - order が与えられれば、シリアライズ済みの注文全体と seq を含める
+      （イベントごとに1回だけシリアライズし、全クライアントで共有する）。
+      WS_COALESCE_WINDOW の間の他の変更とまとめて update_orders で送られることがある
     """
+    if order is not None:
+        await publish_order_changes([serialize_order(order)], is_new=is_new)
+        return
     message = {
         "type": "new_order" if is_new else "update_order",
         "order_id": order_id,
     }
     if status is not None:
         message["status"] = status
-    await manager.broadcast(json.dumps(message))
+    await event_bus.publish(build_event(message, topics=order_topics(order_id, status), key=f"order:{order_id}"))
+
+
+async def notify_orders_update(orders: List[Any], new_order_ids: Iterable[int] = ()):
+    """
+    複数の注文の変更を1つのメッセージ (type == "update_orders") にまとめて通知する。
+    まとめた注文は同じ seq を共有する。new_order_ids の注文は新規注文として扱う。
+    """
+    await publish_order_changes([serialize_order(order) for order in orders], new_order_ids=new_order_ids)
 
 
-async def notify_new_order(order_id: int, status: Optional[str] = None):
+async def publish_order_changes(orders: List[Dict[str, Any]], is_new: bool = False, new_order_ids: Iterable[int] = ()):
+    """
+    売上集計と支払い番号にはその場で反映してから、まとめ送りに溜める。
+    まとめ送りの時間窓を待たずに、直後の /sales/realtime が変更後の値を返す
+    """
+    if apply_order_changes(orders):
+        await notify_sales_update()
+    await order_updates.add(orders, is_new=is_new, new_order_ids=new_order_ids)
+
+
+async def notify_new_order(order_id: int, status: Optional[str] = None, order: Any = None):
     """後方互換ラッパー：既存の notify_new_order(order_id, status) 呼び出しをサポート"""
-    await notify_order_update(order_id, status=status, is_new=True)
+    await notify_order_update(order_id, status=status, is_new=True, order=order)
 
 
-async def notify_menu_update():
-    """Notifies clients that a menu item has been updated."""
-    message = {"type": "menu_update"}
-    await manager.broadcast(json.dumps(message))
\ No newline at end of file
+async def notify_menu_update(menus: Optional[List[Dict[str, Any]]] = None, fields: Optional[Iterable[str]] = None,
+                             reserved: bool = False):
+    """
+    メニューの変更を1つのメッセージで通知する。
+    menus（変更後のメニュー）を渡すとクライアントは手元の一覧を差し替えるだけで済む。
+    fields は変更された項目で、価格・名前が変わっていなければ売上集計を作り直さない。
+    reserved は注文による在庫の引き当て（在庫が減るだけの変更）であることを示す。
+    """
+    message: Dict[str, Any] = {"type": "menu_update"}
+    key = "menu"
+    if menus is not None:
+        message["menus"] = menus
+        # 差分は後続のメッセージで置き換えられると失われるので、まとめ送りの対象にしない
+        key = None
+    if fields is not None:
+        message["fields"] = sorted(set(fields))
+    if reserved:
+        message["reserved"] = True
+    await event_bus.publish(build_event(message, topics=["menu"], key=key))
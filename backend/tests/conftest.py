@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app をインポートする前に、テスト用のデータベースを指定する
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="regi-test-"), "test.db"))
+os.environ.setdefault("EVENT_BUS", "local")
+# レート制限で結果が変わらないよう、流入制御は test_admission で個別に確かめる
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fastapi.testclient import TestClient  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as c:
+        yield c
+
+
+@pytest.fixture
+def menu_id(client):
+    return client.get("/api/menus/").json()[0]["id"]
@@ -0,0 +1,55 @@
+import asyncio
+
+from starlette.datastructures import Headers
+
+from app.admission import AdmissionController, AdmissionMiddleware, request_class
+
+
+def test_register_orders_are_classed_register_without_staff_token():
+    headers = Headers(headers={})
+    assert request_class("POST", "/api/orders/batch", headers, staff_token="") == "register"
+    assert request_class("POST", "/api/orders/", headers, staff_token="") == "mobile"
+    # 合言葉が未設定なら、クラスのヘッダーだけでは優先されない
+    spoofed = Headers(headers={"x-client-class": "register"})
+    assert request_class("POST", "/api/orders/", spoofed, staff_token="") == "mobile"
+
+
+def test_register_order_is_served_ahead_of_a_mobile_flood():
+    finished = []
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(0.005)
+        finished.append(scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"[]"})
+
+    async def request(middleware, path, client):
+        scope = {"type": "http", "method": "POST", "path": path, "headers": [], "client": (client, 50000)}
+        statuses = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message["status"])
+
+        await middleware(scope, receive, send)
+        return statuses[0]
+
+    async def run():
+        # 既定の設定 (合言葉なし) で、同時に1件しか処理できない状態にする
+        middleware = AdmissionMiddleware(app, AdmissionController(max_concurrency=1), enabled=True, staff_token="")
+        mobile = [
+            asyncio.create_task(request(middleware, "/api/orders/", f"10.0.0.{i}")) for i in range(20)
+        ]
+        await asyncio.sleep(0)
+        # レジの画面は合言葉もクラスのヘッダーも送らない
+        register = asyncio.create_task(request(middleware, "/api/orders/batch", "192.168.0.2"))
+        return await register, await asyncio.gather(*mobile)
+
+    register_status, mobile_statuses = asyncio.run(run())
+    assert register_status == 200
+    assert set(mobile_statuses) == {200}
+    # 実行中だった1件の次に、待っていたモバイルオーダーを追い越して処理される
+    assert finished.index("/api/orders/batch") == 1
@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+import pytest
+
+
+def order(menu_id, quantity=1, status="pending"):
+    return {"table_id": 1, "order_items": [{"menu_id": menu_id, "quantity": quantity}], "status": status}
+
+
+@pytest.mark.parametrize("quantity", [-5, 0])
+def test_non_positive_quantity_is_rejected(client, menu_id, quantity):
+    before = client.get("/api/menus/").json()
+    response = client.post("/api/orders/", json=order(menu_id, quantity))
+    assert response.status_code == 422
+    assert client.get("/api/menus/").json() == before
+
+
+def test_order_without_items_is_rejected(client):
+    response = client.post("/api/orders/", json={"table_id": 1, "order_items": [], "status": "pending"})
+    assert response.status_code == 422
+
+
+def test_batch_with_invalid_order_is_rejected(client, menu_id):
+    response = client.post("/api/orders/batch", json=[order(menu_id), order(menu_id, -1)])
+    assert response.status_code == 422
+
+
+@pytest.fixture
+def stock_menu(client):
+    return client.post("/api/menus/", json={"name": "限定メニュー", "price": 500, "stock_quantity": 2}).json()["id"]
+
+
+def menu_stock(client, menu_id):
+    menu = next(menu for menu in client.get("/api/menus/").json() if menu["id"] == menu_id)
+    return menu["stock_quantity"], menu["is_out_of_stock"]
+
+
+def test_cancel_returns_stock(client, stock_menu):
+    created = client.post("/api/orders/", json=order(stock_menu, 2)).json()
+    assert menu_stock(client, stock_menu) == (0, True)
+    assert client.post("/api/orders/", json=order(stock_menu)).status_code == 409
+
+    response = client.patch(f"/api/orders/{created['id']}", json={"status": "cancelled"})
+    assert response.status_code == 200
+    assert menu_stock(client, stock_menu) == (2, False)
+    assert client.post("/api/orders/", json=order(stock_menu)).status_code == 200
+
+
+def test_expired_order_returns_stock(client, stock_menu):
+    from app.database import SessionLocal
+    from app.expiry import expire_unpaid_orders, now_jst
+
+    created = client.post("/api/orders/", json=order(stock_menu, 2, status="unpaid")).json()
+    assert menu_stock(client, stock_menu) == (0, True)
+    db = SessionLocal()
+    try:
+        cancelled, changed_menus = expire_unpaid_orders(db, now_jst() + timedelta(seconds=1))
+    finally:
+        db.close()
+    assert created["id"] in [o["id"] for o in cancelled]
+    assert [(menu["id"], menu["stock_quantity"]) for menu in changed_menus] == [(stock_menu, 2)]
+    assert menu_stock(client, stock_menu) == (2, False)
+
+
+def test_reopen_without_payment_numbers_fails_the_transition(client, menu_id, monkeypatch):
+    from app.payment_numbers import PaymentNumbersExhausted, payment_numbers
+
+    created = client.post("/api/orders/", json=order(menu_id, status="unpaid")).json()
+    for status in ("pending", "preparing", "ready", "completed"):
+        assert client.patch(f"/api/orders/{created['id']}", json={"status": status}).status_code == 200
+
+    def exhausted(count=1):
+        raise PaymentNumbersExhausted()
+
+    # 完了にした注文の番号が別の注文に払い出され、空きの番号もない状態にする
+    monkeypatch.setattr(payment_numbers, "reclaim", lambda code: False)
+    monkeypatch.setattr(payment_numbers, "allocate", exhausted)
+    response = client.patch(f"/api/orders/{created['id']}", json={"status": "pending"})
+    assert response.status_code == 503
+    assert response.json()["detail"] == "No payment numbers available"
+
+    response = client.post("/api/orders/transitions", json={
+        "transitions": [{"order_id": created["id"], "status": "pending"}], "atomic": False,
+    })
+    assert response.status_code == 200
+    assert response.json()["orders"] == []
+    assert [(f["order_id"], f["status_code"]) for f in response.json()["failed"]] == [(created["id"], 503)]
+
+
+def test_realtime_sales_include_an_order_right_after_it_is_completed(client, menu_id, monkeypatch):
+    from app.websockets import order_updates
+
+    # まとめ送りのイベントが届く前に売上を読む
+    monkeypatch.setattr(order_updates, "window", 0.5)
+    created = client.post("/api/orders/", json=order(menu_id, 3)).json()
+    for status in ("preparing", "ready"):
+        assert client.patch(f"/api/orders/{created['id']}", json={"status": status}).status_code == 200
+    before = client.get("/api/orders/sales/realtime").json()["daily_total"]
+
+    assert client.patch(f"/api/orders/{created['id']}", json={"status": "completed"}).status_code == 200
+    assert client.get("/api/orders/sales/realtime").json()["daily_total"] == before + created["total_price"]
+
+    assert client.patch(f"/api/orders/{created['id']}", json={"status": "pending"}).status_code == 200
+    assert client.get("/api/orders/sales/realtime").json()["daily_total"] == before
@@ -0,0 +1,30 @@
+import asyncio
+
+from app import websockets
+from app.websockets import OrderUpdateCoalescer
+
+
+def payload(order_id, version, status):
+    return {"id": order_id, "version": version, "status": status, "payment_number": None}
+
+
+def test_coalescer_keeps_the_newest_version(monkeypatch):
+    published = []
+
+    async def publish(event):
+        published.append(event)
+
+    monkeypatch.setattr(websockets.event_bus, "publish", publish)
+
+    async def run():
+        coalescer = OrderUpdateCoalescer(window=60)
+        await coalescer.add([payload(1, 3, "preparing")], is_new=True)
+        # 先に書き換えたリクエストの通知が後から届いた
+        await coalescer.add([payload(1, 2, "pending")])
+        await coalescer.stop()
+
+    asyncio.run(run())
+    message = published[0]["message"]
+    assert message["type"] == "new_order"
+    assert message["order"]["version"] == 3
+
@@ -0,0 +1,165 @@
+"""
+注文テーブルのインデックス有無でのクエリプランとレイテンシを比較するベンチマーク。
+
+一時的な SQLite データベースに注文を投入し（既定 100万件）、ルーターの
+ホットパスのクエリを、インデックスなし → あり の順に実行して
+EXPLAIN QUERY PLAN と実行時間の中央値を表示する。
+
+    python bench/index_benchmark.py --orders 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=9))
+
+# ベンチマーク対象のインデックス (alembic 5d2c8e91f3a7 と同じ)
+NEW_INDEXES = [
+    "ix_orders_status_created_at",
+    "ix_orders_table_id",
+    "ix_order_items_order_id",
+    "ix_order_items_menu_id",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1_000_000, help="投入する注文数")
+    parser.add_argument("--days", type=int, default=30, help="注文を分散させる日数")
+    parser.add_argument("--active", type=int, default=50, help="調理中 (pending/preparing/ready) の注文数")
+    parser.add_argument("--repeat", type=int, default=5, help="各クエリの実行回数")
+    parser.add_argument("--db", help="使用するデータベースファイル (既定: 一時ファイル)")
+    return parser.parse_args()
+
+
+args = parse_args()
+db_file = args.db or os.path.join(tempfile.mkdtemp(prefix="regi-bench-"), "bench.db")
+# app をインポートする前に、ベンチマーク用のデータベースを指定する
+os.environ["DB_PATH"] = db_file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from fastapi import Response  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.routers import orders as orders_router  # noqa: E402
+
+
+def seed(n_orders: int, days: int, n_active: int):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for name in NEW_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+    raw = sqlite3.connect(db_file)
+    raw.execute("PRAGMA journal_mode=WAL")
+    raw.execute("PRAGMA synchronous=OFF")
+    raw.executemany("INSERT INTO tables (name, status) VALUES (?, 'available')", [(f"テーブル{i}",) for i in range(1, 21)])
+    menus = [(f"メニュー{i}", 150 + 50 * (i % 4), "フード" if i % 2 else "ドリンク") for i in range(1, 13)]
+    raw.executemany("INSERT INTO menus (name, price, category, is_out_of_stock) VALUES (?, ?, ?, 0)", menus)
+    prices = {i + 1: m[1] for i, m in enumerate(menus)}
+
+    rng = random.Random(42)
+    now = datetime.now(JST).replace(tzinfo=None)
+    start = now - timedelta(days=days)
+    span = (now - start).total_seconds()
+    active_statuses = ["pending", "preparing", "ready"]
+    batch = 50_000
+    item_id = 0
+    for offset in range(0, n_orders, batch):
+        order_rows, item_rows = [], []
+        for order_id in range(offset + 1, min(offset + batch, n_orders) + 1):
+            # 新しい注文ほど後ろに来るように created_at を単調に増やす
+            created_at = start + timedelta(seconds=span * order_id / n_orders)
+            if order_id > n_orders - n_active:
+                status = rng.choice(active_statuses)
+            else:
+                status = "completed" if rng.random() < 0.95 else "cancelled"
+            total = 0
+            for _ in range(rng.randint(1, 3)):
+                item_id += 1
+                menu_id = rng.randint(1, len(menus))
+                quantity = rng.randint(1, 3)
+                total += prices[menu_id] * quantity
+                item_rows.append((item_id, order_id, menu_id, quantity))
+            order_rows.append((order_id, rng.choice([None, rng.randint(1, 20)]), total, status,
+                               created_at.strftime("%Y-%m-%d %H:%M:%S.%f")))
+        raw.executemany("INSERT INTO orders (id, table_id, total_price, status, created_at) VALUES (?, ?, ?, ?, ?)", order_rows)
+        raw.executemany("INSERT INTO order_items (id, order_id, menu_id, quantity) VALUES (?, ?, ?, ?)", item_rows)
+        raw.commit()
+    raw.execute("ANALYZE")
+    raw.commit()
+    raw.close()
+
+
+def create_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in NEW_INDEXES:
+                index.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+today = datetime.now(JST).date().isoformat()
+QUERIES = {
+    "GET /api/orders/active": lambda db: orders_router.get_active_orders(Response(), None, db),
+    "GET /api/orders/{table_id}": lambda db: orders_router.get_orders_by_table(7, db),
+    "GET /sales/realtime": lambda db: orders_router.get_realtime_sales(db),
+    "GET /sales/by-time (today)": lambda db: orders_router.get_sales_by_time(today, today, "hour", db),
+}
+
+
+def run(label: str, repeat: int):
+    print(f"\n=== {label} ===")
+    for name, query in QUERIES.items():
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", capture)
+        db = SessionLocal()
+        try:
+            query(db)
+        finally:
+            db.close()
+            event.remove(engine, "before_cursor_execute", capture)
+
+        timings = []
+        for _ in range(repeat):
+            db = SessionLocal()
+            try:
+                t0 = time.perf_counter()
+                query(db)
+                timings.append((time.perf_counter() - t0) * 1000)
+            finally:
+                db.close()
+
+        print(f"\n{name}: median {statistics.median(timings):.2f} ms (min {min(timings):.2f} ms, n={repeat})")
+        with engine.connect() as conn:
+            for statement, parameters in statements:
+                plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+                for row in plan:
+                    print(f"    {row[-1]}")
+
+
+def main():
+    print(f"database: {db_file}")
+    t0 = time.perf_counter()
+    seed(args.orders, args.days, args.active)
+    print(f"seeded {args.orders} orders in {time.perf_counter() - t0:.1f} s")
+    run("before (no indexes)", args.repeat)
+    t0 = time.perf_counter()
+    create_indexes()
+    print(f"\ncreated indexes in {time.perf_counter() - t0:.1f} s")
+    run("after (with indexes)", args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+"""
+注文処理全体の負荷試験。
+
+シード済みの SQLite データベースに対して、次のクライアントを同時に動かす。
+  - レジ (--registers):     POST /api/orders/ を繰り返す
+  - 調理画面 (--kitchens):  /ws?topics=orders.active を購読し、通知のたびに /api/orders/active を取り直す
+  - モバイル (--mobiles):   注文を1件作成し、/api/orders/by_payment_number/{番号} をポーリングする
+  - 管理画面 (--admins):    /api/orders/sales/realtime をポーリングする
+エンドポイントごとの p50 / p99 レイテンシとスループット、注文作成から調理画面に
+通知が届くまでの遅延 (broadcast lag) を表示する。
+
+    # アプリを同じプロセス内で直接呼び出す (ネットワークを通さない)
+    python bench/load_test.py --mode inprocess --orders 100000 --duration 30
+
+    # ローカルで uvicorn を起動して HTTP / WebSocket 越しに試験する
+    python bench/load_test.py --mode uvicorn --workers 1
+    # すでに起動しているサーバーに対して試験する (シードは行わない)
+    python bench/load_test.py --mode uvicorn --url http://127.0.0.1:8000
+
+uvicorn 越しの WebSocket には websockets パッケージが必要。無い場合、調理画面は
+/api/orders/active のポーリングに切り替わり、通知の遅延は計測しない。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+try:
+    import httpx
+except ImportError:
+    sys.exit("httpx が必要です: pip install httpx")
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+JST = timezone(timedelta(hours=9))
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--url", help="uvicorn モードで既存のサーバーを使う場合の URL")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn モードで起動するワーカー数")
+    parser.add_argument("--db", help="使用するデータベースファイル (既定: 一時ファイル。注文が無ければシードする)")
+    parser.add_argument("--orders", type=int, default=100_000, help="シードする過去の注文数")
+    parser.add_argument("--days", type=int, default=30, help="シードする注文を分散させる日数")
+    parser.add_argument("--active", type=int, default=50, help="シードする調理中の注文数")
+    parser.add_argument("--duration", type=float, default=30, help="試験時間 (秒)")
+    parser.add_argument("--registers", type=int, default=8)
+    parser.add_argument("--kitchens", type=int, default=4)
+    parser.add_argument("--mobiles", type=int, default=50)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--register-interval", type=float, default=0.5, help="レジが注文を送る間隔 (秒)")
+    parser.add_argument("--mobile-interval", type=float, default=2.0, help="モバイルのポーリング間隔 (秒)")
+    parser.add_argument("--admin-interval", type=float, default=1.0, help="管理画面のポーリング間隔 (秒)")
+    parser.add_argument("--kitchen-poll", type=float, default=1.0, help="WebSocket を使えない場合の調理画面のポーリング間隔 (秒)")
+    parser.add_argument("--seed", type=int, default=42, help="乱数のシード")
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    return parser.parse_args()
+
+
+args = parse_args()
+db_file = args.db or os.path.join(tempfile.mkdtemp(prefix="regi-bench-"), "bench.db")
+# app をインポートする前に、ベンチマーク用のデータベースを指定する
+os.environ["DB_PATH"] = db_file
+# スタッフの画面のクラスのヘッダーは合言葉と一緒に送った場合だけ使われる
+STAFF_TOKEN = os.environ.setdefault("ADMISSION_STAFF_TOKEN", "bench-staff-token")
+sys.path.insert(0, BACKEND_DIR)
+
+
+# --- シード ---------------------------------------------------------------
+
+def seed(n_orders: int, days: int, n_active: int):
+    from app.database import Base, SessionLocal, engine
+    from app.rollup import backfill
+
+    Base.metadata.create_all(bind=engine)
+    raw = sqlite3.connect(db_file)
+    if raw.execute("SELECT COUNT(*) FROM orders").fetchone()[0]:
+        raw.close()
+        return False
+    raw.execute("PRAGMA journal_mode=WAL")
+    raw.execute("PRAGMA synchronous=OFF")
+    raw.executemany("INSERT INTO tables (name, status) VALUES (?, 'available')", [(f"テーブル{i}",) for i in range(1, 21)])
+    menus = [(f"メニュー{i}", 150 + 50 * (i % 4), "フード" if i % 2 else "ドリンク") for i in range(1, 13)]
+    raw.executemany("INSERT INTO menus (name, price, category, is_out_of_stock) VALUES (?, ?, ?, 0)", menus)
+    prices = {i + 1: m[1] for i, m in enumerate(menus)}
+
+    rng = random.Random(args.seed)
+    now = datetime.now(JST).replace(tzinfo=None)
+    start = now - timedelta(days=days)
+    span = (now - start).total_seconds()
+    active_statuses = ["pending", "preparing", "ready"]
+    batch = 50_000
+    item_id = 0
+    for offset in range(0, n_orders, batch):
+        order_rows, item_rows = [], []
+        for order_id in range(offset + 1, min(offset + batch, n_orders) + 1):
+            created_at = start + timedelta(seconds=span * order_id / n_orders)
+            if order_id > n_orders - n_active:
+                status = rng.choice(active_statuses)
+            else:
+                status = "completed" if rng.random() < 0.95 else "cancelled"
+            total = 0
+            for _ in range(rng.randint(1, 3)):
+                item_id += 1
+                menu_id = rng.randint(1, len(menus))
+                quantity = rng.randint(1, 3)
+                total += prices[menu_id] * quantity
+                item_rows.append((item_id, order_id, menu_id, quantity))
+            order_rows.append((order_id, rng.choice([None, rng.randint(1, 20)]), total, status,
+                               created_at.strftime("%Y-%m-%d %H:%M:%S.%f")))
+        raw.executemany("INSERT INTO orders (id, table_id, total_price, status, created_at) VALUES (?, ?, ?, ?, ?)", order_rows)
+        raw.executemany("INSERT INTO order_items (id, order_id, menu_id, quantity) VALUES (?, ?, ?, ?)", item_rows)
+        raw.commit()
+    raw.execute("ANALYZE")
+    raw.commit()
+    raw.close()
+
+    db = SessionLocal()
+    try:
+        backfill(db)
+    finally:
+        db.close()
+    return True
+
+
+# --- 計測 -----------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        # 流入制御で断られた (429 / 503) 数
+        self.shed: Dict[str, int] = defaultdict(int)
+        # order_id -> 作成リクエストを送った時刻
+        self.sent: Dict[int, float] = {}
+        # 調理画面ごとの order_id -> 通知を受け取った時刻
+        self.received: List[Dict[int, float]] = []
+        self.deadline = 0.0
+
+    def record(self, name: str, started: float, ok: bool, shed: bool = False):
+        if shed:
+            self.shed[name] += 1
+        elif ok:
+            self.latencies[name].append((time.perf_counter() - started) * 1000)
+        else:
+            self.errors[name] += 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(stats: Stats, elapsed: float, grace: float) -> dict:
+    endpoints = {}
+    for name in sorted(set(stats.latencies) | set(stats.errors) | set(stats.shed)):
+        values = stats.latencies[name]
+        endpoints[name] = {
+            "count": len(values),
+            "errors": stats.errors[name],
+            "shed": stats.shed[name],
+            "throughput": len(values) / elapsed,
+            "p50_ms": percentile(values, 0.50),
+            "p99_ms": percentile(values, 0.99),
+            "max_ms": max(values, default=0.0),
+        }
+    lag = None
+    if stats.received:
+        # 終了直前に作成された注文は通知が間に合わないことがあるので除く
+        expected = {order_id: t for order_id, t in stats.sent.items() if t <= stats.deadline - grace}
+        lags = [
+            (received[order_id] - sent) * 1000
+            for received in stats.received
+            for order_id, sent in expected.items() if order_id in received
+        ]
+        total = len(expected) * len(stats.received)
+        lag = {
+            "delivered": len(lags),
+            "expected": total,
+            "p50_ms": percentile(lags, 0.50),
+            "p99_ms": percentile(lags, 0.99),
+            "max_ms": max(lags, default=0.0),
+        }
+    return {"duration": elapsed, "endpoints": endpoints, "broadcast_lag": lag}
+
+
+def print_report(result: dict):
+    print(f"\n{'endpoint':<42} {'count':>7} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7} {'shed':>6}")
+    for name, row in result["endpoints"].items():
+        print(f"{name:<42} {row['count']:>7} {row['throughput']:>8.1f} {row['p50_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['max_ms']:>9.2f} {row['errors']:>7} {row['shed']:>6}")
+    lag = result["broadcast_lag"]
+    if lag is None:
+        print("\nbroadcast lag: not measured (no WebSocket clients)")
+    else:
+        print(f"\nbroadcast lag (order created -> kitchen notified): p50 {lag['p50_ms']:.2f} ms, "
+              f"p99 {lag['p99_ms']:.2f} ms, max {lag['max_ms']:.2f} ms, "
+              f"delivered {lag['delivered']}/{lag['expected']}")
+
+
+# --- WebSocket クライアント ----------------------------------------------
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class ASGIWebSocket:
+    """アプリの ASGI 呼び出しに直接つなぐ WebSocket クライアント（inprocess モード用）"""
+
+    def __init__(self, app, path: str, query_string: str, client_port: int):
+        self.app = app
+        self.scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query_string.encode(),
+            "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", client_port),
+            "server": ("bench", 80),
+            "subprotocols": [],
+        }
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        self._task = asyncio.create_task(self.app(self.scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionClosed(message)
+        return self
+
+    async def recv(self) -> str:
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionClosed(message)
+        return message.get("text") or message.get("bytes", b"").decode()
+
+    async def send(self, text: str):
+        await self._to_app.put({"type": "websocket.receive", "text": text})
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, 5)
+            except (asyncio.TimeoutError, Exception):
+                self._task.cancel()
+
+
+class NetworkWebSocket:
+    """websockets パッケージでサーバーにつなぐクライアント（uvicorn モード用）"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._conn = None
+
+    async def connect(self):
+        self._conn = await websockets.connect(self.url, max_size=None)
+        return self
+
+    async def recv(self) -> str:
+        try:
+            data = await self._conn.recv()
+        except websockets.ConnectionClosed as e:
+            raise ConnectionClosed(e)
+        return data if isinstance(data, str) else data.decode()
+
+    async def send(self, text: str):
+        await self._conn.send(text)
+
+    async def close(self):
+        await self._conn.close()
+
+
+# --- クライアントのシナリオ ----------------------------------------------
+
+# 画面ごとに送る X-Client-Class (フロントエンドと同じ。モバイルは送らない)。X-Staff-Token と一緒に送る
+CLIENT_CLASSES = {"register": "register", "kitchen": "kitchen", "admin": "analytics"}
+
+
+def mobile_ip(index: int) -> str:
+    """モバイルのお客様ごとに別の IP から来たことにする (流入制御のレート制限は IP ごと)"""
+    return f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+
+
+class LoadTest:
+    def __init__(self, http: httpx.AsyncClient, open_ws, menu_ids: List[int], client_for=None):
+        self.http = http
+        # IP ごとの HTTP クライアントを返す関数 (無ければ X-Forwarded-For で伝える)
+        self.client_for = client_for
+        self.open_ws = open_ws
+        self.menu_ids = menu_ids
+        self.stats = Stats()
+        self.rng = random.Random(args.seed)
+        self.stop = asyncio.Event()
+
+    def order_body(self, status: str) -> dict:
+        items = [{"menu_id": self.rng.choice(self.menu_ids), "quantity": self.rng.randint(1, 3)}
+                 for _ in range(self.rng.randint(1, 3))]
+        return {"order_items": items, "status": status}
+
+    async def request(self, name: str, method: str, url: str, http: Optional[httpx.AsyncClient] = None,
+                      **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await (http or self.http).request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.stats.record(name, started, False)
+            return None
+        self.stats.record(name, started, response.status_code < 400, shed=response.status_code in (429, 503))
+        return response
+
+    @staticmethod
+    def headers(role: str) -> Dict[str, str]:
+        return {"X-Client-Class": CLIENT_CLASSES[role], "X-Staff-Token": STAFF_TOKEN}
+
+    async def sleep(self, seconds: float):
+        try:
+            await asyncio.wait_for(self.stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def register(self):
+        # 全員が同時に送り始めないようにずらす
+        await self.sleep(self.rng.random() * args.register_interval)
+        while not self.stop.is_set():
+            started = time.perf_counter()
+            response = await self.request("POST /api/orders/ (register)", "POST", "/api/orders/",
+                                          json=self.order_body("pending"), headers=self.headers("register"))
+            if response is not None and response.status_code < 400:
+                self.stats.sent[response.json()["id"]] = started
+            await self.sleep(args.register_interval)
+
+    async def kitchen(self, index: int):
+        if self.open_ws is None:
+            while not self.stop.is_set():
+                await self.request("GET /api/orders/active", "GET", "/api/orders/active", headers=self.headers("kitchen"))
+                await self.sleep(args.kitchen_poll)
+            return
+
+        received: Dict[int, float] = {}
+        self.stats.received.append(received)
+        dirty = asyncio.Event()
+        ws = await self.open_ws("/ws", "topics=orders.active", index)
+
+        async def reader():
+            while True:
+                try:
+                    data = await ws.recv()
+                except ConnectionClosed:
+                    self.stats.errors["ws disconnected"] += 1
+                    return
+                now = time.perf_counter()
+                try:
+                    message = json.loads(data)
+                except ValueError:
+                    continue
+                if message.get("type") == "ping":
+                    # 応答しないと WS_IDLE_TIMEOUT で切断される
+                    await ws.send(json.dumps({"action": "pong"}))
+                    continue
+                if message.get("type") == "session":
+                    continue
+                orders = message.get("orders") or ([message["order"]] if message.get("order") else [])
+                for order in orders:
+                    received.setdefault(order["id"], now)
+                dirty.set()
+
+        reader_task = asyncio.create_task(reader())
+        await self.request("GET /api/orders/active", "GET", "/api/orders/active", headers=self.headers("kitchen"))
+        while not self.stop.is_set():
+            waiter = asyncio.create_task(dirty.wait())
+            stopper = asyncio.create_task(self.stop.wait())
+            await asyncio.wait([waiter, stopper], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            stopper.cancel()
+            if self.stop.is_set():
+                break
+            dirty.clear()
+            await self.request("GET /api/orders/active", "GET", "/api/orders/active", headers=self.headers("kitchen"))
+        # 終了直前の通知を受け取れるように少し待ってから切断する
+        await asyncio.sleep(GRACE_SECONDS)
+        reader_task.cancel()
+        await ws.close()
+
+    async def mobile(self, index: int):
+        ip = mobile_ip(index)
+        http = self.client_for(ip) if self.client_for is not None else None
+        headers = {} if http is not None else {"X-Forwarded-For": ip}
+        await self.sleep(self.rng.random() * args.mobile_interval)
+        response = await self.request("POST /api/orders/ (mobile)", "POST", "/api/orders/", http=http,
+                                      json=self.order_body("unpaid"), headers=headers)
+        if response is None or response.status_code >= 400:
+            return
+        payment_number = response.json()["payment_number"]
+        while not self.stop.is_set():
+            await self.sleep(args.mobile_interval)
+            await self.request("GET /api/orders/by_payment_number", "GET",
+                               f"/api/orders/by_payment_number/{payment_number}", http=http, headers=headers)
+
+    async def admin(self):
+        polls = 0
+        while not self.stop.is_set():
+            await self.request("GET /api/orders/sales/realtime", "GET", "/api/orders/sales/realtime",
+                               headers=self.headers("admin"))
+            polls += 1
+            if polls % 10 == 1:
+                today = datetime.now(JST).date().isoformat()
+                await self.request("GET /api/orders/sales/by-time", "GET",
+                                   f"/api/orders/sales/by-time?start={today}&end={today}", headers=self.headers("admin"))
+            await self.sleep(args.admin_interval)
+
+    async def run(self) -> dict:
+        tasks = [asyncio.create_task(self.register()) for _ in range(args.registers)]
+        tasks += [asyncio.create_task(self.kitchen(i)) for i in range(args.kitchens)]
+        tasks += [asyncio.create_task(self.mobile(i)) for i in range(args.mobiles)]
+        tasks += [asyncio.create_task(self.admin()) for _ in range(args.admins)]
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        self.stats.deadline = time.perf_counter()
+        self.stop.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"client failed: {result!r}")
+        return summarize(self.stats, self.stats.deadline - started, GRACE_SECONDS)
+
+
+GRACE_SECONDS = 1.0
+
+
+async def fetch_menu_ids(http: httpx.AsyncClient) -> List[int]:
+    response = await http.get("/api/menus/")
+    response.raise_for_status()
+    return [menu["id"] for menu in response.json() if not menu.get("is_out_of_stock")]
+
+
+async def run_inprocess() -> dict:
+    from app.main import app
+
+    # ASGI の lifespan でアプリの startup / shutdown を実行する
+    lifespan_in: asyncio.Queue = asyncio.Queue()
+    lifespan_out: asyncio.Queue = asyncio.Queue()
+    lifespan = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}}, lifespan_in.get, lifespan_out.put))
+    await lifespan_in.put({"type": "lifespan.startup"})
+    message = await lifespan_out.get()
+    if message["type"] != "lifespan.startup.complete":
+        sys.exit(f"startup failed: {message}")
+
+    async def open_ws(path: str, query: str, index: int):
+        return await ASGIWebSocket(app, path, query, 50000 + index).connect()
+
+    transport = httpx.ASGITransport(app=app)
+    mobile_clients: Dict[str, httpx.AsyncClient] = {}
+
+    def client_for(ip: str) -> httpx.AsyncClient:
+        if ip not in mobile_clients:
+            mobile_clients[ip] = httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app, client=(ip, 50000)), base_url="http://bench", timeout=30)
+        return mobile_clients[ip]
+
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as http:
+            test = LoadTest(http, open_ws, await fetch_menu_ids(http), client_for)
+            return await test.run()
+    finally:
+        for client in mobile_clients.values():
+            await client.aclose()
+        await lifespan_in.put({"type": "lifespan.shutdown"})
+        await lifespan_out.get()
+        await lifespan
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_healthy(url: str, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=url) as http:
+        while time.perf_counter() < deadline:
+            try:
+                if (await http.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    sys.exit(f"server at {url} did not become healthy")
+
+
+async def run_uvicorn(url: str) -> dict:
+    await wait_until_healthy(url)
+    ws_base = url.replace("http", "ws", 1)
+    open_ws = None
+    if websockets is not None:
+        async def open_ws(path: str, query: str, index: int):
+            return await NetworkWebSocket(f"{ws_base}{path}?{query}").connect()
+    else:
+        print("websockets is not installed: kitchens poll /api/orders/active instead of subscribing")
+
+    limits = httpx.Limits(max_connections=args.registers + args.kitchens + args.mobiles + args.admins)
+    async with httpx.AsyncClient(base_url=url, timeout=30, limits=limits) as http:
+        test = LoadTest(http, open_ws, await fetch_menu_ids(http))
+        return await test.run()
+
+
+def main():
+    server = None
+    if args.url is None:
+        print(f"database: {db_file}")
+        t0 = time.perf_counter()
+        if seed(args.orders, args.days, args.active):
+            print(f"seeded {args.orders} orders in {time.perf_counter() - t0:.1f} s")
+
+    if args.mode == "inprocess":
+        result = asyncio.run(run_inprocess())
+    else:
+        url = args.url
+        if url is None:
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--workers", str(args.workers), "--log-level", "warning"],
+                cwd=BACKEND_DIR, env=os.environ.copy(),
+            )
+        try:
+            result = asyncio.run(run_uvicorn(url))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    result["config"] = {key: value for key, value in vars(args).items() if key != "json"}
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
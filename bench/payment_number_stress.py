@@ -0,0 +1,134 @@
+"""
+支払い番号の払い出しのストレステスト。
+
+一時的な SQLite データベースで、多数のスレッドから同時にモバイルオーダー (unpaid) を作成し、
+一部を完了・キャンセルして番号を再利用させながら、進行中の注文どうしで
+支払い番号が重複しないこと・作成が失敗しないことを確認する。
+番号の桁数を小さくして (既定 2桁 = 1296通り) 再利用が頻繁に起きるようにしている。
+
+    python bench/payment_number_stress.py --orders 20000 --threads 32
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=20_000, help="作成する注文数")
+    parser.add_argument("--threads", type=int, default=32, help="同時に注文を作成するスレッド数")
+    parser.add_argument("--length", type=int, default=2, help="支払い番号の桁数")
+    parser.add_argument("--max-active", type=int, default=1000, help="進行中の注文がこの数を超えたら古いものから完了させる")
+    parser.add_argument("--db", help="使用するデータベースファイル (既定: 一時ファイル)")
+    return parser.parse_args()
+
+
+args = parse_args()
+db_file = args.db or os.path.join(tempfile.mkdtemp(prefix="regi-bench-"), "bench.db")
+# app をインポートする前に、ベンチマーク用のデータベースと番号の桁数を指定する
+os.environ["DB_PATH"] = db_file
+os.environ["PAYMENT_NUMBER_LENGTH"] = str(args.length)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from fastapi import HTTPException  # noqa: E402
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.models import Menu, Order  # noqa: E402
+from app.payment_numbers import RELEASED_STATUSES, payment_numbers  # noqa: E402
+from app.routers import orders as orders_router  # noqa: E402
+from app.schemas import OrderCreate  # noqa: E402
+
+active_lock = threading.Lock()
+active = []  # 進行中の (order_id, payment_number)
+issued = Counter()
+errors = Counter()
+
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add(Menu(name="コロッケ", price=200, category="フード"))
+        db.commit()
+        return db.query(Menu.id).scalar()
+    finally:
+        db.close()
+
+
+def finish_order(order_id: int, payment_number: str):
+    """注文を完了またはキャンセルし、番号の返却をイベント経由と同じ方法で反映する"""
+    db = SessionLocal()
+    try:
+        status = random.choice(RELEASED_STATUSES)
+        db.query(Order).filter(Order.id == order_id).update({"status": status})
+        db.commit()
+    finally:
+        db.close()
+    payment_numbers.observe({"payment_number": payment_number, "status": status})
+
+
+def create_one(menu_id: int):
+    db = SessionLocal()
+    try:
+        order = OrderCreate(order_items=[{"menu_id": menu_id, "quantity": 1}], status="unpaid")
+        created, _ = orders_router.insert_orders([order], db)
+    except HTTPException as e:
+        errors[f"HTTP {e.status_code}"] += 1
+        return
+    except Exception as e:
+        errors[type(e).__name__] += 1
+        return
+    finally:
+        db.close()
+
+    code = created[0]["payment_number"]
+    to_finish = []
+    with active_lock:
+        issued[code] += 1
+        active.append((created[0]["id"], code))
+        while len(active) > args.max_active:
+            to_finish.append(active.pop(random.randrange(len(active) // 2 + 1)))
+    for order_id, payment_number in to_finish:
+        finish_order(order_id, payment_number)
+
+
+def check_database() -> int:
+    """進行中の注文で同じ支払い番号を持つものの数"""
+    db = SessionLocal()
+    try:
+        rows = db.query(Order.payment_number).filter(
+            Order.payment_number.isnot(None), Order.status.notin_(RELEASED_STATUSES)
+        ).all()
+    finally:
+        db.close()
+    counts = Counter(row[0] for row in rows)
+    return sum(count - 1 for count in counts.values() if count > 1)
+
+
+def main():
+    menu_id = seed()
+    capacity = len(payment_numbers.alphabet) ** args.length
+    print(f"db: {db_file}")
+    print(f"payment numbers: {capacity} codes, max active orders: {args.max_active}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        list(executor.map(lambda _: create_one(menu_id), range(args.orders)))
+    elapsed = time.perf_counter() - start
+
+    duplicates = check_database()
+    print(f"created {sum(issued.values())} orders in {elapsed:.1f}s ({sum(issued.values()) / elapsed:.0f} orders/s)")
+    print(f"distinct codes used: {len(issued)}, max reuse of one code: {max(issued.values(), default=0)}")
+    print(f"errors: {dict(errors) or 'none'}")
+    print(f"duplicate payment numbers among active orders: {duplicates}")
+    if duplicates or errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
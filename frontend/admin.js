@@ -1,67 +1,213 @@
 document.addEventListener('DOMContentLoaded', function() {
     const menuList = document.getElementById('menu-list');
+    const WS_BASE = window.location.origin.replace(/^http/, 'ws') + '/ws';
+    let menuData = [];
+
+    // 流入制御で調理画面として優先してもらうためのヘッダー。合言葉 (main.html?staff_token=... で保存) が無ければ送らない
+    function staffHeaders(headers = {}) {
+        const staffToken = localStorage.getItem('staffToken');
+        if (!staffToken) return headers;
+        return { ...headers, 'X-Client-Class': 'kitchen', 'X-Staff-Token': staffToken };
+    }
 
     // Function to fetch menus and display them
     async function fetchMenus() {
         try {
-            const response = await fetch('/api/menus/');
+            const response = await fetch('/api/menus/', { headers: staffHeaders() });
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
-            const menus = await response.json();
-            displayMenus(menus);
+            menuData = await response.json();
+            displayMenus();
         } catch (error) {
             console.error('Error fetching menus:', error);
             menuList.innerHTML = '<p>メニューの読み込みに失敗しました。</p>';
         }
     }
 
-    // Function to display menus
-    function displayMenus(menus) {
-        menuList.innerHTML = '';
+    // 変更後のメニューで手元の一覧を差し替える（再取得はしない）
+    function applyMenuChanges(menus) {
         menus.forEach(menu => {
-            const menuDiv = document.createElement('div');
-            menuDiv.classList.add('menu-item');
-            if (menu.is_out_of_stock) {
-                menuDiv.classList.add('out-of-stock');
+            const index = menuData.findIndex(m => m.id === menu.id);
+            if (index === -1) {
+                menuData.push(menu);
+            } else {
+                menuData[index] = menu;
             }
+        });
+        displayMenus();
+    }
+
+    // Function to display menus, grouped by category
+    function displayMenus() {
+        menuList.innerHTML = '';
+        const categories = [...new Set(menuData.map(menu => menu.category))];
+        categories.forEach(category => {
+            const menus = menuData.filter(menu => menu.category === category);
+
+            const header = document.createElement('div');
+            header.classList.add('menu-category');
+
+            const categoryName = document.createElement('h2');
+            categoryName.textContent = category;
+
+            const soldOutButton = document.createElement('button');
+            soldOutButton.textContent = 'すべて品切れ';
+            soldOutButton.disabled = menus.every(menu => menu.is_out_of_stock);
+            soldOutButton.addEventListener('click', () => toggleCategoryStock(category, true));
+
+            const restockButton = document.createElement('button');
+            restockButton.textContent = 'すべて在庫あり';
+            restockButton.disabled = menus.every(menu => !menu.is_out_of_stock);
+            restockButton.addEventListener('click', () => toggleCategoryStock(category, false));
+
+            header.appendChild(categoryName);
+            header.appendChild(soldOutButton);
+            header.appendChild(restockButton);
+            menuList.appendChild(header);
 
-            const menuName = document.createElement('span');
-            menuName.textContent = menu.name;
+            menus.forEach(menu => {
+                const menuDiv = document.createElement('div');
+                menuDiv.classList.add('menu-item');
+                if (menu.is_out_of_stock) {
+                    menuDiv.classList.add('out-of-stock');
+                }
 
-            const stockButton = document.createElement('button');
-            stockButton.textContent = menu.is_out_of_stock ? '在庫あり' : '品切れ';
-            stockButton.addEventListener('click', () => toggleStockStatus(menu.id, !menu.is_out_of_stock));
+                const menuName = document.createElement('span');
+                menuName.textContent = menu.name;
 
-            menuDiv.appendChild(menuName);
-            menuDiv.appendChild(stockButton);
-            menuList.appendChild(menuDiv);
+                const stockButton = document.createElement('button');
+                stockButton.textContent = menu.is_out_of_stock ? '在庫あり' : '品切れ';
+                stockButton.addEventListener('click', () => toggleStockStatus(menu.id, !menu.is_out_of_stock));
+
+                // 在庫数（空欄なら数えない）。注文のたびにサーバーで差し引かれ、0 で自動的に品切れになる
+                const quantityInput = document.createElement('input');
+                quantityInput.type = 'number';
+                quantityInput.min = '0';
+                quantityInput.placeholder = '在庫数';
+                quantityInput.value = menu.stock_quantity ?? '';
+
+                const quantityButton = document.createElement('button');
+                quantityButton.textContent = '在庫数を設定';
+                quantityButton.addEventListener('click', () => {
+                    const value = quantityInput.value.trim();
+                    setStockQuantity(menu.id, value === '' ? null : parseInt(value, 10));
+                });
+
+                menuDiv.appendChild(menuName);
+                menuDiv.appendChild(stockButton);
+                menuDiv.appendChild(quantityInput);
+                menuDiv.appendChild(quantityButton);
+                menuList.appendChild(menuDiv);
+            });
         });
     }
 
+    async function patchMenus(url, body) {
+        const response = await fetch(url, {
+            method: 'PATCH',
+            headers: staffHeaders({ 'Content-Type': 'application/json' }),
+            body: JSON.stringify(body),
+        });
+        if (!response.ok) {
+            throw new Error('Network response was not ok');
+        }
+        return response.json();
+    }
+
     // Function to toggle stock status
     async function toggleStockStatus(menuId, isOutOfStock) {
         try {
-            const response = await fetch(`/api/menus/${menuId}`,
-            {
-                method: 'PATCH',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ is_out_of_stock: isOutOfStock }),
-            });
+            const changed = await patchMenus('/api/menus/bulk', [{ id: menuId, is_out_of_stock: isOutOfStock }]);
+            applyMenuChanges(changed);
+        } catch (error) {
+            console.error('Error updating stock status:', error);
+        }
+    }
 
-            if (!response.ok) {
-                throw new Error('Network response was not ok');
-            }
+    async function setStockQuantity(menuId, stockQuantity) {
+        try {
+            const changed = await patchMenus('/api/menus/bulk', [{ id: menuId, stock_quantity: stockQuantity }]);
+            applyMenuChanges(changed);
+        } catch (error) {
+            console.error('Error updating stock quantity:', error);
+        }
+    }
 
-            // Refresh the menu list
-            fetchMenus();
+    // カテゴリ内のメニューを1回のリクエストでまとめて切り替える
+    async function toggleCategoryStock(category, isOutOfStock) {
+        try {
+            const changed = await patchMenus(
+                `/api/menus/categories/${encodeURIComponent(category)}/stock`,
+                { is_out_of_stock: isOutOfStock }
+            );
+            applyMenuChanges(changed);
         } catch (error) {
-            console.error('Error updating stock status:', error);
+            console.error('Error updating category stock status:', error);
         }
     }
 
+    // 再接続の時に送るセッション id と、サーバーからの ping の間隔（秒）
+    let sessionId = null;
+    let pingInterval = 20;
+    let currentSocket = null;
+    let watchdog = null;
+
+    function reconnectWebSocket(socket) {
+        // 同じ接続から何度も張り直さない
+        if (currentSocket !== socket) return;
+        currentSocket = null;
+        clearTimeout(watchdog);
+        setTimeout(connectWebSocket, 3000);
+    }
+
+    // ping も届かない接続（close イベントが来ないまま切れたもの）は見切って張り直す
+    function watchWebSocket(socket) {
+        clearTimeout(watchdog);
+        watchdog = setTimeout(() => {
+            socket.close();
+            reconnectWebSocket(socket);
+        }, pingInterval * 2500);
+    }
+
+    // 他の端末での変更を反映する
+    function connectWebSocket() {
+        const query = sessionId ? `topics=menu&session=${encodeURIComponent(sessionId)}` : 'topics=menu';
+        const websocket = new WebSocket(`${WS_BASE}?${query}`);
+        currentSocket = websocket;
+        websocket.onopen = () => {
+            watchWebSocket(websocket);
+        };
+        websocket.onmessage = (event) => {
+            watchWebSocket(websocket);
+            let data;
+            try {
+                data = JSON.parse(event.data);
+            } catch (error) {
+                return;
+            }
+            if (data.type === 'session') {
+                sessionId = data.session_id;
+                pingInterval = data.ping_interval || pingInterval;
+                return;
+            }
+            if (data.type === 'ping') {
+                websocket.send(JSON.stringify({ action: 'pong' }));
+                return;
+            }
+            if (data.type !== 'menu_update') return;
+            if (data.menus) {
+                applyMenuChanges(data.menus);
+            } else {
+                fetchMenus();
+            }
+        };
+        websocket.onclose = () => {
+            reconnectWebSocket(websocket);
+        };
+    }
+
     // Initial fetch
     fetchMenus();
-});
\ No newline at end of file
+    connectWebSocket();
+});
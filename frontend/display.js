@@ -6,6 +6,13 @@ document.addEventListener('DOMContentLoaded', function() {
     const API_BASE_URL = window.location.origin;
     const WS_BASE_URL = window.location.origin.replace(/^http/, 'ws')+"/ws";
 
+    // 流入制御で調理画面として優先してもらうためのヘッダー。合言葉 (main.html?staff_token=... で保存) が無ければ送らない
+    function staffHeaders(headers = {}) {
+        const staffToken = localStorage.getItem('staffToken');
+        if (!staffToken) return headers;
+        return { ...headers, 'X-Client-Class': 'kitchen', 'X-Staff-Token': staffToken };
+    }
+
     function createOrderCard(order) {
         const card = document.createElement('div');
         card.className = 'order-card';
@@ -42,14 +49,22 @@ document.addEventListener('DOMContentLoaded', function() {
         return card;
     }
 
-    function renderOrders(orders) {
+    const ACTIVE_STATUSES = ['pending', 'preparing', 'ready', '調理中', '提供可能'];
+    const ordersById = new Map();
+    // 注文ごとに反映したバージョン。まとめ送りや取り直しで古い状態が後から届いても巻き戻さない。
+    // バージョンは DB に保存されているので、全件を取り直す時も消さない
+    const orderVersions = new Map();
+    let lastSeq = null;
+    // seq の系列。サーバーが起動し直すと seq は 1 から振り直されるので、系列が変われば全件を取り直す
+    let seqEpoch = null;
+
+    function renderOrders() {
         pendingList.innerHTML = '';
         preparingList.innerHTML = '';
         readyList.innerHTML = '';
 
-        if (!orders || orders.length === 0) {
-            return;
-        }
+        const orders = Array.from(ordersById.values())
+            .sort((a, b) => new Date(a.created_at) - new Date(b.created_at));
 
         orders.forEach(order => {
             const orderCard = createOrderCard(order);
@@ -63,29 +78,132 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // 差分で受け取った注文をローカルの一覧に反映する
+    function applyOrder(order) {
+        if (order.version !== undefined) {
+            const known = orderVersions.get(order.id);
+            if (known !== undefined && order.version < known) return;
+            orderVersions.set(order.id, order.version);
+        }
+        if (ACTIVE_STATUSES.includes(order.status)) {
+            ordersById.set(order.id, order);
+        } else {
+            ordersById.delete(order.id);
+        }
+    }
+
     async function fetchActiveOrders() {
         try {
-            const response = await fetch(`${API_BASE_URL}/api/orders/active`);
+            const url = lastSeq === null
+                ? `${API_BASE_URL}/api/orders/active`
+                : `${API_BASE_URL}/api/orders/active?since_seq=${lastSeq}&epoch=${encodeURIComponent(seqEpoch || '')}`;
+            const response = await fetch(url, { headers: staffHeaders() });
             if (!response.ok) {
                 throw new Error(`Network response was not ok: ${response.statusText}`);
             }
-            const orders = await response.json();
-            renderOrders(orders);
+            const data = await response.json();
+            if (Array.isArray(data)) {
+                ordersById.clear();
+                data.forEach(applyOrder);
+                lastSeq = parseInt(response.headers.get('X-Order-Seq') || '0', 10);
+                seqEpoch = response.headers.get('X-Order-Seq-Epoch');
+            } else {
+                if (data.reset) ordersById.clear();
+                data.orders.forEach(applyOrder);
+                lastSeq = data.seq;
+                seqEpoch = data.epoch || null;
+            }
+            renderOrders();
         } catch (error) {
             console.error('Error fetching active orders:', error);
         }
     }
 
+    function handleMessage(data) {
+        if (data.type === 'seq') {
+            // このページに関係しない注文（未払いのモバイルオーダーなど）のイベントは seq だけが届く
+            if (lastSeq !== null && data.seq !== lastSeq + 1) {
+                fetchActiveOrders();
+            } else {
+                lastSeq = data.seq;
+            }
+            return;
+        }
+        const orders = data.orders || (data.order ? [data.order] : null);
+        if (!orders || typeof data.seq !== 'number') {
+            // 注文本体を含まないイベントは従来どおり取り直す
+            if (data.type === 'new_order' || data.type === 'update_order' || data.type === 'update_orders') fetchActiveOrders();
+            return;
+        }
+        if (lastSeq !== null && data.seq !== lastSeq + 1) {
+            // 取りこぼしがあれば差分を取り直す
+            fetchActiveOrders();
+            return;
+        }
+        orders.forEach(applyOrder);
+        lastSeq = data.seq;
+        renderOrders();
+    }
+
+    // 再接続の時に送るセッション id と、サーバーからの ping の間隔（秒）
+    let sessionId = null;
+    let pingInterval = 20;
+    let currentSocket = null;
+    let watchdog = null;
+
+    function reconnect(socket) {
+        // 同じ接続から何度も張り直さない
+        if (currentSocket !== socket) return;
+        currentSocket = null;
+        clearTimeout(watchdog);
+        setTimeout(setupWebSocket, 3000);
+    }
+
+    // ping も届かない接続（スリープ復帰後など、close イベントが来ないまま切れたもの）は見切って張り直す
+    function watch(socket) {
+        clearTimeout(watchdog);
+        watchdog = setTimeout(() => {
+            socket.close();
+            reconnect(socket);
+        }, pingInterval * 2500);
+    }
+
     function setupWebSocket() {
-        const ws = new WebSocket(`${WS_BASE_URL}/ws`);
-        ws.onopen = () => console.log('WebSocket connection established');
+        // 調理画面に関係する注文イベントだけを購読する
+        const query = sessionId ? `topics=orders.active&session=${encodeURIComponent(sessionId)}` : 'topics=orders.active';
+        const ws = new WebSocket(`${WS_BASE_URL}?${query}`);
+        currentSocket = ws;
+        ws.onopen = () => {
+            console.log('WebSocket connection established');
+            watch(ws);
+            // 切断中の変更を取り戻す
+            fetchActiveOrders();
+        };
         ws.onmessage = event => {
             console.log('WebSocket message received:', event.data);
-            // Re-fetch all data on any update
-            fetchActiveOrders();
+            watch(ws);
+            try {
+                const data = JSON.parse(event.data);
+                if (data.type === 'session') {
+                    sessionId = data.session_id;
+                    pingInterval = data.ping_interval || pingInterval;
+                    if (seqEpoch !== null && data.epoch && data.epoch !== seqEpoch) {
+                        // サーバーが起動し直した。手元の seq は使えないので全件を取り直す
+                        lastSeq = null;
+                        seqEpoch = null;
+                        fetchActiveOrders();
+                    }
+                } else if (data.type === 'ping') {
+                    ws.send(JSON.stringify({ action: 'pong' }));
+                } else {
+                    handleMessage(data);
+                }
+            } catch (error) {
+                console.error('Error handling WebSocket message:', error);
+            }
         };
         ws.onclose = () => {
-            setTimeout(setupWebSocket, 3000);
+            reconnect(ws);
         };
         ws.onerror = error => {
             console.error('WebSocket error:', error);
@@ -93,6 +211,5 @@ document.addEventListener('DOMContentLoaded', function() {
         };
     }
 
-    fetchActiveOrders();
     setupWebSocket();
 });
@@ -2,6 +2,10 @@ const API_BASE = '/api';
 
 let cart = [];
 let menuData = [];
+let websocket = null;
+let paymentNumbers = [];
+
+const WS_BASE = window.location.origin.replace(/^http/, 'ws') + '/ws';
 
 const elements = {
     menusGrid: document.getElementById('menus-grid'),
@@ -24,31 +28,47 @@ function fetchWithError(url, options = {}) {
 // --- Menu Loading ---
 async function loadMenus() {
     try {
-        const menus = await fetchWithError('/menus/');
-        menuData = menus;
-        elements.menusGrid.innerHTML = '';
-        menus.forEach(menu => {
-            const col = document.createElement('div');
-            col.className = 'col';
-            col.innerHTML = `
-                <div class="card h-100 ${menu.is_out_of_stock ? 'border-danger' : ''}">
-                    <div class="card-body d-flex flex-column">
-                        <h5 class="card-title">${menu.name}</h5>
-                        <p class="card-text">${menu.price}円</p>
-                        <button class="btn btn-primary mt-auto" ${menu.is_out_of_stock ? 'disabled' : ''} onclick="addToCart(${menu.id})">
-                            ${menu.is_out_of_stock ? '品切れ' : '追加'}
-                        </button>
-                    </div>
-                </div>
-            `;
-            elements.menusGrid.appendChild(col);
-        });
+        menuData = await fetchWithError('/menus/');
+        renderMenus();
     } catch (error) {
         console.error('メニュー取得エラー:', error);
         elements.menusGrid.innerHTML = '<p class="text-danger">メニューの読み込みに失敗しました。</p>';
     }
 }
 
+function renderMenus() {
+    elements.menusGrid.innerHTML = '';
+    menuData.forEach(menu => {
+        const col = document.createElement('div');
+        col.className = 'col';
+        col.innerHTML = `
+            <div class="card h-100 ${menu.is_out_of_stock ? 'border-danger' : ''}">
+                <div class="card-body d-flex flex-column">
+                    <h5 class="card-title">${menu.name}</h5>
+                    <p class="card-text">${menu.price}円</p>
+                    <button class="btn btn-primary mt-auto" ${menu.is_out_of_stock ? 'disabled' : ''} onclick="addToCart(${menu.id})">
+                        ${menu.is_out_of_stock ? '品切れ' : '追加'}
+                    </button>
+                </div>
+            </div>
+        `;
+        elements.menusGrid.appendChild(col);
+    });
+}
+
+// サーバーから送られてきた変更後のメニューで手元の一覧を差し替える
+function applyMenuChanges(menus) {
+    menus.forEach(menu => {
+        const index = menuData.findIndex(m => m.id === menu.id);
+        if (index === -1) {
+            menuData.push(menu);
+        } else {
+            menuData[index] = menu;
+        }
+    });
+    renderMenus();
+}
+
 // --- Cart Management ---
 function addToCart(menuId) {
     const menu = menuData.find(m => m.id === menuId);
@@ -125,20 +145,128 @@ elements.orderSubmitBtn.onclick = async () => {
 
     } catch (error) {
         console.error('注文作成エラー:', error);
+        if (error.message === 'HTTP 409') {
+            // 注文の間に在庫がなくなった
+            alert('品切れの商品が含まれています。カートの内容をご確認ください。');
+            loadMenus();
+            return;
+        }
         alert('注文の作成に失敗しました。時間をおいて再度お試しください。');
     }
 };
 
 function showConfirmationScreen(paymentNumber) {
     elements.paymentNumberDisplay.textContent = paymentNumber;
+    watchPaymentNumber(paymentNumber);
     elements.orderConfirmationModal.show();
     cart = [];
     updateCart();
 }
 
+// --- WebSocket ---
+// 再接続の時に送るセッション id と、サーバーからの ping の間隔（秒）
+let wsSessionId = null;
+let wsPingInterval = 20;
+let wsWatchdog = null;
+
+function reconnectWebSocket(socket) {
+    // 同じ接続から何度も張り直さない
+    if (websocket !== socket) return;
+    websocket = null;
+    clearTimeout(wsWatchdog);
+    setTimeout(connectWebSocket, 3000);
+}
+
+// スマートフォンのスリープ復帰後など、close イベントが来ないまま切れた接続は見切って張り直す
+function watchWebSocket(socket) {
+    clearTimeout(wsWatchdog);
+    wsWatchdog = setTimeout(() => {
+        socket.close();
+        reconnectWebSocket(socket);
+    }, wsPingInterval * 2500);
+}
+
+// メニュー更新と、自分の支払い番号の注文だけを購読する
+function connectWebSocket() {
+    const query = wsSessionId ? `topics=menu&session=${encodeURIComponent(wsSessionId)}` : 'topics=menu';
+    const socket = new WebSocket(`${WS_BASE}?${query}`);
+    websocket = socket;
+    socket.onopen = () => {
+        watchWebSocket(socket);
+        if (paymentNumbers.length > 0) {
+            socket.send(JSON.stringify({
+                action: 'subscribe',
+                topics: paymentNumbers.map(pn => `payment:${pn}`)
+            }));
+        }
+    };
+    socket.onmessage = (event) => {
+        watchWebSocket(socket);
+        let data;
+        try {
+            data = JSON.parse(event.data);
+        } catch (error) {
+            return;
+        }
+        if (data.type === 'session') {
+            wsSessionId = data.session_id;
+            wsPingInterval = data.ping_interval || wsPingInterval;
+        } else if (data.type === 'ping') {
+            socket.send(JSON.stringify({ action: 'pong' }));
+        } else if (data.type === 'menu_update') {
+            if (data.menus) {
+                applyMenuChanges(data.menus);
+            } else {
+                loadMenus();
+            }
+        } else {
+            const orders = data.orders || (data.order ? [data.order] : []);
+            orders
+                .filter(order => paymentNumbers.includes(order.payment_number))
+                .forEach(notifyOrderStatus);
+        }
+    };
+    socket.onclose = () => {
+        reconnectWebSocket(socket);
+    };
+}
+
+function watchPaymentNumber(paymentNumber) {
+    if (!paymentNumber || paymentNumbers.includes(paymentNumber)) return;
+    paymentNumbers.push(paymentNumber);
+    if (websocket && websocket.readyState === WebSocket.OPEN) {
+        websocket.send(JSON.stringify({ action: 'subscribe', topics: [`payment:${paymentNumber}`] }));
+    }
+}
+
+// 完了・キャンセルされた注文の支払い番号は別の注文に再利用されるので購読をやめる
+function unwatchPaymentNumber(paymentNumber) {
+    paymentNumbers = paymentNumbers.filter(pn => pn !== paymentNumber);
+    if (websocket && websocket.readyState === WebSocket.OPEN) {
+        websocket.send(JSON.stringify({ action: 'unsubscribe', topics: [`payment:${paymentNumber}`] }));
+    }
+}
+
+function notifyOrderStatus(order) {
+    const messages = {
+        pending: 'お支払いを確認しました。調理をお待ちください。',
+        preparing: '調理中です。',
+        ready: 'ご注文の準備ができました。受取場所へお越しください。',
+        cancelled: 'ご注文はキャンセルされました。'
+    };
+    const text = messages[order.status];
+    if (text) {
+        notie.alert({ type: order.status === 'cancelled' ? 'error' : 'info', text: `${order.payment_number}: ${text}`, time: 5 });
+    }
+    if (order.status === 'completed' || order.status === 'cancelled') {
+        unwatchPaymentNumber(order.payment_number);
+    }
+}
+
 // --- Initialization ---
 document.addEventListener('DOMContentLoaded', () => {
     elements.explanationModal.show();
     loadMenus();
     updateCart();
+    connectWebSocket();
 });
\ No newline at end of file
@@ -5,6 +5,7 @@ let currentMode = null; // 'cashier', 'kitchen', or 'admin'
 let cart = [];
 let fetchedMobileOrder = null; // To store the looked-up mobile order
 let activeOrders = [];
+let menuData = []; // 最後に取得したメニュー（menu_update の差分で更新する）
 let websocket = null;
 
 const elements = {
@@ -86,27 +87,171 @@ elements.adminModeBtn.onclick = () => {
 };
 
 
+// 通信できない・タイムアウト・サーバーの過負荷は、時間をおいて送り直せば成功しうる
+function isRetryableError(error) {
+    return !error.status || error.status === 429 || error.status >= 500;
+}
+
+// スタッフの端末の合言葉 (サーバーの ADMISSION_STAFF_TOKEN)。main.html?staff_token=... で一度開くと保存される
+const STAFF_TOKEN_KEY = 'staffToken';
+(function saveStaffToken() {
+    const params = new URLSearchParams(window.location.search);
+    const token = params.get('staff_token');
+    if (token === null) return;
+    localStorage.setItem(STAFF_TOKEN_KEY, token);
+    // アドレスバーや履歴に合言葉を残さない
+    params.delete('staff_token');
+    const query = params.toString();
+    history.replaceState(null, '', window.location.pathname + (query ? `?${query}` : '') + window.location.hash);
+})();
+
+// サーバーの流入制御で優先度を決めるため、画面ごとのクラスを伝える
+function clientClassHeaders(headers = {}) {
+    const clientClass = { cashier: 'register', kitchen: 'kitchen', admin: 'analytics' }[currentMode];
+    const staffToken = localStorage.getItem(STAFF_TOKEN_KEY);
+    // サーバーは合言葉の無いクラスのヘッダーを無視するので、合言葉を設定していない端末では送らない
+    if (!clientClass || !staffToken) return headers;
+    return { ...headers, 'X-Client-Class': clientClass, 'X-Staff-Token': staffToken };
+}
+
+// options.timeout (ミリ秒) を指定すると、応答が遅いリクエストを打ち切る
 async function fetchWithError(url, options = {}, retries = 3, delay = 1000) {
+    const { timeout, ...rest } = options;
+    const fetchOptions = { ...rest, headers: clientClassHeaders(rest.headers) };
     for (let i = 0; i < retries; i++) {
+        const controller = timeout ? new AbortController() : null;
+        const timer = controller ? setTimeout(() => controller.abort(), timeout) : null;
         try {
-            const res = await fetch(API_BASE + url, options);
+            const res = await fetch(API_BASE + url, controller ? { ...fetchOptions, signal: controller.signal } : fetchOptions);
             if (!res.ok) {
-                // サーバーからのエラーレスポンス(4xx, 5xx)はリトライしない
-                if (res.status >= 400 && res.status < 600) {
-                    throw new Error(`HTTP ${res.status}`);
-                }
-                // その他のエラー（ネットワーク障害など）はリトライの対象
-                throw new Error('Network response was not ok');
+                const error = new Error(`HTTP ${res.status}`);
+                error.status = res.status;
+                throw error;
             }
             return await res.json();
         } catch (error) {
             console.error(`Attempt ${i + 1} failed for ${url}:`, error.message);
-            if (i < retries - 1) {
+            // サーバーからのエラーレスポンス(4xx)は送り直しても結果が変わらないのでリトライしない
+            if (isRetryableError(error) && i < retries - 1) {
                 await new Promise(resolve => setTimeout(resolve, delay));
                 delay *= 2; // Exponential backoff
             } else {
                 throw error; // Last attempt failed, re-throw.
             }
+        } finally {
+            if (timer) clearTimeout(timer);
+        }
+    }
+}
+
+// --- 注文の送信とオフライン時の送信待ちキュー ---
+// 注文には冪等キーを付けるので、タイムアウト後に送り直しても二重に登録されない。
+// サーバーに届かない・過負荷の間は端末 (localStorage) に保存し、つながったら /batch でまとめて送る。
+const PENDING_ORDERS_KEY = 'pendingOrders';
+const ORDER_SUBMIT_TIMEOUT_MS = 8000;
+const PENDING_ORDERS_FLUSH_INTERVAL_MS = 10000;
+const PENDING_ORDERS_BATCH_SIZE = 50;
+let flushingPendingOrders = false;
+
+function newIdempotencyKey() {
+    // randomUUID は https でしか使えないので、LAN 内の http ではその場で作る
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+function loadPendingOrders() {
+    try {
+        return JSON.parse(localStorage.getItem(PENDING_ORDERS_KEY)) || [];
+    } catch (error) {
+        return [];
+    }
+}
+
+function savePendingOrders(orders) {
+    localStorage.setItem(PENDING_ORDERS_KEY, JSON.stringify(orders));
+    renderPendingOrders();
+}
+
+function renderPendingOrders() {
+    const status = document.getElementById('pending-orders-status');
+    if (!status) return;
+    const count = loadPendingOrders().length;
+    status.textContent = `送信待ちの注文: ${count}件 (タップで再送)`;
+    status.classList.toggle('hidden', count === 0);
+}
+
+function postOrderOptions(body, idempotencyKey) {
+    const headers = { 'Content-Type': 'application/json' };
+    if (idempotencyKey) headers['Idempotency-Key'] = idempotencyKey;
+    return { method: 'POST', headers, body: JSON.stringify(body), timeout: ORDER_SUBMIT_TIMEOUT_MS };
+}
+
+// レジの注文は1件でも /batch に送る。POST /api/orders/ はモバイルオーダーと同じ経路なので、
+// 合言葉を設定していない端末だと、サーバーの流入制御でモバイルオーダーと同じ優先度になってしまう
+async function postRegisterOrder(order, retries) {
+    const created = await fetchWithError('api/orders/batch', postOrderOptions([order], order.idempotency_key), retries);
+    return created[0];
+}
+
+// 注文を送信する。登録できれば { order }、端末に保存した場合は { queued: true } を返す
+async function submitOrder(order) {
+    const payload = { ...order, idempotency_key: newIdempotencyKey() };
+    try {
+        const created = await postRegisterOrder(payload, 2);
+        return { order: created };
+    } catch (error) {
+        if (!isRetryableError(error)) throw error;
+        savePendingOrders([...loadPendingOrders(), payload]);
+        return { queued: true };
+    }
+}
+
+// まとめて登録できなかった注文を1件ずつ送り、登録できなかった注文を返す (まだつながらなければ null)
+async function replayOrdersOneByOne(orders) {
+    const rejected = [];
+    for (const order of orders) {
+        try {
+            await postRegisterOrder(order, 1);
+        } catch (error) {
+            if (isRetryableError(error)) return null;
+            console.error('送信待ちの注文を登録できませんでした:', order, error.message);
+            rejected.push(order);
+        }
+    }
+    return rejected;
+}
+
+async function flushPendingOrders() {
+    if (flushingPendingOrders || loadPendingOrders().length === 0) return;
+    flushingPendingOrders = true;
+    let sent = 0;
+    let rejected = 0;
+    try {
+        let pending = loadPendingOrders();
+        while (pending.length > 0) {
+            const batch = pending.slice(0, PENDING_ORDERS_BATCH_SIZE);
+            try {
+                await fetchWithError('api/orders/batch', postOrderOptions(batch), 1);
+            } catch (error) {
+                if (isRetryableError(error)) return; // まだつながらないので次の機会に送る
+                // 品切れなどでまとめて登録できない場合は1件ずつ送る (登録済みの注文は冪等キーで重複しない)
+                const failed = await replayOrdersOneByOne(batch);
+                if (failed === null) return;
+                rejected += failed.length;
+            }
+            sent += batch.length;
+            // 送信中に保存された注文を消さないよう、読み直してから送った分だけ取り除く
+            const sentKeys = new Set(batch.map(order => order.idempotency_key));
+            pending = loadPendingOrders().filter(order => !sentKeys.has(order.idempotency_key));
+            savePendingOrders(pending);
+        }
+    } finally {
+        flushingPendingOrders = false;
+        if (sent > 0 && currentMode === 'cashier') loadHistory();
+        if (rejected > 0) {
+            alert(`送信待ちの注文のうち ${rejected}件は品切れなどのため登録できませんでした。`);
         }
     }
 }
@@ -114,23 +259,39 @@ async function fetchWithError(url, options = {}, retries = 3, delay = 1000) {
 // メニューロード (全メニュー)
 async function loadMenus() {
     try {
-        const menus = await fetchWithError('api/menus/');
-        elements.menusGrid.innerHTML = '';
-        menus.forEach(menu => {
-            const card = document.createElement('div');
-            card.className = 'menu-card';
-            card.innerHTML = `
-                <h3>${menu.name}</h3>
-                <p class="price">${menu.price}円</p>
-                <button onclick="addToCart(${menu.id}, '${menu.name.replace(/'/g, "\\'")}', ${menu.price})">追加</button>
-            `;
-            elements.menusGrid.appendChild(card);
-        });
+        menuData = await fetchWithError('api/menus/');
+        renderMenus();
     } catch (error) {
         console.error('メニュー取得エラー:', error);
     }
 }
 
+function renderMenus() {
+    elements.menusGrid.innerHTML = '';
+    menuData.forEach(menu => {
+        const card = document.createElement('div');
+        card.className = 'menu-card';
+        card.innerHTML = `
+            <h3>${menu.name}</h3>
+            <p class="price">${menu.price}円</p>
+            <button ${menu.is_out_of_stock ? 'disabled' : ''} onclick="addToCart(${menu.id}, '${menu.name.replace(/'/g, "\\'")}', ${menu.price})">${menu.is_out_of_stock ? '品切れ' : '追加'}</button>
+        `;
+        elements.menusGrid.appendChild(card);
+    });
+}
+
+// サーバーから送られてきた変更後のメニューで手元の一覧を差し替える
+function applyMenuChanges(menus) {
+    menus.forEach(menu => {
+        const index = menuData.findIndex(m => m.id === menu.id);
+        if (index === -1) {
+            menuData.push(menu);
+        } else {
+            menuData[index] = menu;
+        }
+    });
+}
+
 function addToCart(menuId, name, price) {
     const existing = cart.find(item => item.menuId === menuId);
     if (existing) {
@@ -270,16 +431,16 @@ elements.orderSubmitBtn.onclick = async () => {
                 resetMobileOrderLookup();
             } else {
                 // Paying for a local cart order: POST new order
-                const response = await fetchWithError('api/orders/', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        order_items: cart.map(item => ({ menu_id: item.menuId, quantity: item.quantity })),
-                        total_price: total,
-                        status: 'pending' // Direct payment, so status is pending
-                    })
+                const result = await submitOrder({
+                    order_items: cart.map(item => ({ menu_id: item.menuId, quantity: item.quantity })),
+                    total_price: total,
+                    status: 'pending' // Direct payment, so status is pending
                 });
-                alert(`注文完了: ID ${response.id} お釣り: ${received - total}円`);
+                if (result.queued) {
+                    alert(`サーバーに接続できないため、注文を端末に保存しました (送信待ち ${loadPendingOrders().length}件)。接続が戻ると自動で送信します。お釣り: ${received - total}円`);
+                } else {
+                    alert(`注文完了: ID ${result.order.id} お釣り: ${received - total}円`);
+                }
                 cart = [];
                 updateCart();
             }
@@ -292,6 +453,10 @@ elements.orderSubmitBtn.onclick = async () => {
 
         } catch (error) {
             console.error('支払い処理エラー:', error);
+            if (error.message === 'HTTP 409') {
+                alert('品切れの商品が含まれています。');
+                return;
+            }
             alert('支払い処理中にエラーが発生しました。');
         }
     }
@@ -355,7 +520,8 @@ elements.mobileOrderPayBtn.onclick = () => {
 // 注文履歴ロード
 async function loadHistory() {
     try {
-        const orders = await fetchWithError('api/orders/');
+        // 直近の注文だけを新しい順に取得する
+        const orders = await fetchWithError('api/orders/?desc=true&limit=50');
         elements.historyList.innerHTML = orders.map(order => `
             <div class="history-item">
                 <h4>注文 ${order.id} - ${order.created_at}</h4>
@@ -369,12 +535,20 @@ async function loadHistory() {
 }
 
 // 調理側: 注文ロード
+// 調理画面に表示する完了済みの注文の件数（新しい順）
+const COMPLETED_ORDERS_LIMIT = 100;
+
 async function loadOrders() {
     try {
-        const orders = await fetchWithError('api/orders/');
+        // 調理画面に必要なステータスだけをサーバー側で絞り込む。
+        // 進行中の注文は古いものも切り捨てずに全件、完了済みの注文だけ新しい順に件数を絞る
+        const [orders, completedOrders] = await Promise.all([
+            fetchWithError('api/orders/?status=unpaid,pending,preparing,ready'),
+            fetchWithError(`api/orders/?status=completed&desc=true&limit=${COMPLETED_ORDERS_LIMIT}`),
+        ]);
         
         // 表示対象の注文をフィルタリング
-        activeOrders = orders.filter(order => ['pending', 'preparing', 'ready', 'completed'].includes(order.status));
+        activeOrders = orders.filter(order => order.status !== 'unpaid').concat(completedOrders);
         const unpaidOrders = orders.filter(order => order.status === 'unpaid');
 
         elements.activeOrders.innerHTML = '';
@@ -444,17 +618,25 @@ function updateOrderStatus(orderId, status, confirmationMessage) {
 
     fetch(API_BASE + `api/orders/${orderId}`, {
         method: 'PATCH',
-        headers: { 'Content-Type': 'application/json' },
+        headers: clientClassHeaders({ 'Content-Type': 'application/json' }),
         body: JSON.stringify({ status })
     })
     .then(async res => {
+        if (res.status === 409) {
+            // 他の端末が先に更新していた。一覧を読み直して最新の状態を表示する
+            if (currentMode === 'kitchen') loadOrders();
+            if (currentMode === 'admin') loadAdminOrders();
+            notie.alert({ type: 'warning', text: `注文 ${orderId} は他の端末で更新されています。` });
+            return null;
+        }
         if (!res.ok) {
             const errorData = await res.json().catch(() => ({ detail: 'ステータス更新中に不明なエラーが発生しました。' }));
             throw new Error(errorData.detail || `HTTP ${res.status}`);
         }
         return res.json();
     })
-    .then(() => {
+    .then(order => {
+        if (!order) return;
         // すべての関連ビューをリロード
         if (currentMode === 'kitchen') loadOrders();
         if (currentMode === 'cashier') loadHistory();
@@ -482,26 +664,64 @@ function updateStatuses() {
 let reconnectInterval = 1000; // Initial reconnect delay 1s
 const maxReconnectInterval = 30000; // Max reconnect delay 30s
 let messageQueue = [];
+let reconnectTimer = null;
+// 再接続の時に送るセッション id（サーバーが古い接続を置き換え、購読を引き継ぐ）
+let wsSessionId = null;
+// サーバーからの ping の間隔（秒）。この 2.5 倍の間何も届かなければ切れているとみなす
+let wsPingInterval = 20;
+let wsWatchdog = null;
+
+function scheduleReconnect() {
+    console.log(`WebSocket切断。${reconnectInterval / 1000}秒後に再接続します。`);
+    clearTimeout(reconnectTimer);
+    reconnectTimer = setTimeout(connectWebSocket, reconnectInterval);
+    // Increase reconnect interval for next time (exponential backoff)
+    reconnectInterval = Math.min(reconnectInterval * 2, maxReconnectInterval);
+}
+
+// スリープから復帰した端末などで、close イベントが来ないまま切れている接続を見切って張り直す
+function watchWebSocket(socket) {
+    clearTimeout(wsWatchdog);
+    wsWatchdog = setTimeout(() => {
+        console.log('WebSocketの応答がありません。再接続します。');
+        socket.close();
+        if (websocket === socket) {
+            websocket = null;
+            scheduleReconnect();
+        }
+    }, wsPingInterval * 2500);
+}
 
 function connectWebSocket() {
-    if (websocket && websocket.readyState === WebSocket.OPEN) {
+    // 接続中のソケットがあれば作らない（再接続が重なって接続が増えないように）
+    if (websocket && (websocket.readyState === WebSocket.OPEN || websocket.readyState === WebSocket.CONNECTING)) {
         return;
     }
+    clearTimeout(reconnectTimer);
 
-    websocket = new WebSocket(WS_BASE);
+    const socket = new WebSocket(wsSessionId ? `${WS_BASE}?session=${encodeURIComponent(wsSessionId)}` : WS_BASE);
+    websocket = socket;
 
-    websocket.onopen = () => {
+    socket.onopen = () => {
         console.log('WebSocket接続');
         reconnectInterval = 1000; // Reset reconnect interval on successful connection
+        watchWebSocket(socket);
         processMessageQueue();
+        flushPendingOrders();
     };
 
-    websocket.onmessage = (event) => {
+    socket.onmessage = (event) => {
         console.log('WebSocket受信:', event.data);
+        watchWebSocket(socket);
         try {
             const data = JSON.parse(event.data);
             // Handle different message types based on mode
-            if (data.type === 'new_order' || data.type === 'update_order') {
+            if (data.type === 'session') {
+                wsSessionId = data.session_id;
+                wsPingInterval = data.ping_interval || wsPingInterval;
+            } else if (data.type === 'ping') {
+                socket.send(JSON.stringify({ action: 'pong' }));
+            } else if (data.type === 'new_order' || data.type === 'update_order' || data.type === 'update_orders') {
                  if (currentMode === 'kitchen') {
                     loadOrders();
                 }
@@ -510,14 +730,29 @@ function connectWebSocket() {
                 }
                 if (currentMode === 'admin') {
                     loadAdminOrders();
-                    loadRealtimeSales();
-                }
-            } else if (data.type === 'menu_update') {
-                if (currentMode === 'cashier') {
-                    loadMenus();
                 }
+            } else if (data.type === 'sales_update') {
+                // 売上はサーバーから集計結果が送られてくるので再取得しない
                 if (currentMode === 'admin') {
-                    loadMenuPriceManagement();
+                    renderRealtimeSales(data.sales);
+                }
+            } else if (data.type === 'menu_update') {
+                if (data.menus && menuData.length > 0) {
+                    // 変更されたメニューだけが送られてくるので再取得しない
+                    applyMenuChanges(data.menus);
+                    if (currentMode === 'cashier') {
+                        renderMenus();
+                    }
+                    if (currentMode === 'admin') {
+                        renderMenuPriceManagement();
+                    }
+                } else {
+                    if (currentMode === 'cashier') {
+                        loadMenus();
+                    }
+                    if (currentMode === 'admin') {
+                        loadMenuPriceManagement();
+                    }
                 }
             }
         } catch (error) {
@@ -525,15 +760,15 @@ function connectWebSocket() {
         }
     };
 
-    websocket.onclose = () => {
-        console.log(`WebSocket切断。${reconnectInterval / 1000}秒後に再接続します。`);
+    socket.onclose = () => {
+        // 見切って張り直した古い接続の close は無視する
+        if (websocket !== socket) return;
+        clearTimeout(wsWatchdog);
         websocket = null;
-        setTimeout(connectWebSocket, reconnectInterval);
-        // Increase reconnect interval for next time (exponential backoff)
-        reconnectInterval = Math.min(reconnectInterval * 2, maxReconnectInterval);
+        scheduleReconnect();
     };
 
-    websocket.onerror = (error) => {
+    socket.onerror = (error) => {
         console.error('WebSocketエラー:', error);
         // onerror will likely be followed by onclose, which handles reconnection.
     };
@@ -755,41 +990,46 @@ async function loadRealtimeSales() {
     
     try {
         const salesData = await fetchWithError('api/orders/sales/realtime');
-        if (elements.dailyTotal) {
-            elements.dailyTotal.textContent = `${salesData.daily_total}円`;
-        }
-        if (elements.pastHourTotal) {
-            elements.pastHourTotal.textContent = `${salesData.past_hour_total}円`;
-        }
-        if (elements.past30minTotal) {
-            elements.past30minTotal.textContent = `${salesData.past_30min_total}円`;
-        }
-        
-        // 商品別売上を表示
-        if (elements.menuSalesList && salesData.menu_sales) {
-            elements.menuSalesList.innerHTML = '';
-            if (salesData.menu_sales.length === 0) {
-                elements.menuSalesList.innerHTML = '<div class="no-menu-sales">今日はまだ売上がありません</div>';
-            } else {
-                salesData.menu_sales.forEach(item => {
-                    const salesItem = document.createElement('div');
-                    salesItem.className = 'menu-sales-item';
-                    salesItem.innerHTML = `
-                        <div class="menu-sales-info">
-                            <div class="menu-sales-name">${item.menu_name}</div>
-                            <div class="menu-sales-quantity">${item.quantity_sold}個</div>
-                        </div>
-                        <div class="menu-sales-total">${item.total_sales}円</div>
-                    `;
-                    elements.menuSalesList.appendChild(salesItem);
-                });
-            }
-        }
+        renderRealtimeSales(salesData);
     } catch (error) {
         console.error('リアルタイム売上取得エラー:', error);
     }
 }
 
+// WebSocket の sales_update でも同じ表示を更新する
+function renderRealtimeSales(salesData) {
+    if (elements.dailyTotal) {
+        elements.dailyTotal.textContent = `${salesData.daily_total}円`;
+    }
+    if (elements.pastHourTotal) {
+        elements.pastHourTotal.textContent = `${salesData.past_hour_total}円`;
+    }
+    if (elements.past30minTotal) {
+        elements.past30minTotal.textContent = `${salesData.past_30min_total}円`;
+    }
+    
+    // 商品別売上を表示
+    if (elements.menuSalesList && salesData.menu_sales) {
+        elements.menuSalesList.innerHTML = '';
+        if (salesData.menu_sales.length === 0) {
+            elements.menuSalesList.innerHTML = '<div class="no-menu-sales">今日はまだ売上がありません</div>';
+        } else {
+            salesData.menu_sales.forEach(item => {
+                const salesItem = document.createElement('div');
+                salesItem.className = 'menu-sales-item';
+                salesItem.innerHTML = `
+                    <div class="menu-sales-info">
+                        <div class="menu-sales-name">${item.menu_name}</div>
+                        <div class="menu-sales-quantity">${item.quantity_sold}個</div>
+                    </div>
+                    <div class="menu-sales-total">${item.total_sales}円</div>
+                `;
+                elements.menuSalesList.appendChild(salesItem);
+            });
+        }
+    }
+}
+
 // 時間別売上データロード
 // 今日の時間別売上データロード
 async function loadSalesByTime() {
@@ -825,7 +1065,8 @@ async function loadAdminOrders() {
     if (currentMode !== 'admin') return;
     
     try {
-        const orders = await fetchWithError('api/orders/');
+        // 一覧に表示する項目だけを新しい順に取得する
+        const orders = await fetchWithError('api/orders/?desc=true&limit=200&fields=id,created_at,total_price,status');
         
         if (elements.adminOrdersList) {
             elements.adminOrdersList.innerHTML = '';
@@ -873,37 +1114,40 @@ async function loadMenuPriceManagement() {
     if (currentMode !== 'admin') return;
     
     try {
-        const menus = await fetchWithError('api/menus/');
-        
-        if (elements.menuPriceList) {
-            elements.menuPriceList.innerHTML = '';
-            
-            if (menus.length === 0) {
-                elements.menuPriceList.innerHTML = '<div class="no-menus">メニューがありません</div>';
-                return;
-            }
-            
-            menus.forEach(menu => {
-                const priceItem = document.createElement('div');
-                priceItem.className = 'menu-price-item';
-                priceItem.innerHTML = `
-                    <div class="menu-price-info">
-                        <div class="menu-price-name">${menu.name}</div>
-                        <div class="menu-price-current">現在: ${menu.price}円</div>
-                    </div>
-                    <div class="menu-price-controls">
-                        <input type="number" class="menu-price-input" value="${menu.price}" min="0" step="10" id="price-${menu.id}">
-                        <button class="menu-price-update-btn" onclick="updateMenuPrice(${menu.id})">更新</button>
-                    </div>
-                `;
-                elements.menuPriceList.appendChild(priceItem);
-            });
-        }
+        menuData = await fetchWithError('api/menus/');
+        renderMenuPriceManagement();
     } catch (error) {
         console.error('メニュー価格管理取得エラー:', error);
     }
 }
 
+function renderMenuPriceManagement() {
+    if (elements.menuPriceList) {
+        elements.menuPriceList.innerHTML = '';
+        
+        if (menuData.length === 0) {
+            elements.menuPriceList.innerHTML = '<div class="no-menus">メニューがありません</div>';
+            return;
+        }
+        
+        menuData.forEach(menu => {
+            const priceItem = document.createElement('div');
+            priceItem.className = 'menu-price-item';
+            priceItem.innerHTML = `
+                <div class="menu-price-info">
+                    <div class="menu-price-name">${menu.name}</div>
+                    <div class="menu-price-current">現在: ${menu.price}円</div>
+                </div>
+                <div class="menu-price-controls">
+                    <input type="number" class="menu-price-input" value="${menu.price}" min="0" step="10" id="price-${menu.id}">
+                    <button class="menu-price-update-btn" onclick="updateMenuPrice(${menu.id})">更新</button>
+                </div>
+            `;
+            elements.menuPriceList.appendChild(priceItem);
+        });
+    }
+}
+
 // メニュー価格更新
 async function updateMenuPrice(menuId) {
     const priceInput = document.getElementById(`price-${menuId}`);
@@ -919,19 +1163,15 @@ async function updateMenuPrice(menuId) {
     }
     
     try {
-        await fetchWithError(`api/menus/${menuId}`, {
+        const updated = await fetchWithError(`api/menus/${menuId}`, {
             method: 'PATCH',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ price: newPrice })
         });
         
         alert('価格を更新しました');
-        loadMenuPriceManagement();
-        
-        // レジ側のメニューも更新
-        if (currentMode === 'cashier') {
-            loadMenus();
-        }
+        applyMenuChanges([updated]);
+        renderMenuPriceManagement();
     } catch (error) {
         console.error('価格更新エラー:', error);
         alert('価格の更新に失敗しました');
@@ -952,4 +1192,10 @@ function getStatusText(status) {
 }
 
 // 初期化
-connectWebSocket();
\ No newline at end of file
+connectWebSocket();
+renderPendingOrders();
+flushPendingOrders();
+setInterval(flushPendingOrders, PENDING_ORDERS_FLUSH_INTERVAL_MS);
+window.addEventListener('online', flushPendingOrders);
+const pendingOrdersStatus = document.getElementById('pending-orders-status');
+if (pendingOrdersStatus) pendingOrdersStatus.onclick = flushPendingOrders;
\ No newline at end of file
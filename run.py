@@ -1,7 +1,11 @@
+import os
 import uvicorn
 import sys
 sys.path.append('backend')
 from app.main import app
 
+# WebSocket の permessage-deflate（ブラウザとの間でフレームを圧縮する）。CPU が足りない場合は 0 で無効にする
+WS_PER_MESSAGE_DEFLATE = os.environ.get("WS_PER_MESSAGE_DEFLATE", "1") == "1"
+
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="localhost", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("app.main:app", host="localhost", port=8000, reload=True, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)